@@ -2,12 +2,23 @@ import os
 import streamlit as st
 import streamlit.components.v1 as components
 import pandas as pd
+import numpy as np
 import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime
 import re
 import hashlib
 import html
 import json
+import codecs
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import workers
 
 # =========================
 # CONFIG
@@ -254,6 +265,54 @@ except ImportError:
     HAS_PDF_LIB = False
 
 
+# =========================
+# PDF: TEXTO POR PÁGINA (paralelo)
+# =========================
+# extract_text() domina el tiempo de parseo de Control/manifiestos grandes. Se reparte en
+# bloques contiguos de páginas entre procesos (workers.py) y se reúne en orden, así que el
+# resultado es idéntico al serial. Las máquinas de estado corren después sobre esa lista.
+PDF_PARSE_WORKERS = min(4, os.cpu_count() or 1)  # 0/1 = serial
+PDF_PARSE_MIN_PAGES = 8  # con menos páginas no conviene levantar procesos
+
+
+def _pdf_bytes(src) -> bytes:
+    if isinstance(src, (bytes, bytearray)):
+        return bytes(src)
+    if isinstance(src, str):
+        with open(src, "rb") as f:
+            return f.read()
+    if hasattr(src, "getvalue"):
+        return src.getvalue()
+    try:
+        src.seek(0)
+    except Exception:
+        pass
+    return src.read()
+
+
+def pdf_extract_page_texts(src, max_workers: int = None) -> list:
+    """Texto de cada página en orden. Con max_workers > 1 usa un pool de procesos;
+    si el pool falla (entorno sin procesos, etc.) cae al modo serial."""
+    data = _pdf_bytes(src)
+    max_workers = PDF_PARSE_WORKERS if max_workers is None else int(max_workers)
+    if max_workers > 1:
+        try:
+            n = workers.pdf_page_count(data)
+            if n >= PDF_PARSE_MIN_PAGES:
+                k = min(max_workers, n)
+                bounds = [(i * n // k, (i + 1) * n // k) for i in range(k)]
+                ctx = multiprocessing.get_context("spawn")  # fork con hilos de Streamlit no es seguro
+                with ProcessPoolExecutor(max_workers=k, mp_context=ctx) as ex:
+                    parts = list(ex.map(
+                        workers.pdf_page_texts,
+                        [data] * k, [b[0] for b in bounds], [b[1] for b in bounds],
+                    ))
+                return [t for part in parts for t in part]
+        except Exception:
+            pass
+    return workers.pdf_page_texts(data)
+
+
 # =========================
 # UTILIDADES
 # =========================
@@ -266,9 +325,76 @@ def now_iso():
 
 
 # =========================
-# TEXT HELPERS
+# REGEX PRECOMPILADOS
 # =========================
+# Patrones que corren por línea, título o escaneo (parsers de Control/etiquetas, helpers de
+# texto). Se compilan una vez aquí: re.search("...", s) repite en cada llamada la búsqueda
+# en la caché interna de re.
 UBC_RE = re.compile(r"\[\s*UBC\s*:\s*([^\]]+)\]", re.IGNORECASE)
+MULTISPACE_RE = re.compile(r"\s{2,}")
+NON_DIGIT_RE = re.compile(r"\D")
+SKU_FLOAT0_RE = re.compile(r"\d+\.0")
+SKU_SCI_RE = re.compile(r"\d+(\.\d+)?[eE][+-]?\d+")
+BARCODE_SEP_RE = re.compile(r"[\s,;]+")
+
+# sufijo de ubicación al final del título: "[UBC: 2260]" o "UBC: 2260"
+UBC_SUFFIX_RE = re.compile(r"(\[\s*UBC\s*:\s*[^\]]+\])\s*$", re.IGNORECASE)
+UBC_SUFFIX_PLAIN_RE = re.compile(r"(UBC\s*:\s*\d+)\s*$", re.IGNORECASE)
+UBC_SUFFIX_STRIP_RE = re.compile(r"\s*(\[\s*UBC\s*:\s*[^\]]+\])\s*$", re.IGNORECASE)
+UBC_SUFFIX_PLAIN_STRIP_RE = re.compile(r"\s*(UBC\s*:\s*\d+)\s*$", re.IGNORECASE)
+
+# Control.pdf (sorting v2): una sola pasada por línea etiqueta cada dato por su grupo
+# (ver _s2_classify_control_line). "attr" marca líneas tipo "Color: Rojo", que no son nombres.
+S2_CTRL_LINE_RE = re.compile(
+    r"^(?P<ship>46\d{8,13})\b"          # Flex: shipment al inicio (evita códigos tipo 30119784...)
+    r"|\bPack\s*ID\s*:\s*(?P<pack>\d{10,20})\b"
+    r"|\bVenta\s*:\s*(?P<sale>\d{10,20})\b"
+    r"|\bSKU\s*:\s*(?P<sku>[0-9A-Za-z_-]{6,20})\b"
+    r"|\bCantidad\s*:\s*(?P<qty>\d+)\b"
+    r"|\b(?P<attr>color|acabado|modelo|di[aá]metro|voltaje|dise[nñ]o|tipo)\b\s*:",
+    re.IGNORECASE,
+)
+S2_CTRL_QTY_LABEL_RE = re.compile(r"Cantidad\s*:", re.IGNORECASE)
+S2_CTRL_SKU_TOKEN_RE = re.compile(r"\bSKU\s*:\s*[0-9A-Za-z_-]{6,20}\b", re.IGNORECASE)
+S2_CTRL_LEAD_NUM_RE = re.compile(r"^\d{8,15}\b")
+NAME_ATTR_RE = re.compile(r"\b(color|acabado|modelo|di[aá]metro|voltaje|dise[nñ]o|tipo)\b\s*:", re.IGNORECASE)
+NAME_LETTER_RE = re.compile(r"[A-Za-zÁÉÍÓÚÜÑáéíóúüñ]")
+
+# ZPL: solo los comandos que importan; el resto (^FO, ^A0, ^BY, ...) se salta dentro del regex.
+# ^FD captura el dato hasta su ^FS (un ^FD sin ^FS en la etiqueta queda con el grupo 2 vacío).
+ZPL_TOKEN_RE = re.compile(r"\^(?:FD([^^]*(?:\^(?!FS)[^^]*)*)(\^FS)?|(XZ|FH|B.))", re.S)
+
+# Etiquetas (sorting v2). Los extractores corren sobre los ^FD de la etiqueta rodeados por
+# "\x00": ningún patrón lo acepta, así que un match no cruza de un campo a otro, y "\x00"
+# marca dónde termina/empieza cada ^FD. Pack/Venta van en minúsculas (texto ya en lower()).
+S2_LABEL_SPLIT_RES = {
+    kind: (
+        re.compile(rf"{kind}\s*(?:id)?\s*:\s*(\d{{10,20}})"),         # completo
+        re.compile(rf"{kind}\s*(?:id)?\s*:\s*(\d{{4,10}})\s*\x00"),  # cabeza al final del ^FD
+    )
+    for kind in ("pack", "venta")
+}
+S2_LABEL_TAIL_RE = re.compile(r"\x00\s*([0-9 ]{6,20})\s*\x00")
+S2_LABEL_JSON_ID_RE = re.compile(r"\"id\"\s*:\s*\"(\d{8,15})\"")
+# un número pegado al inicio del ^FD no cuenta: en el texto ZPL la "D" de ^FD le quita el \b
+S2_LABEL_NUM_RE = re.compile(r"(?<!\x00)\b\d{10,15}\b")
+S2_LABEL_INFO_RES = [
+    ("destinatario", re.compile(r"Destinatario\s*:\s*(.+)", re.IGNORECASE)),
+    ("direccion", re.compile(r"Direccion\s*:\s*(.+)", re.IGNORECASE)),
+    ("comuna", re.compile(r"Comuna\s*:\s*(.+)", re.IGNORECASE)),
+    ("ciudad_destino", re.compile(r"Ciudad\s*de\s*destino\s*:\s*(.+)", re.IGNORECASE)),
+]
+S2_LABEL_DOMICILIO_RE = re.compile(r"Domicilio\s*:\s*(.+)", re.IGNORECASE)
+S2_LABEL_NAME_LINE_RE = re.compile(r"^\s*([A-ZÁÉÍÓÚÑ][^\n]{3,60})\s*\(([^\n]{2,30})\)\s*$", re.M)
+
+# escaneo de etiqueta en sorting v2
+S2_SCAN_JSON_ID_RE = re.compile(r"\d{8,20}")
+S2_SCAN_NUM_RE = re.compile(r"(\d{6,20})")
+
+
+# =========================
+# TEXT HELPERS
+# =========================
 
 def split_title_ubc(title: str):
     """Return (title_without_ubc, ubc_str_or_empty)."""
@@ -280,7 +406,7 @@ def split_title_ubc(title: str):
         # remove the whole [UBC: ...] chunk
         t = UBC_RE.sub("", t).strip()
         # collapse double spaces
-        t = re.sub(r"\s{2,}", " ", t)
+        t = MULTISPACE_RE.sub(" ", t)
     return t, ubc
 
 def to_chile_display(iso_str: str) -> str:
@@ -306,9 +432,9 @@ def normalize_sku(value) -> str:
     s = str(value).strip()
     if not s or s.lower() == "nan":
         return ""
-    if re.fullmatch(r"\d+\.0", s):
+    if SKU_FLOAT0_RE.fullmatch(s):
         s = s[:-2]
-    if re.fullmatch(r"\d+(\.\d+)?[eE][+-]?\d+", s):
+    if SKU_SCI_RE.fullmatch(s):
         try:
             s = str(int(float(s)))
         except Exception:
@@ -316,8 +442,21 @@ def normalize_sku(value) -> str:
     return s
 
 
+def normalize_sku_series(values: pd.Series) -> pd.Series:
+    """normalize_sku vectorizado (mismo resultado elemento a elemento)."""
+    s = values.astype(object).map(str).str.strip()
+    s = s.where(s.str.lower() != "nan", "")
+    dot0 = s.str.fullmatch(SKU_FLOAT0_RE)
+    s = s.where(~dot0, s.str[:-2])
+    sci = s.str.fullmatch(SKU_SCI_RE)
+    if sci.any():
+        s = s.copy()
+        s[sci] = s[sci].map(normalize_sku)
+    return s
+
+
 def only_digits(s: str) -> str:
-    return re.sub(r"\D", "", str(s or ""))
+    return NON_DIGIT_RE.sub("", str(s or ""))
 
 
 def split_barcodes(cell_value) -> list[str]:
@@ -326,7 +465,7 @@ def split_barcodes(cell_value) -> list[str]:
     s = str(cell_value).strip()
     if not s or s.lower() == "nan":
         return []
-    parts = re.split(r"[\s,;]+", s)
+    parts = BARCODE_SEP_RE.split(s)
     out = []
     for p in parts:
         p = p.strip()
@@ -344,8 +483,121 @@ def split_barcodes(cell_value) -> list[str]:
     return uniq
 
 
+# =========================
+# DB: POOL DE CONEXIONES (WAL)
+# =========================
+# Streamlit corre cada sesión en su propio hilo y varias PDAs/mesas escanean a la vez.
+# En vez de abrir un sqlite3.connect() por llamada, cada hilo toma UNA conexión del pool
+# y la reutiliza mientras tenga handles abiertos (get_conn() anidados comparten conexión).
+# Al cerrar el último handle, se hace rollback de lo no confirmado y vuelve al pool.
+DB_BUSY_TIMEOUT_MS = 5000
+DB_POOL_MAX_IDLE = 8
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL;",
+    f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS};",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA cache_size=-16000;",      # ~16 MB por conexión
+    "PRAGMA mmap_size=134217728;",    # 128 MB
+    "PRAGMA temp_store=MEMORY;",
+)
+
+_DB_POOL_LOCK = threading.Lock()
+_DB_POOL_IDLE: list = []
+_DB_THREAD = threading.local()
+
+
+def _db_open_raw() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_NAME, timeout=DB_BUSY_TIMEOUT_MS / 1000.0, check_same_thread=False)
+    for pragma in DB_PRAGMAS:
+        try:
+            conn.execute(pragma)
+        except sqlite3.Error:
+            # p.ej. journal_mode=WAL en un FS que no lo soporta: seguimos con el default
+            pass
+    return conn
+
+
+class _DBSlot:
+    """Conexión asignada a un hilo + cantidad de handles abiertos sobre ella."""
+    __slots__ = ("conn", "refs")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.refs = 0
+
+
+class _PooledConn:
+    """Handle devuelto por get_conn(). Se usa igual que sqlite3.Connection;
+    close() libera el handle (idempotente) en vez de cerrar la conexión."""
+    __slots__ = ("_slot", "_conn", "_closed")
+
+    def __init__(self, slot: _DBSlot):
+        self._slot = slot
+        self._conn = slot.conn
+        self._closed = False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._conn.__exit__(*exc)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        _db_release(self._slot)
+
+    def __del__(self):
+        # Handles olvidados (p.ej. st.rerun() antes de conn.close()) no deben
+        # dejar una transacción abierta ni la conexión tomada.
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def _db_release(slot: _DBSlot):
+    slot.refs -= 1
+    if slot.refs > 0:
+        return
+    if getattr(_DB_THREAD, "slot", None) is slot:
+        _DB_THREAD.slot = None
+    conn = slot.conn
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+    except sqlite3.Error:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return
+    with _DB_POOL_LOCK:
+        if len(_DB_POOL_IDLE) < DB_POOL_MAX_IDLE:
+            _DB_POOL_IDLE.append(conn)
+            return
+    conn.close()
+
+
 def get_conn():
-    return sqlite3.connect(DB_NAME, check_same_thread=False)
+    slot = getattr(_DB_THREAD, "slot", None)
+    if slot is None:
+        conn = None
+        with _DB_POOL_LOCK:
+            if _DB_POOL_IDLE:
+                conn = _DB_POOL_IDLE.pop()
+        if conn is None:
+            conn = _db_open_raw()
+        slot = _DBSlot(conn)
+        _DB_THREAD.slot = slot
+    slot.refs += 1
+    return _PooledConn(slot)
+
 
 
 # =========================
@@ -450,6 +702,9 @@ def _restore_tables_from_db_bytes(db_bytes: bytes, tables: list[str]) -> tuple[b
                 cdst.executemany(f"INSERT INTO {tname} VALUES ({ph});", rows)
 
         conn_dst.commit()
+        # El respaldo puede venir de una versión anterior del esquema (sin columnas/índices nuevos)
+        init_db(force=True)
+        _s2_label_info_invalidate()
         return True, None
     except Exception as e:
         try:
@@ -595,12 +850,61 @@ def autofocus_input(label: str):
 
 
 # =========================
-# DB INIT
+# DB INIT (migraciones versionadas)
 # =========================
-def init_db():
-    conn = get_conn()
-    c = conn.cursor()
+# El esquema se crea/migra UNA vez por proceso (no en cada rerun de Streamlit).
+# Cada migración queda registrada en schema_version; entre procesos se serializa
+# con un lock de archivo junto al .db. Las migraciones son idempotentes
+# (IF NOT EXISTS / _db_ensure_col) para poder re-aplicarlas tras un restore.
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
+
+DB_LOCK_FILE = DB_NAME + ".lock"
+
+_SCHEMA_LOCK = threading.Lock()
+_SCHEMA_READY = False
+
+
+def _db_table_cols(c, table: str) -> set:
+    try:
+        c.execute(f"PRAGMA table_info({table});")
+        return {r[1] for r in c.fetchall()}
+    except Exception:
+        return set()
+
+
+_DB_SCHEMA_CACHE = {"version": None, "tables": {}}
+
 
+def _db_schema_cols(c, table: str) -> frozenset:
+    """Columnas de una tabla, cacheadas por proceso mientras no cambie PRAGMA schema_version
+    (vacío si la tabla no existe). Para chequeos de esquema en rutas que corren en cada rerun."""
+    version = c.execute("PRAGMA schema_version;").fetchone()[0]
+    if _DB_SCHEMA_CACHE["version"] != version:
+        _DB_SCHEMA_CACHE["tables"] = {}
+        _DB_SCHEMA_CACHE["version"] = version
+    tables = _DB_SCHEMA_CACHE["tables"]
+    cols = tables.get(table)
+    if cols is None:
+        cols = tables[table] = frozenset(_db_table_cols(c, table))
+    return cols
+
+
+def _db_ensure_col(c, table: str, col: str, ddl: str):
+    if col in _db_table_cols(c, table):
+        return
+    try:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {col} {ddl};")
+    except Exception:
+        # Si falla (por locks o tablas raras), no botar la app.
+        pass
+
+
+def _mig_001_base(c):
+    """Tablas base: Picking Flex/Colecta, Full, Contador de paquetes y Sorting v1."""
     # --- FLEX/COLECTA ---
     c.execute("""
     CREATE TABLE IF NOT EXISTS orders (
@@ -832,64 +1136,47 @@ def init_db():
     """)
 
     # --- MIGRACIONES SUAVES (para BD antiguas) ---
-    def _cols(table: str) -> set:
-        try:
-            c.execute(f"PRAGMA table_info({table});")
-            return {r[1] for r in c.fetchall()}
-        except Exception:
-            return set()
+    # picking_tasks (nuevas columnas para reordenar por "Surtido en venta")
+    _db_ensure_col(c, "picking_tasks", "defer_rank", "INTEGER DEFAULT 0")
+    _db_ensure_col(c, "picking_tasks", "defer_at", "TEXT")
+    _db_ensure_col(c, "picking_incidences", "note", "TEXT")
 
-    def _ensure_col(table: str, col: str, ddl: str):
-        cols = _cols(table)
-        if col in cols:
-            return
-        try:
-            c.execute(f"ALTER TABLE {table} ADD COLUMN {col} {ddl};")
-        except Exception:
-            # Si falla (por locks o tablas raras), no botar la app.
-            pass
-
-        # picking_tasks (nuevas columnas para reordenar por "Surtido en venta")
-    _ensure_col("picking_tasks", "defer_rank", "INTEGER DEFAULT 0")
-    _ensure_col("picking_tasks", "defer_at", "TEXT")
-    _ensure_col("picking_incidences", "note", "TEXT")
-
-# sorting_manifests
-    _ensure_col("sorting_manifests", "name", "TEXT")
-    _ensure_col("sorting_manifests", "created_at", "TEXT")
-    _ensure_col("sorting_manifests", "status", "TEXT")
+    # sorting_manifests
+    _db_ensure_col(c, "sorting_manifests", "name", "TEXT")
+    _db_ensure_col(c, "sorting_manifests", "created_at", "TEXT")
+    _db_ensure_col(c, "sorting_manifests", "status", "TEXT")
 
     # sorting_runs
-    _ensure_col("sorting_runs", "manifest_id", "INTEGER")
-    _ensure_col("sorting_runs", "page_no", "INTEGER")
-    _ensure_col("sorting_runs", "mesa", "INTEGER")
-    _ensure_col("sorting_runs", "status", "TEXT")
-    _ensure_col("sorting_runs", "created_at", "TEXT")
-    _ensure_col("sorting_runs", "closed_at", "TEXT")
+    _db_ensure_col(c, "sorting_runs", "manifest_id", "INTEGER")
+    _db_ensure_col(c, "sorting_runs", "page_no", "INTEGER")
+    _db_ensure_col(c, "sorting_runs", "mesa", "INTEGER")
+    _db_ensure_col(c, "sorting_runs", "status", "TEXT")
+    _db_ensure_col(c, "sorting_runs", "created_at", "TEXT")
+    _db_ensure_col(c, "sorting_runs", "closed_at", "TEXT")
 
     # sorting_run_items
-    _ensure_col("sorting_run_items", "run_id", "INTEGER")
-    _ensure_col("sorting_run_items", "seq", "INTEGER")
-    _ensure_col("sorting_run_items", "ml_order_id", "TEXT")
-    _ensure_col("sorting_run_items", "pack_id", "TEXT")
-    _ensure_col("sorting_run_items", "sku", "TEXT")
-    _ensure_col("sorting_run_items", "title_ml", "TEXT")
-    _ensure_col("sorting_run_items", "title_tec", "TEXT")
-    _ensure_col("sorting_run_items", "qty", "INTEGER")
-    _ensure_col("sorting_run_items", "buyer", "TEXT")
-    _ensure_col("sorting_run_items", "address", "TEXT")
-    _ensure_col("sorting_run_items", "shipment_id", "TEXT")
-    _ensure_col("sorting_run_items", "status", "TEXT")
-    _ensure_col("sorting_run_items", "done_at", "TEXT")
-    _ensure_col("sorting_run_items", "incidence_note", "TEXT")
+    _db_ensure_col(c, "sorting_run_items", "run_id", "INTEGER")
+    _db_ensure_col(c, "sorting_run_items", "seq", "INTEGER")
+    _db_ensure_col(c, "sorting_run_items", "ml_order_id", "TEXT")
+    _db_ensure_col(c, "sorting_run_items", "pack_id", "TEXT")
+    _db_ensure_col(c, "sorting_run_items", "sku", "TEXT")
+    _db_ensure_col(c, "sorting_run_items", "title_ml", "TEXT")
+    _db_ensure_col(c, "sorting_run_items", "title_tec", "TEXT")
+    _db_ensure_col(c, "sorting_run_items", "qty", "INTEGER")
+    _db_ensure_col(c, "sorting_run_items", "buyer", "TEXT")
+    _db_ensure_col(c, "sorting_run_items", "address", "TEXT")
+    _db_ensure_col(c, "sorting_run_items", "shipment_id", "TEXT")
+    _db_ensure_col(c, "sorting_run_items", "status", "TEXT")
+    _db_ensure_col(c, "sorting_run_items", "done_at", "TEXT")
+    _db_ensure_col(c, "sorting_run_items", "incidence_note", "TEXT")
 
     # sorting_labels
-    _ensure_col("sorting_labels", "manifest_id", "INTEGER")
-    _ensure_col("sorting_labels", "pack_id", "TEXT")
-    _ensure_col("sorting_labels", "shipment_id", "TEXT")
-    _ensure_col("sorting_labels", "buyer", "TEXT")
-    _ensure_col("sorting_labels", "address", "TEXT")
-    _ensure_col("sorting_labels", "raw", "TEXT")
+    _db_ensure_col(c, "sorting_labels", "manifest_id", "INTEGER")
+    _db_ensure_col(c, "sorting_labels", "pack_id", "TEXT")
+    _db_ensure_col(c, "sorting_labels", "shipment_id", "TEXT")
+    _db_ensure_col(c, "sorting_labels", "buyer", "TEXT")
+    _db_ensure_col(c, "sorting_labels", "address", "TEXT")
+    _db_ensure_col(c, "sorting_labels", "raw", "TEXT")
 
     # Asegurar índices/constraints para UPSERT (BD antiguas)
     try:
@@ -901,20 +1188,492 @@ def init_db():
     except Exception:
         pass
 
+
+def _mig_002_sorting_v2(c):
+    """Sorting v2: Control PDF + etiquetas + corridas por mesa."""
+    c.execute("""CREATE TABLE IF NOT EXISTS s2_manifests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        status TEXT NOT NULL DEFAULT 'ACTIVE',
+        created_at TEXT NOT NULL
+    );""")
+    c.execute("""CREATE TABLE IF NOT EXISTS s2_files (
+        manifest_id INTEGER PRIMARY KEY,
+        control_pdf BLOB,
+        labels_txt BLOB,
+        control_name TEXT,
+        labels_name TEXT,
+        updated_at TEXT NOT NULL
+    );""")
+    c.execute("""CREATE TABLE IF NOT EXISTS s2_page_assign (
+        manifest_id INTEGER NOT NULL,
+        page_no INTEGER NOT NULL,
+        mesa INTEGER NOT NULL,
+        PRIMARY KEY (manifest_id, page_no)
+    );""")
+    c.execute("""CREATE TABLE IF NOT EXISTS s2_sales (
+        manifest_id INTEGER NOT NULL,
+        sale_id TEXT NOT NULL,
+        shipment_id TEXT,
+        page_no INTEGER NOT NULL,
+        mesa INTEGER,
+        status TEXT NOT NULL DEFAULT 'NEW',
+        opened_at TEXT,
+        closed_at TEXT,
+        PRIMARY KEY (manifest_id, sale_id)
+    );""")
+    c.execute("""CREATE TABLE IF NOT EXISTS s2_items (
+        manifest_id INTEGER NOT NULL,
+        sale_id TEXT NOT NULL,
+        sku TEXT NOT NULL,
+        description TEXT,
+        qty INTEGER NOT NULL,
+        picked INTEGER NOT NULL DEFAULT 0,
+        status TEXT NOT NULL DEFAULT 'PENDING',
+        PRIMARY KEY (manifest_id, sale_id, sku)
+    );""")
+    c.execute("""CREATE TABLE IF NOT EXISTS s2_labels (
+        manifest_id INTEGER NOT NULL,
+        shipment_id TEXT NOT NULL,
+        raw TEXT,
+        PRIMARY KEY (manifest_id, shipment_id)
+    );""")
+
+    # --- Migraciones suaves (SQLite) ---
+    try:
+        cols = [r[1] for r in c.execute("PRAGMA table_info(s2_sales);").fetchall()]
+        if "pack_id" not in cols:
+            c.execute("ALTER TABLE s2_sales ADD COLUMN pack_id TEXT;")
+        if "customer" not in cols:
+            c.execute("ALTER TABLE s2_sales ADD COLUMN customer TEXT;")
+    except Exception:
+        pass
+
+    # s2_items: guardar confirm_mode para trazabilidad (ej: MANUAL_NO_EAN)
+    try:
+        cols_i = [r[1] for r in c.execute("PRAGMA table_info(s2_items);").fetchall()]
+        if "confirm_mode" not in cols_i:
+            c.execute("ALTER TABLE s2_items ADD COLUMN confirm_mode TEXT;")
+        if "updated_at" not in cols_i:
+            c.execute("ALTER TABLE s2_items ADD COLUMN updated_at TEXT;")
+    except Exception:
+        pass
+
+
+    # Mapa Pack ID -> Shipment ID (necesario para Colecta)
+    c.execute("""CREATE TABLE IF NOT EXISTS s2_pack_ship (
+        manifest_id INTEGER NOT NULL,
+        pack_id TEXT NOT NULL,
+        shipment_id TEXT NOT NULL,
+        PRIMARY KEY (manifest_id, pack_id)
+    );""")
+
+
+# Índices secundarios para las consultas calientes (escaneo/picking).
+# (nombre, tabla, columnas). Incluyen las columnas del ORDER BY / SELECT
+# para que la búsqueda sea por índice y sin B-tree temporal.
+DB_INDEXES = [
+    ("idx_s2_sales_scan_ship", "s2_sales", "manifest_id, mesa, shipment_id, status, page_no, sale_id"),
+    ("idx_s2_sales_scan_pack", "s2_sales", "manifest_id, mesa, pack_id, status, page_no, sale_id"),
+    ("idx_s2_sales_ship", "s2_sales", "manifest_id, shipment_id, mesa, status"),
+    ("idx_s2_sales_pack", "s2_sales", "manifest_id, pack_id, status, shipment_id"),
+    ("idx_picking_tasks_ot", "picking_tasks", "ot_id, status"),
+    ("idx_sorting_run_items_run", "sorting_run_items", "run_id, status, seq"),
+    ("idx_sorting_run_items_group", "sorting_run_items", "run_id, ml_order_id, pack_id, seq"),
+    ("idx_order_items_order", "order_items", "order_id"),
+    ("idx_ot_orders_ot", "ot_orders", "ot_id, order_id"),
+    # detalle por SKU de Full – Admin (paginado en el orden del ORDER BY)
+    ("idx_full_items_detail", "full_batch_items", "batch_id, status, CAST(sku_ml AS INTEGER), sku_ml"),
+]
+
+
+def _db_ensure_indexes(c, indexes=None):
+    for name, table, cols in (indexes or DB_INDEXES):
+        c.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table}({cols});")
+
+
+def _mig_003_hot_indexes(c):
+    """Índices para búsquedas por escaneo (s2_sales, picking_tasks, sorting_run_items, ...)."""
+    _db_ensure_indexes(c)
+
+
+def _mig_004_app_meta(c):
+    """Clave/valor para estado interno (p.ej. hash del maestro ya sincronizado)."""
+    c.execute("""CREATE TABLE IF NOT EXISTS app_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );""")
+
+
+def _mig_005_pick_routes(c):
+    """Secuencia de ruta por tarea y recorrido estimado por OT."""
+    _db_ensure_col(c, "picking_tasks", "route_rank", "INTEGER")
+    _db_ensure_col(c, "picking_ots", "route_distance", "REAL")
+
+
+def _mig_006_s2_parse_cache(c):
+    """Cache de parseo de Control/Etiquetas por sha256 y hash del archivo vigente por manifiesto."""
+    c.execute("""CREATE TABLE IF NOT EXISTS s2_parse_cache (
+        digest TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        parser_version TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        created_at TEXT,
+        PRIMARY KEY (digest, kind, parser_version)
+    );""")
+    _db_ensure_col(c, "s2_files", "control_sha", "TEXT")
+    _db_ensure_col(c, "s2_files", "labels_sha", "TEXT")
+
+
+# Contadores por manifiesto de sorting v2 (s2_manifest_stats), mantenidos por triggers para
+# que _s2_get_stats sea una lectura de una fila. Por tabla: (columnas que vigila el trigger de
+# UPDATE, [(contador, expresión por fila con {r} = NEW/OLD/tabla, clave si es COUNT DISTINCT)]).
+# La expresión de un contador DISTINCT solo puede depender de su clave.
+# s2_labels y s2_pack_ship tienen PK (manifest_id, shipment_id / pack_id): ahí "distintos" es
+# un conteo simple. Ojo: INSERT OR REPLACE no dispara los triggers de DELETE; en estas tablas
+# usar ON CONFLICT ... DO UPDATE.
+S2_STATS_COUNTERS = {
+    "s2_sales": ("manifest_id, status, pack_id, shipment_id", [
+        ("sales_total", "1", None),
+        ("sales_pending", "{r}.status='PENDING'", None),
+        ("sales_done", "{r}.status='DONE'", None),
+        ("sales_with_pack", "COALESCE({r}.pack_id,'')!=''", None),
+        ("distinct_packs", "COALESCE({r}.pack_id,'')!=''", "pack_id"),
+        ("sales_with_ship", "COALESCE({r}.shipment_id,'')!=''", None),
+    ]),
+    "s2_items": ("manifest_id, status", [
+        ("items_total", "1", None),
+        ("items_pending", "{r}.status='PENDING'", None),
+        ("items_done", "{r}.status='DONE'", None),
+        ("items_incidence", "{r}.status='INCIDENCE'", None),
+    ]),
+    "s2_labels": ("manifest_id, shipment_id", [
+        ("labels_total", "1", None),
+        ("labels_with_ship", "COALESCE({r}.shipment_id,'')!=''", None),
+    ]),
+    "s2_pack_ship": ("manifest_id, pack_id, shipment_id", [
+        ("matched_by_pack", "COALESCE({r}.pack_id,'')!='' AND COALESCE({r}.shipment_id,'')!=''", None),
+    ]),
+}
+S2_STATS_NAMES = [name for _watch, counters in S2_STATS_COUNTERS.values() for name, _e, _k in counters]
+
+
+def _s2_stats_trigger_sql(table: str) -> list:
+    """CREATE TRIGGER (insert/delete/update) que mantienen los contadores de `table`."""
+    watch, counters = S2_STATS_COUNTERS[table]
+
+    def delta(r: str, op: str) -> str:
+        # r = NEW suma la fila nueva, r = OLD resta la anterior
+        sets = []
+        for name, expr, key in counters:
+            e = f"({expr.format(r=r)})"
+            if key:
+                if r == "NEW":   # primera fila con esa clave
+                    cond = (f"(SELECT COUNT(*) FROM {table} "
+                            f"WHERE manifest_id=NEW.manifest_id AND {key}=NEW.{key})=1")
+                else:            # ya no queda ninguna fila con esa clave
+                    cond = (f"NOT EXISTS (SELECT 1 FROM {table} "
+                            f"WHERE manifest_id=OLD.manifest_id AND {key}=OLD.{key})")
+                if op == "upd":
+                    cond = f"(OLD.manifest_id IS NOT NEW.manifest_id OR OLD.{key} IS NOT NEW.{key}) AND {cond}"
+                e = f"({e} AND {cond})"
+            sets.append(f"{name} = {name} {'+' if r == 'NEW' else '-'} {e}")
+        return f"UPDATE s2_manifest_stats SET {', '.join(sets)} WHERE manifest_id = {r}.manifest_id;"
+
+    # sin OR IGNORE: dentro de un trigger manda el ON CONFLICT de la sentencia que lo dispara (UPSERT)
+    ensure = ("INSERT INTO s2_manifest_stats(manifest_id) SELECT NEW.manifest_id "
+              "WHERE NOT EXISTS (SELECT 1 FROM s2_manifest_stats WHERE manifest_id=NEW.manifest_id);")
+    return [
+        f"CREATE TRIGGER trg_s2_stats_{table}_ins AFTER INSERT ON {table} BEGIN "
+        f"{ensure} {delta('NEW', 'ins')} END;",
+        f"CREATE TRIGGER trg_s2_stats_{table}_del AFTER DELETE ON {table} BEGIN "
+        f"{delta('OLD', 'del')} END;",
+        f"CREATE TRIGGER trg_s2_stats_{table}_upd AFTER UPDATE OF {watch} ON {table} BEGIN "
+        f"{ensure} {delta('OLD', 'upd')} {delta('NEW', 'upd')} END;",
+    ]
+
+
+def _mig_007_s2_manifest_stats(c):
+    """Contadores materializados por manifiesto (sorting v2) + triggers; se recalculan completos."""
+    _db_ensure_indexes(c)
+    cols = ", ".join(f"{name} INTEGER NOT NULL DEFAULT 0" for name in S2_STATS_NAMES)
+    c.execute(f"CREATE TABLE IF NOT EXISTS s2_manifest_stats (manifest_id INTEGER PRIMARY KEY, {cols});")
+    for name in S2_STATS_NAMES:
+        _db_ensure_col(c, "s2_manifest_stats", name, "INTEGER NOT NULL DEFAULT 0")
+    for table in S2_STATS_COUNTERS:
+        for op in ("ins", "del", "upd"):
+            c.execute(f"DROP TRIGGER IF EXISTS trg_s2_stats_{table}_{op};")
+        for sql in _s2_stats_trigger_sql(table):
+            c.execute(sql)
+    _s2_stats_rebuild(c)
+
+
+# Contadores por lote Full (full_batch_stats), mantenidos por triggers sobre full_batch_items
+# para que el resumen de Full – Admin sea una lectura de una fila:
+# (contador, expresión por fila con {r} = NEW/OLD/tabla). Se suman (no solo cuentan).
+FULL_STATS_COUNTERS = [
+    ("n_skus", "1"),
+    ("req_units", "COALESCE({r}.qty_required,0)"),
+    ("chk_units", "COALESCE({r}.qty_checked,0)"),
+    ("ok_skus", "{r}.status='OK'"),
+    ("touched_skus", "{r}.status IN ('PARTIAL','INCIDENCE','OVER','OK_WITH_ISSUES')"),
+    ("pending_skus", "{r}.status='PENDING'"),
+]
+FULL_STATS_NAMES = [name for name, _e in FULL_STATS_COUNTERS]
+
+
+def _full_stats_trigger_sql() -> list:
+    """CREATE TRIGGER (insert/delete/update) que mantienen full_batch_stats."""
+    def delta(r: str) -> str:
+        sets = ", ".join(
+            f"{name} = {name} {'+' if r == 'NEW' else '-'} COALESCE(({expr.format(r=r)}), 0)"
+            for name, expr in FULL_STATS_COUNTERS
+        )
+        return f"UPDATE full_batch_stats SET {sets} WHERE batch_id = {r}.batch_id;"
+
+    ensure = ("INSERT INTO full_batch_stats(batch_id) SELECT NEW.batch_id "
+              "WHERE NOT EXISTS (SELECT 1 FROM full_batch_stats WHERE batch_id=NEW.batch_id);")
+    return [
+        f"CREATE TRIGGER trg_full_stats_ins AFTER INSERT ON full_batch_items BEGIN "
+        f"{ensure} {delta('NEW')} END;",
+        f"CREATE TRIGGER trg_full_stats_del AFTER DELETE ON full_batch_items BEGIN "
+        f"{delta('OLD')} END;",
+        f"CREATE TRIGGER trg_full_stats_upd AFTER UPDATE OF batch_id, qty_required, qty_checked, status "
+        f"ON full_batch_items BEGIN {ensure} {delta('OLD')} {delta('NEW')} END;",
+    ]
+
+
+def _mig_008_full_batch_stats(c):
+    """Contadores materializados por lote Full + triggers + índice del detalle paginado."""
+    _db_ensure_indexes(c)
+    cols = ", ".join(f"{name} INTEGER NOT NULL DEFAULT 0" for name in FULL_STATS_NAMES)
+    c.execute(f"CREATE TABLE IF NOT EXISTS full_batch_stats (batch_id INTEGER PRIMARY KEY, {cols});")
+    for name in FULL_STATS_NAMES:
+        _db_ensure_col(c, "full_batch_stats", name, "INTEGER NOT NULL DEFAULT 0")
+    for op in ("ins", "del", "upd"):
+        c.execute(f"DROP TRIGGER IF EXISTS trg_full_stats_{op};")
+    for sql in _full_stats_trigger_sql():
+        c.execute(sql)
+    _full_stats_rebuild(c)
+
+
+# Versión por tarea de picking: cada alta/cambio deja task_version = (máx. de su OT) + 1, así
+# page_picking relee solo las filas con task_version > la última que vio. Índice propio
+# (no va en DB_INDEXES: la columna no existe aún cuando corre la migración 3).
+PICKING_TASK_VERSION_INDEX = ("idx_picking_tasks_version", "picking_tasks", "ot_id, task_version")
+PICKING_TASK_VERSION_WATCH = "ot_id, sku_ml, title_ml, title_tec, qty_total, qty_picked, status, defer_rank, route_rank"
+
+
+def _mig_009_picking_task_version(c):
+    """task_version en picking_tasks + triggers que la mantienen (refresco por delta en Picking)."""
+    _db_ensure_col(c, "picking_tasks", "task_version", "INTEGER NOT NULL DEFAULT 0")
+    _db_ensure_indexes(c, [PICKING_TASK_VERSION_INDEX])
+    bump = ("UPDATE picking_tasks SET task_version = "
+            "(SELECT COALESCE(MAX(task_version), 0) + 1 FROM picking_tasks WHERE ot_id = NEW.ot_id) "
+            "WHERE id = NEW.id;")
+    for op in ("ins", "upd"):
+        c.execute(f"DROP TRIGGER IF EXISTS trg_picking_tasks_version_{op};")
+    c.execute(f"CREATE TRIGGER trg_picking_tasks_version_ins AFTER INSERT ON picking_tasks BEGIN {bump} END;")
+    c.execute(f"CREATE TRIGGER trg_picking_tasks_version_upd AFTER UPDATE OF {PICKING_TASK_VERSION_WATCH} "
+              f"ON picking_tasks BEGIN {bump} END;")
+
+
+# Versión por venta (sorting v2): cualquier cambio en los ítems o en la venta sube
+# s2_sales.version, así el Camarero detecta con una lectura por PK lo que escribió otro equipo.
+S2_SALE_VERSION_ITEMS_WATCH = "sku, description, qty, picked, status"
+S2_SALE_VERSION_SALES_WATCH = "shipment_id, pack_id, customer, page_no, mesa, status"
+
+
+def _mig_010_s2_sale_version(c):
+    """version en s2_sales + triggers sobre s2_items / s2_sales (Camarero recarga la venta si cambió)."""
+    _db_ensure_col(c, "s2_sales", "version", "INTEGER NOT NULL DEFAULT 0")
+    bump = "UPDATE s2_sales SET version = version + 1 WHERE manifest_id = {r}.manifest_id AND sale_id = {r}.sale_id;"
+    triggers = {
+        "items_ins": f"AFTER INSERT ON s2_items BEGIN {bump.format(r='NEW')} END",
+        "items_del": f"AFTER DELETE ON s2_items BEGIN {bump.format(r='OLD')} END",
+        "items_upd": f"AFTER UPDATE OF {S2_SALE_VERSION_ITEMS_WATCH} ON s2_items BEGIN "
+                     f"{bump.format(r='OLD')} {bump.format(r='NEW')} END",
+        "sales_upd": f"AFTER UPDATE OF {S2_SALE_VERSION_SALES_WATCH} ON s2_sales BEGIN "
+                     f"{bump.format(r='NEW')} END",
+    }
+    for name, body in triggers.items():
+        c.execute(f"DROP TRIGGER IF EXISTS trg_s2_sale_version_{name};")
+        c.execute(f"CREATE TRIGGER trg_s2_sale_version_{name} {body};")
+
+
+SCHEMA_MIGRATIONS = [
+    (1, "base (picking, full, contador, sorting v1)", _mig_001_base),
+    (2, "sorting v2", _mig_002_sorting_v2),
+    (3, "índices consultas calientes", _mig_003_hot_indexes),
+    (4, "app_meta", _mig_004_app_meta),
+    (5, "ruta de picking", _mig_005_pick_routes),
+    (6, "sorting v2 cache de parseo", _mig_006_s2_parse_cache),
+    (7, "sorting v2 contadores por manifiesto", _mig_007_s2_manifest_stats),
+    (8, "full contadores por lote", _mig_008_full_batch_stats),
+    (9, "picking versión por tarea", _mig_009_picking_task_version),
+    (10, "sorting v2 versión por venta", _mig_010_s2_sale_version),
+]
+
+
+# Consultas calientes registradas: (nombre, índice esperado, tupla de índices aceptados o None, sql).
+# Si alguna vuelve a recorrer la tabla completa (plan "SCAN <tabla>") o deja de usar
+# su índice, es que falta o se perdió un índice.
+HOT_QUERIES = [
+    ("s2 escaneo por envío", "idx_s2_sales_scan_ship",
+     "SELECT sale_id FROM s2_sales WHERE manifest_id=? AND mesa=? AND shipment_id=? AND status='PENDING' "
+     "ORDER BY page_no, sale_id LIMIT 1;"),
+    ("s2 escaneo por pack", "idx_s2_sales_scan_pack",
+     "SELECT sale_id FROM s2_sales WHERE manifest_id=? AND mesa=? AND pack_id=? AND status='PENDING' "
+     "ORDER BY page_no, sale_id LIMIT 1;"),
+    ("s2 diagnóstico envío", "idx_s2_sales_ship",
+     "SELECT mesa, status FROM s2_sales WHERE manifest_id=? AND shipment_id=? LIMIT 5;"),
+    ("s2 contador packs distintos", "idx_s2_sales_pack",
+     "SELECT COUNT(*) FROM s2_sales WHERE manifest_id=? AND pack_id=?;"),
+    ("s2 versión de venta", None,
+     "SELECT version FROM s2_sales WHERE manifest_id=? AND sale_id=?;"),
+    ("s2 items de venta", None,
+     "SELECT sku, description, qty, picked, status FROM s2_items WHERE manifest_id=? AND sale_id=? ORDER BY sku;"),
+    ("picking tareas OT", ("idx_picking_tasks_ot", "idx_picking_tasks_version"),
+     "SELECT id, sku_ml, title_ml, title_tec, qty_total, qty_picked, status, defer_rank, route_rank, "
+     "CAST(sku_ml AS INTEGER) FROM picking_tasks WHERE ot_id=?;"),
+    ("picking versión OT", "idx_picking_tasks_version",
+     "SELECT COUNT(*), COALESCE(MAX(task_version), 0) FROM picking_tasks WHERE ot_id=?;"),
+    ("picking delta OT", "idx_picking_tasks_version",
+     "SELECT id FROM picking_tasks WHERE ot_id=? AND task_version>?;"),
+    ("picking defer_rank", "idx_picking_tasks_ot",
+     "SELECT COALESCE(MIN(defer_rank), 0) FROM picking_tasks WHERE ot_id=? AND status='PENDING';"),
+    ("sorting v1 siguiente grupo", None,
+     "SELECT ml_order_id, pack_id, MIN(seq) as mseq FROM sorting_run_items WHERE run_id=? AND status!='DONE' "
+     "GROUP BY ml_order_id, pack_id ORDER BY mseq ASC LIMIT 1;"),
+    ("sorting v1 items grupo", "idx_sorting_run_items_group",
+     "SELECT id, sku, qty, status FROM sorting_run_items WHERE run_id=? AND ml_order_id=? AND pack_id=? ORDER BY seq ASC;"),
+    ("sorting v1 cierre corrida", "idx_sorting_run_items_run",
+     "SELECT COUNT(1) FROM sorting_run_items WHERE run_id=? AND status!='DONE';"),
+    ("full detalle por SKU (página)", "idx_full_items_detail",
+     "SELECT sku_ml, title, qty_required, qty_checked, status, updated_at, areas, nros FROM full_batch_items "
+     "WHERE batch_id=? ORDER BY status, CAST(sku_ml AS INTEGER), sku_ml LIMIT ? OFFSET ?;"),
+    ("OT -> líneas de venta", "idx_order_items_order",
+     "SELECT oi.sku_ml, SUM(oi.qty) FROM ot_orders oo JOIN order_items oi ON oi.order_id = oo.order_id "
+     "WHERE oo.ot_id = ? GROUP BY oi.sku_ml;"),
+]
+
+_PLAN_SCAN_RE = re.compile(r"^SCAN (?:TABLE )?(\w+)")
+DB_STRICT_QUERY_PLANS = False  # True: init_db falla si una consulta caliente hace full scan
+_DB_PLAN_PROBLEMS: list = []
+
+
+def db_check_query_plans(conn=None, queries=None, strict: bool = False) -> list:
+    """EXPLAIN QUERY PLAN de HOT_QUERIES. Devuelve [(consulta, detalle del plan)] de las que
+    hacen SCAN completo o no usan su índice; con strict=True lanza RuntimeError si hay alguna."""
+    own = conn is None
+    if own:
+        conn = get_conn()
+    problems = []
+    try:
+        c = conn.cursor()
+        # El cache de sentencias de sqlite3 no re-prepara un EXPLAIN tras cambios de esquema:
+        # se incluye schema_version en el texto para no leer un plan viejo.
+        schema_ver = c.execute("PRAGMA schema_version;").fetchone()[0]
+        for label, index, sql in (queries or HOT_QUERIES):
+            params = (None,) * sql.count("?")
+            plan = [
+                str(r[-1])
+                for r in c.execute(f"EXPLAIN QUERY PLAN /* v{schema_ver} */ {sql}", params).fetchall()
+            ]
+            scans = [p for p in plan if _PLAN_SCAN_RE.match(p)]
+            allowed = (index,) if isinstance(index, str) else (index or ())
+            if scans or (allowed and not any(f"INDEX {i} " in p for i in allowed for p in plan)):
+                problems.append((label, " | ".join(plan)))
+    finally:
+        if own:
+            conn.close()
+    if problems and strict:
+        detail = "; ".join(f"{q}: {p}" for q, p in problems)
+        raise RuntimeError(f"Consultas calientes sin su índice: {detail}")
+    return problems
+
+
+@contextmanager
+def _db_file_lock(path: str = DB_LOCK_FILE):
+    """Lock exclusivo entre procesos (fcntl). Sin fcntl (Windows) no bloquea:
+    BEGIN IMMEDIATE sigue serializando a los escritores."""
+    fh = None
+    if HAS_FCNTL:
+        try:
+            fh = open(path, "a+")
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+        except OSError:
+            if fh is not None:
+                fh.close()
+            fh = None
+    try:
+        yield
+    finally:
+        if fh is not None:
+            try:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+            finally:
+                fh.close()
+
+
+def _schema_apply(conn, force: bool = False) -> int:
+    """Aplica las migraciones pendientes (o todas si force). Devuelve la versión final."""
+    c = conn.cursor()
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name TEXT,
+        applied_at TEXT
+    );
+    """)
     conn.commit()
-    conn.close()
+    current = int(c.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version;").fetchone()[0] or 0)
+    for version, name, fn in SCHEMA_MIGRATIONS:
+        if version <= current and not force:
+            continue
+        c.execute("BEGIN IMMEDIATE;")
+        try:
+            fn(c)
+            c.execute(
+                "INSERT OR REPLACE INTO schema_version (version, name, applied_at) VALUES (?,?,?);",
+                (version, name, now_iso()),
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        current = max(current, version)
+    return current
+
+
+def init_db(force: bool = False):
+    """Deja el esquema al día. Solo trabaja la primera vez en el proceso;
+    force=True re-aplica todas las migraciones (p.ej. después de restaurar tablas)."""
+    global _SCHEMA_READY, _DB_PLAN_PROBLEMS
+    if _SCHEMA_READY and not force:
+        return
+    with _SCHEMA_LOCK:
+        if _SCHEMA_READY and not force:
+            return
+        with _db_file_lock():
+            conn = get_conn()
+            try:
+                _schema_apply(conn, force=force)
+                _DB_PLAN_PROBLEMS = db_check_query_plans(conn, strict=DB_STRICT_QUERY_PLANS)
+            finally:
+                conn.close()
+        _SCHEMA_READY = True
 
 
 # =========================
 # MAESTRO SKU/EAN (AUTO)
 # =========================
-def load_master_from_path(path: str) -> tuple[dict, dict, list]:
+def _master_parse_excel(path: str) -> tuple[dict, dict, list, dict]:
+    """Lee el Excel del maestro (una sola vez) y devuelve
+    (sku->título técnico, barcode->sku, conflictos, sku->texto crudo del maestro)."""
     inv_map_sku = {}
     barcode_to_sku = {}
     conflicts = []
-
-    if not path or not os.path.exists(path):
-        return inv_map_sku, barcode_to_sku, conflicts
+    raw_titles = {}
 
     df = pd.read_excel(path, dtype=str)
     cols = df.columns.tolist()
@@ -924,6 +1683,26 @@ def load_master_from_path(path: str) -> tuple[dict, dict, list]:
     if "sku" in lower:
         sku_col = cols[lower.index("sku")]
 
+    # Texto "tal cual" de la celda (sin limpiar), primera fila de cada SKU
+    if sku_col is not None:
+        pref = [
+            "descripción", "descripcion", "artículo", "articulo",
+            "detalle", "producto", "nombre", "descripción pack", "nombre pack"
+        ]
+        raw_col = None
+        for cand in pref:
+            if cand in lower:
+                raw_col = cols[lower.index(cand)]
+                break
+        if raw_col is None:
+            raw_col = next((c for c in cols if c != sku_col), None)
+        if raw_col is not None:
+            for k, val in zip(df[sku_col].astype(str).map(normalize_sku), df[raw_col].tolist()):
+                if not k or k in raw_titles:
+                    continue
+                sval = "" if val is None else str(val)
+                raw_titles[k] = "" if sval.lower() == "nan" else sval
+
     tech_col = None
     for cand in ["artículo", "articulo", "descripcion", "descripción", "nombre", "producto", "detalle"]:
         if cand in lower:
@@ -958,118 +1737,332 @@ def load_master_from_path(path: str) -> tuple[dict, dict, list]:
             df = df0
             barcode_col = None  # sin header no asumimos dónde está EAN
 
-    for _, r in df.iterrows():
-        sku = normalize_sku(r.get(sku_col, ""))
+    if sku_col is None:
+        return inv_map_sku, barcode_to_sku, conflicts, raw_titles
+
+    n = len(df)
+    skus = df[sku_col].tolist()
+    techs = df[tech_col].tolist() if tech_col is not None else [""] * n
+    bcs = df[barcode_col].tolist() if barcode_col is not None else [None] * n
+
+    for sku_v, tech_v, bc_v in zip(skus, techs, bcs):
+        sku = normalize_sku(sku_v)
         if not sku:
             continue
 
-        tech = str(r.get(tech_col, "")).strip() if tech_col is not None else ""
+        tech = str(tech_v).strip()
         if tech and tech.lower() != "nan":
             inv_map_sku[sku] = tech
 
         if barcode_col is not None:
-            codes = split_barcodes(r.get(barcode_col, ""))
+            codes = split_barcodes(bc_v)
             for code in codes:
                 if code in barcode_to_sku and barcode_to_sku[code] != sku:
                     conflicts.append((code, barcode_to_sku[code], sku))
                     continue
                 barcode_to_sku[code] = sku
 
-    return inv_map_sku, barcode_to_sku, conflicts
+    return inv_map_sku, barcode_to_sku, conflicts, raw_titles
 
 
-# Cache extra: lookup directo del título "tal cual" en el maestro (sin limpiar)
-_MASTER_DF_CACHE = {"path": None, "mtime": None, "df": None}
+# -------------------------
+# Índice compilado del maestro (sidecar SQLite junto al .xlsx)
+# -------------------------
+# Abrir el Excel con openpyxl domina el arranque de cada proceso. El maestro se compila a
+# "<maestro>.idx.sqlite" (sku->título, sku->texto crudo, barcode->sku, conflictos) y solo se
+# vuelve a leer el Excel si cambia su contenido (sha256). Mientras mtime/size coincidan con
+# lo guardado en meta ni siquiera se calcula el hash.
+MASTER_INDEX_VERSION = "1"
+MASTER_INDEX_SUFFIX = ".idx.sqlite"
 
-def _load_master_df_cached(path: str):
-    """Carga el Excel del maestro una sola vez (por mtime) para poder buscar el texto crudo."""
-    if not path or not os.path.exists(path):
-        return None
+_MASTER_INDEX_LOCK = threading.Lock()
+_MASTER_INDEX_CACHE = {}  # path -> {"stat": (mtime_ns, size), "index": str|None, "sha": str, "data": tuple}
+
+
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _master_stat(path: str):
+    st_ = os.stat(path)
+    return (int(st_.st_mtime_ns), int(st_.st_size))
+
+
+def _master_index_path(path: str) -> str:
+    return path + MASTER_INDEX_SUFFIX
+
+
+def _master_index_meta(index_path: str) -> dict:
+    if not os.path.exists(index_path):
+        return {}
     try:
-        mtime = os.path.getmtime(path)
-    except Exception:
-        mtime = None
+        con = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True)
+        try:
+            return dict(con.execute("SELECT key, value FROM meta;").fetchall())
+        finally:
+            con.close()
+    except sqlite3.Error:
+        return {}
+
 
-    if (_MASTER_DF_CACHE.get("path") == path and _MASTER_DF_CACHE.get("mtime") == mtime
-            and _MASTER_DF_CACHE.get("df") is not None):
-        return _MASTER_DF_CACHE["df"]
+def master_index_compile(path: str, sha: str = None) -> str:
+    """Parsea el Excel y escribe el índice (archivo temporal + os.replace, atómico)."""
+    index_path = _master_index_path(path)
+    stat = _master_stat(path)
+    sha = sha or _file_sha256(path)
+    inv_map_sku, barcode_to_sku, conflicts, raw_titles = _master_parse_excel(path)
 
+    tmp = f"{index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    con = sqlite3.connect(tmp)
     try:
-        dfm = pd.read_excel(path, dtype=str)
-    except Exception:
+        con.executescript("""
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE sku_title (sku TEXT PRIMARY KEY, title TEXT) WITHOUT ROWID;
+            CREATE TABLE sku_raw (sku TEXT PRIMARY KEY, raw TEXT) WITHOUT ROWID;
+            CREATE TABLE barcodes (barcode TEXT PRIMARY KEY, sku TEXT) WITHOUT ROWID;
+            CREATE TABLE conflicts (seq INTEGER PRIMARY KEY, barcode TEXT, sku_a TEXT, sku_b TEXT);
+        """)
+        con.executemany("INSERT INTO sku_title VALUES (?,?);", inv_map_sku.items())
+        con.executemany("INSERT INTO sku_raw VALUES (?,?);", raw_titles.items())
+        con.executemany("INSERT INTO barcodes VALUES (?,?);", barcode_to_sku.items())
+        con.executemany("INSERT INTO conflicts (barcode, sku_a, sku_b) VALUES (?,?,?);", conflicts)
+        con.executemany("INSERT INTO meta VALUES (?,?);", [
+            ("version", MASTER_INDEX_VERSION),
+            ("sha256", sha),
+            ("mtime_ns", str(stat[0])),
+            ("size", str(stat[1])),
+            ("compiled_at", now_iso()),
+        ])
+        con.commit()
+    finally:
+        con.close()
+    os.replace(tmp, index_path)
+    return index_path
+
+
+def _master_index_ensure(path: str):
+    """Devuelve (ruta índice al día, sha256). Recompila solo si cambió el contenido."""
+    index_path = _master_index_path(path)
+    stat = _master_stat(path)
+    meta = _master_index_meta(index_path)
+    if meta.get("version") == MASTER_INDEX_VERSION:
+        if (meta.get("mtime_ns"), meta.get("size")) == (str(stat[0]), str(stat[1])):
+            return index_path, meta.get("sha256", "")
+        sha = _file_sha256(path)
+        if meta.get("sha256") == sha:
+            # Mismo contenido (p.ej. checkout/copia): solo refrescar mtime/size
+            con = sqlite3.connect(index_path)
+            try:
+                con.executemany("INSERT OR REPLACE INTO meta VALUES (?,?);",
+                                [("mtime_ns", str(stat[0])), ("size", str(stat[1]))])
+                con.commit()
+            finally:
+                con.close()
+            return index_path, sha
+    else:
+        sha = _file_sha256(path)
+    return master_index_compile(path, sha=sha), sha
+
+
+def _master_index_load(index_path: str) -> tuple[dict, dict, list]:
+    con = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True)
+    try:
+        inv_map_sku = dict(con.execute("SELECT sku, title FROM sku_title;").fetchall())
+        barcode_to_sku = dict(con.execute("SELECT barcode, sku FROM barcodes;").fetchall())
+        conflicts = [tuple(r) for r in con.execute("SELECT barcode, sku_a, sku_b FROM conflicts ORDER BY seq;")]
+    finally:
+        con.close()
+    return inv_map_sku, barcode_to_sku, conflicts
+
+
+def _master_index_entry(path: str):
+    """Entrada del cache de proceso para el maestro (compila/carga si cambió el archivo)."""
+    if not path or not os.path.exists(path):
         return None
+    stat = _master_stat(path)
+    ent = _MASTER_INDEX_CACHE.get(path)
+    if ent is not None and ent["stat"] == stat:
+        return ent
+    with _MASTER_INDEX_LOCK:
+        ent = _MASTER_INDEX_CACHE.get(path)
+        if ent is not None and ent["stat"] == stat:
+            return ent
+        try:
+            index_path, sha = _master_index_ensure(path)
+            data = _master_index_load(index_path)
+            raw_titles = None
+        except (OSError, sqlite3.Error):
+            # Carpeta de solo lectura u otro problema con el sidecar: leer el Excel directo
+            index_path, sha = None, _file_sha256(path)
+            inv_map_sku, barcode_to_sku, conflicts, raw_titles = _master_parse_excel(path)
+            data = (inv_map_sku, barcode_to_sku, conflicts)
+        ent = {"stat": stat, "index": index_path, "sha": sha, "data": data, "raw": raw_titles}
+        _MASTER_INDEX_CACHE[path] = ent
+        return ent
 
-    _MASTER_DF_CACHE.update({"path": path, "mtime": mtime, "df": dfm})
-    return dfm
 
-def master_raw_title_lookup(path: str, sku: str) -> str:
-    """Devuelve el texto EXACTO del maestro para ese SKU (tal cual viene en la celda)."""
-    dfm = _load_master_df_cached(path)
-    if dfm is None or dfm.empty:
-        return ""
-    cols = list(dfm.columns)
-    lower = [str(c).strip().lower() for c in cols]
+def load_master_from_path(path: str) -> tuple[dict, dict, list]:
+    ent = _master_index_entry(path)
+    if ent is None:
+        return {}, {}, []
+    return ent["data"]
 
-    # columna SKU
-    sku_col = None
-    if "sku" in lower:
-        sku_col = cols[lower.index("sku")]
-    if sku_col is None:
-        return ""
 
-    # preferir columnas típicas de descripción/título
-    pref = [
-        "descripción", "descripcion", "artículo", "articulo",
-        "detalle", "producto", "nombre", "descripción pack", "nombre pack"
-    ]
-    title_col = None
-    for cand in pref:
-        if cand in lower:
-            title_col = cols[lower.index(cand)]
-            break
-    # si no hay, tomar la primera no-SKU
-    if title_col is None:
-        for c in cols:
-            if c != sku_col:
-                title_col = c
-                break
-    if title_col is None:
-        return ""
+def _master_raw_index(path: str) -> dict:
+    """SKU normalizado -> texto crudo del maestro. Se arma una vez por versión del archivo
+    (mtime/size) y se comparte entre sesiones."""
+    ent = _master_index_entry(path)
+    if ent is None:
+        return {}
+    raw = ent.get("raw")
+    if raw is None:
+        with _MASTER_INDEX_LOCK:
+            raw = ent.get("raw")
+            if raw is None:
+                try:
+                    con = sqlite3.connect(f"file:{ent['index']}?mode=ro", uri=True)
+                    try:
+                        raw = dict(con.execute("SELECT sku, raw FROM sku_raw;").fetchall())
+                    finally:
+                        con.close()
+                except sqlite3.Error:
+                    raw = {}
+                ent["raw"] = raw
+    return raw
 
+
+def master_raw_title_lookup(path: str, sku: str) -> str:
+    """Devuelve el texto EXACTO del maestro para ese SKU (tal cual viene en la celda)."""
     target = normalize_sku(sku)
     if not target:
         return ""
+    return _master_raw_index(path).get(target) or ""
 
-    try:
-        ser = dfm[sku_col].astype(str).map(normalize_sku)
-        hits = dfm.loc[ser == target]
-    except Exception:
-        return ""
 
-    if hits.empty:
-        return ""
+def master_raw_titles_lookup(path: str, skus) -> dict:
+    """Versión batch de master_raw_title_lookup: {sku tal cual se pidió: texto crudo o ""}."""
+    raw = _master_raw_index(path)
+    out = {}
+    for sku in skus:
+        if sku not in out:
+            out[sku] = raw.get(normalize_sku(sku)) or ""
+    return out
 
-    val = hits.iloc[0][title_col]
-    if val is None:
-        return ""
-    sval = str(val)
-    if sval.lower() == "nan":
-        return ""
-    return sval
+
+def master_content_hash(path: str) -> str:
+    """sha256 del maestro (del cache de proceso; no relee el archivo)."""
+    ent = _master_index_entry(path)
+    return ent["sha"] if ent is not None else ""
 
 
-def upsert_barcodes_to_db(barcode_to_sku: dict):
+# Último hash del maestro ya sincronizado a sku_barcodes en este proceso
+_BARCODE_SYNC = {"hash": None}
+_BARCODE_SYNC_META_KEY = "sku_barcodes_master_sha256"
+
+
+def upsert_barcodes_to_db(barcode_to_sku: dict, content_hash: str = None):
+    """Sincroniza sku_barcodes con el maestro aplicando solo altas/cambios/bajas.
+    Con content_hash: no hace nada si ese maestro ya se sincronizó (se guarda en app_meta)."""
     if not barcode_to_sku:
         return
+    if content_hash and _BARCODE_SYNC["hash"] == content_hash:
+        return
     conn = get_conn()
     c = conn.cursor()
-    for bc, sku in barcode_to_sku.items():
-        c.execute("INSERT OR REPLACE INTO sku_barcodes (barcode, sku_ml) VALUES (?, ?)", (bc, sku))
-    conn.commit()
-    conn.close()
+    if content_hash:
+        row = c.execute("SELECT value FROM app_meta WHERE key=?;", (_BARCODE_SYNC_META_KEY,)).fetchone()
+        if row and row[0] == content_hash:
+            conn.close()
+            _BARCODE_SYNC["hash"] = content_hash
+            return
+
+    current = dict(c.execute("SELECT barcode, sku_ml FROM sku_barcodes;").fetchall())
+    upserts = [(bc, sku) for bc, sku in barcode_to_sku.items() if current.get(bc) != sku]
+    removed = [(bc,) for bc in current.keys() - barcode_to_sku.keys()]
+    try:
+        if upserts:
+            c.executemany("INSERT OR REPLACE INTO sku_barcodes (barcode, sku_ml) VALUES (?, ?);", upserts)
+        if removed:
+            c.executemany("DELETE FROM sku_barcodes WHERE barcode=?;", removed)
+        if content_hash:
+            c.execute("INSERT OR REPLACE INTO app_meta (key, value) VALUES (?, ?);",
+                      (_BARCODE_SYNC_META_KEY, content_hash))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    if content_hash:
+        _BARCODE_SYNC["hash"] = content_hash
+
+
+class BarcodeResolver:
+    """barcode->SKU en memoria, uno por versión del maestro y compartido por todas las sesiones/modos."""
+    __slots__ = ("version", "_map")
 
+    def __init__(self, barcode_to_sku: dict, version: str = ""):
+        self.version = version
+        self._map = barcode_to_sku
 
-def resolve_scan_to_sku(scan: str, barcode_to_sku: dict) -> str:
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, barcode):
+        return barcode in self._map
+
+    def __getitem__(self, barcode):
+        return self._map[barcode]
+
+    def get(self, barcode, default=None):
+        return self._map.get(barcode, default)
+
+    def resolve(self, scan: str) -> str:
+        """EAN escaneado (con o sin basura alrededor) -> SKU; si no es un EAN conocido, el SKU normalizado."""
+        raw = str(scan).strip()
+        digits = only_digits(raw)
+        if digits:
+            sku = self._map.get(digits)
+            if sku is not None:
+                return sku
+        return normalize_sku(raw)
+
+
+_BARCODE_RESOLVERS = {}  # master_path -> BarcodeResolver
+_BARCODE_RESOLVER_LOCK = threading.Lock()
+
+
+def get_barcode_resolver(master_path: str = MASTER_FILE) -> BarcodeResolver:
+    """Resolver compartido del proceso. Se reconstruye solo cuando cambia el hash del maestro;
+    sin maestro usa lo último sincronizado en sku_barcodes."""
+    version = master_content_hash(master_path) or "db"
+    res = _BARCODE_RESOLVERS.get(master_path)
+    if res is not None and res.version == version:
+        return res
+    with _BARCODE_RESOLVER_LOCK:
+        res = _BARCODE_RESOLVERS.get(master_path)
+        if res is not None and res.version == version:
+            return res
+        if version == "db":
+            conn = get_conn()
+            mapping = dict(conn.execute("SELECT barcode, sku_ml FROM sku_barcodes;").fetchall())
+            conn.close()
+        else:
+            mapping = load_master_from_path(master_path)[1]
+        res = BarcodeResolver(mapping, version)
+        _BARCODE_RESOLVERS[master_path] = res
+        return res
+
+
+def resolve_scan_to_sku(scan: str, barcode_to_sku) -> str:
+    if isinstance(barcode_to_sku, BarcodeResolver):
+        return barcode_to_sku.resolve(scan)
     raw = str(scan).strip()
     digits = only_digits(raw)
     if digits and digits in barcode_to_sku:
@@ -1083,11 +2076,11 @@ def extract_location_suffix(text: str) -> str:
     if not t:
         return ""
     # Common pattern in Aurora: '[UBC: 2260]' or '[ubc: 2260]'
-    m = re.search(r"(\[\s*UBC\s*:\s*[^\]]+\])\s*$", t, flags=re.IGNORECASE)
+    m = UBC_SUFFIX_RE.search(t)
     if m:
         return m.group(1).strip()
     # Sometimes without brackets: 'UBC: 2260' at end
-    m = re.search(r"(UBC\s*:\s*\d+)\s*$", t, flags=re.IGNORECASE)
+    m = UBC_SUFFIX_PLAIN_RE.search(t)
     if m:
         return f"[{m.group(1).strip()}]"
     return ""
@@ -1098,9 +2091,9 @@ def strip_location_suffix(text: str) -> str:
     if not t:
         return ""
     # remove bracketed suffix
-    t2 = re.sub(r"\s*(\[\s*UBC\s*:\s*[^\]]+\])\s*$", "", t, flags=re.IGNORECASE).strip()
+    t2 = UBC_SUFFIX_STRIP_RE.sub("", t).strip()
     # remove unbracketed suffix
-    t2 = re.sub(r"\s*(UBC\s*:\s*\d+)\s*$", "", t2, flags=re.IGNORECASE).strip()
+    t2 = UBC_SUFFIX_PLAIN_STRIP_RE.sub("", t2).strip()
     return t2
 
 
@@ -1122,14 +2115,15 @@ def with_location(title_display: str, title_tec: str) -> str:
     return base
 
 
-@st.cache_data(show_spinner=False)
 def get_master_cached(master_path: str) -> tuple[dict, dict, list]:
+    # Cache de proceso por mtime/size (ver _master_index_entry): compartido entre sesiones
+    # y sin la copia que hace st.cache_data en cada rerun.
     return load_master_from_path(master_path)
 
 
 def master_bootstrap(master_path: str):
     inv_map_sku, barcode_to_sku, conflicts = get_master_cached(master_path)
-    upsert_barcodes_to_db(barcode_to_sku)
+    upsert_barcodes_to_db(barcode_to_sku, content_hash=master_content_hash(master_path))
     return inv_map_sku, barcode_to_sku, conflicts
 
 
@@ -1195,7 +2189,11 @@ def parse_manifest_pdf(uploaded_file) -> pd.DataFrame:
     """
     if not HAS_PDF_LIB:
         raise RuntimeError("Falta pdfplumber. Agrega 'pdfplumber' a requirements.txt")
+    return _parse_manifest_texts(pdf_extract_page_texts(uploaded_file))
+
 
+def _parse_manifest_texts(page_texts: list) -> pd.DataFrame:
+    """Máquina de estados de parse_manifest_pdf sobre el texto de cada página (Venta/SKU vigentes por página)."""
     records: list[dict] = []
 
     re_venta = re.compile(r"\bVenta\s*[:#]?\s*([0-9]+)\b", re.IGNORECASE)
@@ -1227,79 +2225,78 @@ def parse_manifest_pdf(uploaded_file) -> pd.DataFrame:
                 return line[:idx].strip()
         return line.strip()
 
-    with pdfplumber.open(uploaded_file) as pdf:
-        for page in pdf.pages:
-            text = (page.extract_text() or "").replace("\r", "\n")
-            lines = [ln.strip() for ln in text.splitlines() if ln and str(ln).strip()]
+    for text in page_texts:
+        text = text.replace("\r", "\n")
+        lines = [ln.strip() for ln in text.splitlines() if ln and str(ln).strip()]
 
-            current_order: str | None = None
-            current_buyer: str = ""
+        current_order: str | None = None
+        current_buyer: str = ""
 
-            # SKU "vigente" para el próximo "Cantidad"
-            sku_current: str | None = None
+        # SKU "vigente" para el próximo "Cantidad"
+        sku_current: str | None = None
 
-            # SKU visto antes de que aparezca la Venta (caso: "Pack ID ... SKU:xxxx" y luego "Venta ... Cantidad ...")
-            pending_sku_before_order: str | None = None
+        # SKU visto antes de que aparezca la Venta (caso: "Pack ID ... SKU:xxxx" y luego "Venta ... Cantidad ...")
+        pending_sku_before_order: str | None = None
 
-            for line in lines:
-                if _is_noise_line(line):
-                    continue
+        for line in lines:
+            if _is_noise_line(line):
+                continue
 
-                # Capturar Venta (no reseteamos SKU aquí; hay PDFs donde el SKU viene en la línea anterior)
-                mv = re_venta.search(line)
-                if mv:
-                    current_order = mv.group(1).strip()
-                    current_buyer = ""
-                    # Si hay un SKU pendiente (visto antes de la venta), lo activamos
-                    if pending_sku_before_order and not sku_current:
-                        sku_current = pending_sku_before_order
-                        pending_sku_before_order = None
-
-                # Buyer: primera línea razonable después de "Venta:" que no sea metadata
-                if current_order and not current_buyer:
-                    low = line.lower()
-                    if (not _is_noise_line(line)
-                        and "venta" not in low
-                        and "sku" not in low
-                        and "cantidad" not in low
-                        and ":" not in line  # evita "Color:" etc
-                        and len(line) <= 120):
-                        cand = _maybe_buyer(line)
-                        if cand and len(cand) >= 3:
-                            current_buyer = cand
-
-                # Tokenizar SKU y Cantidad en orden de aparición en el renglón
-                tokens = []
-                for ms in re_sku.finditer(line):
-                    tokens.append((ms.start(), "SKU", normalize_sku(ms.group(1))))
-                for mq in re_qty.finditer(line):
-                    try:
-                        qv = int(mq.group(1))
-                    except Exception:
-                        qv = 0
-                    tokens.append((mq.start(), "QTY", qv))
-                tokens.sort(key=lambda x: x[0])
-
-                for _, kind, val in tokens:
-                    if kind == "SKU":
-                        if current_order:
-                            sku_current = val
-                        else:
-                            pending_sku_before_order = val
-                    elif kind == "QTY":
-                        qty = int(val) if val is not None else 0
-                        if current_order and sku_current and qty > 0:
-                            records.append(
-                                {
-                                    "ml_order_id": str(current_order).strip(),
-                                    "buyer": str(current_buyer or "").strip(),
-                                    "sku_ml": str(sku_current).strip(),
-                                    "title_ml": "",
-                                    "qty": qty,
-                                }
-                            )
-                            # Importante: NO limpiamos sku_current aquí, porque puede venir otra Cantidad asociada
-                            # al mismo SKU en el mismo bloque (raro, pero seguro).
+            # Capturar Venta (no reseteamos SKU aquí; hay PDFs donde el SKU viene en la línea anterior)
+            mv = re_venta.search(line)
+            if mv:
+                current_order = mv.group(1).strip()
+                current_buyer = ""
+                # Si hay un SKU pendiente (visto antes de la venta), lo activamos
+                if pending_sku_before_order and not sku_current:
+                    sku_current = pending_sku_before_order
+                    pending_sku_before_order = None
+
+            # Buyer: primera línea razonable después de "Venta:" que no sea metadata
+            if current_order and not current_buyer:
+                low = line.lower()
+                if (not _is_noise_line(line)
+                    and "venta" not in low
+                    and "sku" not in low
+                    and "cantidad" not in low
+                    and ":" not in line  # evita "Color:" etc
+                    and len(line) <= 120):
+                    cand = _maybe_buyer(line)
+                    if cand and len(cand) >= 3:
+                        current_buyer = cand
+
+            # Tokenizar SKU y Cantidad en orden de aparición en el renglón
+            tokens = []
+            for ms in re_sku.finditer(line):
+                tokens.append((ms.start(), "SKU", normalize_sku(ms.group(1))))
+            for mq in re_qty.finditer(line):
+                try:
+                    qv = int(mq.group(1))
+                except Exception:
+                    qv = 0
+                tokens.append((mq.start(), "QTY", qv))
+            tokens.sort(key=lambda x: x[0])
+
+            for _, kind, val in tokens:
+                if kind == "SKU":
+                    if current_order:
+                        sku_current = val
+                    else:
+                        pending_sku_before_order = val
+                elif kind == "QTY":
+                    qty = int(val) if val is not None else 0
+                    if current_order and sku_current and qty > 0:
+                        records.append(
+                            {
+                                "ml_order_id": str(current_order).strip(),
+                                "buyer": str(current_buyer or "").strip(),
+                                "sku_ml": str(sku_current).strip(),
+                                "title_ml": "",
+                                "qty": qty,
+                            }
+                        )
+                        # Importante: NO limpiamos sku_current aquí, porque puede venir otra Cantidad asociada
+                        # al mismo SKU en el mismo bloque (raro, pero seguro).
 
     return pd.DataFrame(records, columns=["ml_order_id", "buyer", "sku_ml", "title_ml", "qty"])
 
@@ -1334,85 +2331,332 @@ def import_sales_excel(file) -> pd.DataFrame:
     work = df[required].copy()
     work.columns = ["ml_order_id", "status", "qty", "sku_ml", "title_ml", "buyer"]
 
-    # Helpers
-    def _clean_str(x) -> str:
-        if pd.isna(x):
-            return ""
-        return str(x).strip()
+    def _clean_col(col: pd.Series) -> pd.Series:
+        col = col.astype(object)
+        return col.where(col.notna(), "").map(str).str.strip()
+
+    status = _clean_col(work["status"])
+    ml_id = _clean_col(work["ml_order_id"])
+    buyer = _clean_col(work["buyer"])
+    sku = _clean_col(work["sku_ml"])
+    title = _clean_col(work["title_ml"])
+    qty = pd.to_numeric(work["qty"], errors="coerce")
+
+    # Filas cabecera del paquete (no traen SKU/qty): "Paquete de X productos"
+    pkg_n = status.str.extract(r"^Paquete\s+de\s+(\d+)\s+productos?$", flags=re.IGNORECASE)[0]
+    is_header = pkg_n.notna()
+
+    # Filas sin SKU/qty (o qty <= 0) -> se ignoran
+    qty_ok = qty.notna() & np.isfinite(qty)
+    qty_int = np.trunc(qty.where(qty_ok, 0)).astype("int64")
+    valid = ~is_header & (sku != "") & qty_ok & (qty_int > 0)
+
+    # Cada cabecera abre un grupo; sus primeras X filas válidas van bajo el ID de la cabecera
+    grp = is_header.cumsum()
+    hdr = pd.DataFrame({
+        "pkg_id": ml_id[is_header].values,
+        "pkg_buyer": buyer[is_header].values,
+        "pkg_n": pkg_n[is_header].astype("int64").values,
+    }, index=grp[is_header].values)
+    rank = valid.astype("int64").groupby(grp).cumsum() - 1
+
+    v = valid[valid].index
+    g = grp[v]
+    pkg_id = hdr["pkg_id"].reindex(g.values).fillna("").values
+    pkg_buyer = hdr["pkg_buyer"].reindex(g.values).fillna("").values
+    pkg_left = hdr["pkg_n"].reindex(g.values).fillna(0).values > rank[v].values
+    in_pkg = (pkg_id != "") & pkg_left
+
+    row_buyer = buyer[v].values
+    out_id = np.where(in_pkg, pkg_id, ml_id[v].values)
+    out_buyer = np.where(in_pkg & (pkg_buyer != ""), pkg_buyer, row_buyer)
+
+    if len(v) == 0:
+        return pd.DataFrame([], columns=["ml_order_id", "buyer", "sku_ml", "title_ml", "qty"])
+
+    out = pd.DataFrame(
+        {
+            "ml_order_id": out_id.tolist(),
+            "buyer": out_buyer.tolist(),
+            "sku_ml": normalize_sku_series(sku[v]).tolist(),
+            "title_ml": title[v].tolist(),
+            "qty": qty_int[v].tolist(),
+        },
+        columns=["ml_order_id", "buyer", "sku_ml", "title_ml", "qty"],
+    )
+    return out
+# =========================
+# ASIGNACIÓN VENTAS -> OTs (balance de carga)
+# =========================
+# Esfuerzo estimado de una OT = SKUs distintos (paradas) * PICK_EFFORT_PER_SKU + unidades * PICK_EFFORT_PER_UNIT.
+# El picker recorre una vez cada SKU de su OT, así que juntar ventas que comparten SKU baja el esfuerzo.
+PICK_EFFORT_PER_SKU = 1.0
+PICK_EFFORT_PER_UNIT = 1.0
+DEFAULT_OT_STRATEGY = "LPT"
 
-    records = []
-    current_pkg_id = None
-    current_pkg_buyer = ""
-    remaining_items = 0
 
-    pkg_re = re.compile(r"^Paquete\s+de\s+(\d+)\s+productos?$", re.IGNORECASE)
+def _order_loads(sales_df: pd.DataFrame, cortes_set: set = None) -> list:
+    """[(ml_order_id, unidades, set de SKUs)] en orden de aparición. Los SKUs de corte no se pickean."""
+    cortes_set = cortes_set or set()
+    df = sales_df.reset_index(drop=True)
+    if df.empty:
+        return []
+    ml_key = df["ml_order_id"].map(lambda x: str(x).strip())
+    sku = normalize_sku_series(df["sku_ml"])
+    qty = pd.to_numeric(df["qty"], errors="coerce").fillna(0).astype("int64")
+    pick = ~sku.isin(cortes_set)
+    units = {}
+    skus = {}
+    for k, s, q, p in zip(ml_key.tolist(), sku.tolist(), qty.tolist(), pick.tolist()):
+        if k not in units:
+            units[k] = 0
+            skus[k] = set()
+        if p:
+            units[k] += q
+            skus[k].add(s)
+    return [(k, units[k], frozenset(skus[k])) for k in units]
+
+
+def _ot_effort(units: int, skus) -> float:
+    return len(skus) * PICK_EFFORT_PER_SKU + units * PICK_EFFORT_PER_UNIT
+
+
+def _assign_round_robin(orders: list, k: int) -> list:
+    return [i % k for i in range(len(orders))]
+
+
+def _assign_lpt(orders: list, k: int) -> list:
+    """Greedy LPT: ventas de mayor esfuerzo primero, cada una a la OT menos cargada."""
+    loads = [0.0] * k
+    out = [0] * len(orders)
+    order_idx = sorted(range(len(orders)), key=lambda i: -_ot_effort(orders[i][1], orders[i][2]))
+    for i in order_idx:
+        b = min(range(k), key=lambda j: (loads[j], j))
+        out[i] = b
+        loads[b] += _ot_effort(orders[i][1], orders[i][2])
+    return out
 
-    for _, r in work.iterrows():
-        status = _clean_str(r.get("status"))
-        ml_id = _clean_str(r.get("ml_order_id"))
-        buyer = _clean_str(r.get("buyer"))
-        sku = _clean_str(r.get("sku_ml"))
-        title = _clean_str(r.get("title_ml"))
-        qty = pd.to_numeric(r.get("qty"), errors="coerce")
 
-        # Detecta fila cabecera del paquete (no trae SKU/qty)
-        m = pkg_re.match(status)
-        if m:
-            try:
-                remaining_items = int(m.group(1))
-            except Exception:
-                remaining_items = 0
-            current_pkg_id = ml_id if ml_id else None
-            current_pkg_buyer = buyer
-            continue
+def _assign_sku_affinity(orders: list, k: int) -> list:
+    """LPT con afinidad: cada venta va a la OT que queda con menor esfuerzo total contando solo
+    los SKUs que esa OT todavía no tiene (empate: menor costo marginal)."""
+    ot_units = [0] * k
+    ot_skus = [set() for _ in range(k)]
+    out = [0] * len(orders)
+    order_idx = sorted(range(len(orders)), key=lambda i: -_ot_effort(orders[i][1], orders[i][2]))
+    for i in order_idx:
+        _, units, skus = orders[i]
+        best = None
+        for j in range(k):
+            new_skus = len(skus - ot_skus[j])
+            marginal = new_skus * PICK_EFFORT_PER_SKU + units * PICK_EFFORT_PER_UNIT
+            total = _ot_effort(ot_units[j], ot_skus[j]) + marginal
+            key = (total, marginal, j)
+            if best is None or key < best:
+                best = key
+        j = best[2]
+        out[i] = j
+        ot_units[j] += units
+        ot_skus[j].update(skus)
+    return out
 
-        # Filas sin SKU/qty -> se ignoran
-        if not sku or pd.isna(qty):
-            continue
 
-        qty_int = int(qty) if not pd.isna(qty) else 0
-        if qty_int <= 0:
-            continue
+# nombre -> (etiqueta, función(orders, k) -> índice de OT por venta)
+OT_ASSIGN_STRATEGIES = {
+    "ROUND_ROBIN": ("Round-robin (actual)", _assign_round_robin),
+    "LPT": ("Balanceo LPT (esfuerzo)", _assign_lpt),
+    "SKU_AFFINITY": ("Afinidad de SKU + balanceo", _assign_sku_affinity),
+}
+
+
+def _assignment_efforts(orders: list, assign: list, k: int) -> list:
+    units = [0] * k
+    skus = [set() for _ in range(k)]
+    for (_, u, s), j in zip(orders, assign):
+        units[j] += u
+        skus[j].update(s)
+    return [_ot_effort(units[j], skus[j]) for j in range(k)]
+
+
+def plan_ot_assignment(sales_df: pd.DataFrame, num_pickers: int, strategy: str = DEFAULT_OT_STRATEGY,
+                       cortes_set: set = None) -> dict:
+    """ml_order_id -> índice de OT (0..num_pickers-1) según la estrategia."""
+    k = max(1, int(num_pickers))
+    orders = _order_loads(sales_df, cortes_set)
+    _, fn = OT_ASSIGN_STRATEGIES.get(strategy, OT_ASSIGN_STRATEGIES[DEFAULT_OT_STRATEGY])
+    return {o[0]: j for o, j in zip(orders, fn(orders, k))}
+
+
+def compare_ot_strategies(sales_df: pd.DataFrame, num_pickers: int, cortes_set: set = None) -> list:
+    """Makespan previsto (esfuerzo de la OT más cargada) por estrategia, para elegir antes de guardar."""
+    k = max(1, int(num_pickers))
+    orders = _order_loads(sales_df, cortes_set)
+    out = []
+    for name, (label, fn) in OT_ASSIGN_STRATEGIES.items():
+        efforts = _assignment_efforts(orders, fn(orders, k), k)
+        out.append({
+            "strategy": name,
+            "label": label,
+            "makespan": max(efforts) if efforts else 0.0,
+            "min": min(efforts) if efforts else 0.0,
+            "total": sum(efforts),
+        })
+    return out
+
+
+def plan_mesa_assignment(sales_df: pd.DataFrame, num_mesas: int = NUM_MESAS) -> dict:
+    """ml_order_id -> mesa (1..num_mesas), balanceando unidades con LPT."""
+    k = max(1, int(num_mesas))
+    orders = [(ml, units, frozenset()) for ml, units, _ in _order_loads(sales_df)]
+    return {o[0]: j + 1 for o, j in zip(orders, _assign_lpt(orders, k))}
+
+
+# =========================
+# RUTA DE PICKING (UBC -> pasillo/módulo/nivel)
+# =========================
+# Ubicación UBC típica: "2246", "8472-P", "3830-2". Los primeros UBC_AISLE_DIGITS dígitos son el
+# pasillo, el resto el módulo (posición dentro del pasillo); un sufijo numérico "-N" es el nivel.
+# Códigos sin número (p.ej. "SIN CODIGO CCC") quedan sin ubicación y van al final de la ruta.
+UBC_AISLE_DIGITS = 2
+AISLE_PITCH_M = 3.0   # distancia entre pasillos
+BAY_WIDTH_M = 1.0     # ancho de un módulo
+ROUTE_METHODS = ("SERPENTINE", "NEAREST")
+DEFAULT_ROUTE_METHOD = "SERPENTINE"
+
+UBC_LOC_RE = re.compile(r"^\D*?(\d{3,})(?:\s*[-.]\s*(\d+))?")
+
+
+def parse_ubc_location(ubc: str):
+    """'2246' -> (22, 46, 0); '3830-2' -> (38, 30, 2); sin número -> None."""
+    m = UBC_LOC_RE.match(str(ubc or "").strip())
+    if not m:
+        return None
+    digits = m.group(1)
+    aisle = int(digits[:UBC_AISLE_DIGITS])
+    bay = int(digits[UBC_AISLE_DIGITS:] or 0)
+    level = int(m.group(2)) if m.group(2) else 0
+    return (aisle, bay, level)
+
+
+def task_location(title_tec: str, title_ml: str = ""):
+    """Ubicación de una tarea a partir del [UBC: ...] del título técnico (o del de ML)."""
+    for t in (title_tec, title_ml):
+        _, ubc = split_title_ubc(t)
+        if ubc:
+            loc = parse_ubc_location(ubc)
+            if loc is not None:
+                return loc
+    return None
+
+
+def _walk_distance(a, b, bay_max: int) -> float:
+    """Distancia caminando entre dos ubicaciones (pasillos paralelos, cruce por adelante o por atrás)."""
+    (a_aisle, a_bay), (b_aisle, b_bay) = a[:2], b[:2]
+    if a_aisle == b_aisle:
+        return abs(a_bay - b_bay) * BAY_WIDTH_M
+    along = min(a_bay + b_bay, 2 * bay_max - a_bay - b_bay) * BAY_WIDTH_M
+    return along + abs(a_aisle - b_aisle) * AISLE_PITCH_M
+
+
+def route_distance(locs: list) -> float:
+    """Recorrido estimado desde el inicio (pasillo 0, módulo 0) por las ubicaciones y de vuelta."""
+    if not locs:
+        return 0.0
+    bay_max = max(l[1] for l in locs)
+    depot = (0, 0, 0)
+    pts = [depot] + list(locs) + [depot]
+    return sum(_walk_distance(pts[i], pts[i + 1], bay_max) for i in range(len(pts) - 1))
+
+
+def _route_serpentine(locs: list) -> list:
+    """Pasillos en orden; dentro de cada pasillo se alterna el sentido (ida/vuelta)."""
+    aisles = sorted({l[0] for l in locs})
+    flip = {a: (i % 2 == 1) for i, a in enumerate(aisles)}
+    return sorted(range(len(locs)), key=lambda i: (
+        locs[i][0],
+        -locs[i][1] if flip[locs[i][0]] else locs[i][1],
+        locs[i][2],
+    ))
+
+
+def _route_nearest(locs: list) -> list:
+    """Vecino más cercano desde el inicio."""
+    if not locs:
+        return []
+    bay_max = max(l[1] for l in locs)
+    left = set(range(len(locs)))
+    cur = (0, 0, 0)
+    out = []
+    while left:
+        i = min(left, key=lambda j: (_walk_distance(cur, locs[j], bay_max), locs[j], j))
+        out.append(i)
+        left.remove(i)
+        cur = locs[i]
+    return out
+
+
+def sequence_route(tasks: list, method: str = DEFAULT_ROUTE_METHOD):
+    """tasks: [(task_id, sku, title_ml, title_tec)]. Devuelve ([(task_id, route_rank)], distancia).
+    Tareas sin ubicación van al final por SKU."""
+    located, unlocated = [], []
+    for task_id, sku, title_ml, title_tec in tasks:
+        loc = task_location(title_tec, title_ml)
+        if loc is None:
+            unlocated.append((task_id, sku))
+        else:
+            located.append((task_id, loc))
+    locs = [l for _, l in located]
+    order = _route_nearest(locs) if method == "NEAREST" else _route_serpentine(locs)
+    seq = [located[i][0] for i in order]
+    seq += [tid for tid, sku in sorted(unlocated, key=lambda x: (_sku_sort_key(x[1]), x[0]))]
+    return [(tid, rank) for rank, tid in enumerate(seq, start=1)], route_distance([locs[i] for i in order])
+
+
+def _sku_sort_key(sku):
+    s = str(sku or "")
+    return (0, int(s), s) if s.isdigit() else (1, 0, s)
+
 
-        sku_norm = normalize_sku(sku)
-
-        # Si estamos dentro de un paquete, agrupamos bajo el ID del paquete
-        if current_pkg_id and remaining_items > 0:
-            records.append(
-                {
-                    "ml_order_id": current_pkg_id,
-                    "buyer": current_pkg_buyer or buyer,
-                    "sku_ml": sku_norm,
-                    "title_ml": title,
-                    "qty": qty_int,
-                }
-            )
-            remaining_items -= 1
-            if remaining_items <= 0:
-                current_pkg_id = None
-                current_pkg_buyer = ""
-            continue
+def build_pick_routes(c, ot_ids: list, method: str = DEFAULT_ROUTE_METHOD):
+    """Calcula route_rank de las tareas y route_distance de cada OT (dentro de la transacción del llamador)."""
+    for ot_id in ot_ids:
+        tasks = c.execute(
+            "SELECT id, sku_ml, title_ml, title_tec FROM picking_tasks WHERE ot_id=?;", (ot_id,)
+        ).fetchall()
+        ranks, dist = sequence_route(tasks, method=method)
+        c.executemany("UPDATE picking_tasks SET route_rank=? WHERE id=?;", [(r, tid) for tid, r in ranks])
+        c.execute("UPDATE picking_ots SET route_distance=? WHERE id=?;", (round(dist, 1), ot_id))
 
-        # Venta normal (1 producto)
-        records.append(
-            {
-                "ml_order_id": ml_id,
-                "buyer": buyer,
-                "sku_ml": sku_norm,
-                "title_ml": title,
-                "qty": qty_int,
-            }
-        )
 
-    out = pd.DataFrame(records, columns=["ml_order_id", "buyer", "sku_ml", "title_ml", "qty"])
-    return out
-def save_orders_and_build_ots(sales_df: pd.DataFrame, inv_map_sku: dict, num_pickers: int):
+def save_orders_and_build_ots(sales_df: pd.DataFrame, inv_map_sku: dict, num_pickers: int,
+                              strategy: str = DEFAULT_OT_STRATEGY, route_method: str = DEFAULT_ROUTE_METHOD):
+    """Guarda ventas y arma OTs/tareas en bloque (tablas temporales + INSERT ... SELECT),
+    todo en una sola transacción."""
     conn = get_conn()
     c = conn.cursor()
 
-
     # SKUs que se van a CORTES (no aparecen en picking)
     cortes_set = load_cortes_set()
+    created = now_iso()
+
+    # --- Staging en memoria (pandas) ---
+    df = sales_df.reset_index(drop=True)
+    n = len(df)
+    grp_no = df.groupby("ml_order_id", sort=True).ngroup()
+    ml_key = df["ml_order_id"].map(lambda x: str(x).strip())
+    sku = normalize_sku_series(df["sku_ml"]) if n else pd.Series([], dtype=object)
+    if "title_ml" in df.columns:
+        title_ml = df["title_ml"].map(lambda x: str(x or "").strip())
+    else:
+        title_ml = pd.Series([""] * n, dtype=object)
+    title_tec = sku.map(lambda k: inv_map_sku.get(k, ""))
+    title_eff = title_tec.where(title_tec != "", title_ml)
+    buyer = df["buyer"].map(str) if "buyer" in df.columns else pd.Series([""] * n, dtype=object)
+
+    # Primera fila de cada venta (en orden de aparición): buyer y reparto a OTs/mesas
+    first = ~df["ml_order_id"].duplicated()
+    first_rows = pd.DataFrame({"grp": grp_no[first], "ml": ml_key[first], "buyer": buyer[first]})
+    first_rows = first_rows[first_rows["grp"] >= 0]
 
     # Reset corrida (no borra histórico; eso lo hace admin reset total)
     c.execute("DELETE FROM picking_tasks;")
@@ -1423,92 +2667,114 @@ def save_orders_and_build_ots(sales_df: pd.DataFrame, inv_map_sku: dict, num_pic
     c.execute("DELETE FROM picking_ots;")
     c.execute("DELETE FROM pickers;")
 
-    order_id_by_ml = {}
-    for ml_order_id, g in sales_df.groupby("ml_order_id"):
-        ml_order_id = str(ml_order_id).strip()
-        buyer = str(g["buyer"].iloc[0]) if "buyer" in g.columns else ""
-        created = now_iso()
-
-        c.execute("SELECT id FROM orders WHERE ml_order_id = ?", (ml_order_id,))
-        row = c.fetchone()
-        if row:
-            order_id = row[0]
-            c.execute("UPDATE orders SET buyer=?, created_at=? WHERE id=?", (buyer, created, order_id))
-            c.execute("DELETE FROM order_items WHERE order_id=?", (order_id,))
-        else:
-            c.execute("INSERT INTO orders (ml_order_id, buyer, created_at) VALUES (?,?,?)", (ml_order_id, buyer, created))
-            order_id = c.lastrowid
-
-        order_id_by_ml[ml_order_id] = order_id
+    # Tablas temporales (la conexión vuelve al pool: se limpian al entrar y al salir)
+    c.execute("DROP TABLE IF EXISTS temp.imp_orders;")
+    c.execute("DROP TABLE IF EXISTS temp.imp_items;")
+    c.execute("DROP TABLE IF EXISTS temp.imp_cortes;")
+    c.execute("CREATE TEMP TABLE imp_orders (seq INTEGER PRIMARY KEY, ml_order_id TEXT, buyer TEXT);")
+    c.execute("""CREATE TEMP TABLE imp_items (
+        seq INTEGER PRIMARY KEY, grp INTEGER, ml_order_id TEXT,
+        sku_ml TEXT, title_ml TEXT, title_tec TEXT, qty INTEGER
+    );""")
+    c.execute("CREATE TEMP TABLE imp_cortes (sku TEXT PRIMARY KEY);")
 
-        for _, r in g.iterrows():
-            sku = normalize_sku(r["sku_ml"])
-            qty = int(r["qty"])
-            title_ml = str(r.get("title_ml", "") or "").strip()
-            title_tec = inv_map_sku.get(sku, "")
-            title_eff = title_tec if title_tec else title_ml
+    c.executemany(
+        "INSERT INTO imp_orders (seq, ml_order_id, buyer) VALUES (?,?,?);",
+        first_rows.sort_values("grp")[["grp", "ml", "buyer"]].itertuples(index=False, name=None),
+    )
+    keep = grp_no >= 0
+    c.executemany(
+        "INSERT INTO imp_items (seq, grp, ml_order_id, sku_ml, title_ml, title_tec, qty) VALUES (?,?,?,?,?,?,?);",
+        zip(
+            df.index[keep].tolist(), grp_no[keep].tolist(), ml_key[keep].tolist(), sku[keep].tolist(),
+            title_eff[keep].tolist(), title_tec[keep].tolist(), [int(q) for q in df.loc[keep, "qty"]],
+        ),
+    )
+    c.executemany("INSERT OR IGNORE INTO imp_cortes (sku) VALUES (?);", ((str(k),) for k in cortes_set))
 
-            c.execute(
-                "INSERT INTO order_items (order_id, sku_ml, title_ml, title_tec, qty) VALUES (?,?,?,?,?)",
-                (order_id, sku, title_eff, title_tec, qty)
-            )
+    # --- Ventas: las que ya existían pierden sus líneas; UPSERT de cabeceras ---
+    c.execute("""
+        DELETE FROM order_items
+        WHERE order_id IN (SELECT o.id FROM orders o JOIN imp_orders t ON t.ml_order_id = o.ml_order_id);
+    """)
+    c.execute("""
+        INSERT INTO orders (ml_order_id, buyer, created_at)
+        SELECT ml_order_id, buyer, ? FROM imp_orders WHERE 1 ORDER BY seq
+        ON CONFLICT(ml_order_id) DO UPDATE SET buyer=excluded.buyer, created_at=excluded.created_at;
+    """, (created,))
+    c.execute("""
+        INSERT INTO order_items (order_id, sku_ml, title_ml, title_tec, qty)
+        SELECT o.id, i.sku_ml, i.title_ml, i.title_tec, i.qty
+        FROM imp_items i
+        JOIN orders o ON o.ml_order_id = i.ml_order_id
+        ORDER BY i.grp, i.seq;
+    """)
+    order_id_by_ml = dict(c.execute("""
+        SELECT t.ml_order_id, o.id FROM imp_orders t JOIN orders o ON o.ml_order_id = t.ml_order_id;
+    """).fetchall())
 
+    # --- Pickers / OTs ---
     picker_ids = []
     for i in range(int(num_pickers)):
-        name = f"P{i+1}"
-        c.execute("INSERT INTO pickers (name) VALUES (?)", (name,))
+        c.execute("INSERT INTO pickers (name) VALUES (?)", (f"P{i+1}",))
         picker_ids.append(c.lastrowid)
 
     ot_ids = []
     for pid in picker_ids:
         c.execute(
             "INSERT INTO picking_ots (ot_code, picker_id, status, created_at, closed_at) VALUES (?,?,?,?,?)",
-            ("", pid, "OPEN", now_iso(), None)
+            ("", pid, "OPEN", created, None)
         )
         ot_id = c.lastrowid
-        ot_code = f"OT{ot_id:06d}"
-        c.execute("UPDATE picking_ots SET ot_code=? WHERE id=?", (ot_code, ot_id))
+        c.execute("UPDATE picking_ots SET ot_code=? WHERE id=?", (f"OT{ot_id:06d}", ot_id))
         ot_ids.append(ot_id)
 
-    unique_orders = sales_df[["ml_order_id"]].drop_duplicates().reset_index(drop=True)
-    assignments = {}
-    for idx, row in unique_orders.iterrows():
-        ot_id = ot_ids[idx % len(ot_ids)]
-        assignments[str(row["ml_order_id"]).strip()] = ot_id
+    # Reparto a OTs según estrategia (balance de esfuerzo) y a mesas por unidades
+    ot_plan = plan_ot_assignment(df, len(ot_ids), strategy=strategy, cortes_set=cortes_set)
+    mesa_plan = plan_mesa_assignment(df, NUM_MESAS)
 
-    for idx, (ml_order_id, ot_id) in enumerate(assignments.items()):
+    ot_rows = []
+    status_rows = []
+    for ml_order_id, ot_idx in ot_plan.items():
+        ot_id = ot_ids[ot_idx]
         order_id = order_id_by_ml[ml_order_id]
-        mesa = (idx % NUM_MESAS) + 1
-        c.execute("INSERT INTO ot_orders (ot_id, order_id) VALUES (?,?)", (ot_id, order_id))
-        c.execute("""
-            INSERT INTO sorting_status (ot_id, order_id, status, marked_at, mesa, printed_at)
-            VALUES (?,?,?,?,?,?)
-        """, (ot_id, order_id, "PENDING", None, mesa, None))
+        mesa = mesa_plan.get(ml_order_id, 1)
+        ot_rows.append((ot_id, order_id))
+        status_rows.append((ot_id, order_id, "PENDING", None, mesa, None))
+    c.executemany("INSERT INTO ot_orders (ot_id, order_id) VALUES (?,?)", ot_rows)
+    c.executemany("""
+        INSERT INTO sorting_status (ot_id, order_id, status, marked_at, mesa, printed_at)
+        VALUES (?,?,?,?,?,?)
+    """, status_rows)
+
+    # --- Tareas de todas las OTs en un solo GROUP BY (cortes aparte) ---
+    task_select = """
+        SELECT oo.ot_id, oi.sku_ml,
+               COALESCE(NULLIF(oi.title_tec,''), oi.title_ml) AS title,
+               MAX(COALESCE(oi.title_tec,'')) AS title_tec_any,
+               SUM(oi.qty) as total
+        FROM ot_orders oo
+        JOIN order_items oi ON oi.order_id = oo.order_id
+        WHERE oi.sku_ml {op} (SELECT sku FROM imp_cortes)
+        GROUP BY oo.ot_id, oi.sku_ml, title
+    """
+    task_order = "ORDER BY ot_id, CAST(sku_ml AS INTEGER), sku_ml, title"
+    c.execute(f"""
+        INSERT INTO picking_tasks (ot_id, sku_ml, title_ml, title_tec, qty_total, qty_picked, status, decided_at, confirm_mode)
+        SELECT ot_id, sku_ml, title, title_tec_any, total, 0, 'PENDING', NULL, NULL
+        FROM ({task_select.format(op="NOT IN")}) {task_order};
+    """)
+    c.execute(f"""
+        INSERT INTO cortes_tasks (ot_id, sku_ml, title_ml, title_tec, qty_total, created_at)
+        SELECT ot_id, sku_ml, title, title_tec_any, total, ?
+        FROM ({task_select.format(op="IN")}) {task_order};
+    """, (created,))
 
-    for ot_id in ot_ids:
-        c.execute("""
-            SELECT oi.sku_ml,
-                   COALESCE(NULLIF(oi.title_tec,''), oi.title_ml) AS title,
-                   MAX(COALESCE(oi.title_tec,'')) AS title_tec_any,
-                   SUM(oi.qty) as total
-            FROM ot_orders oo
-            JOIN order_items oi ON oi.order_id = oo.order_id
-            WHERE oo.ot_id = ?
-            GROUP BY oi.sku_ml, title
-            ORDER BY CAST(oi.sku_ml AS INTEGER), oi.sku_ml
-        """, (ot_id,))
-        rows = c.fetchall()
-        for sku, title, title_tec_any, total in rows:
-            if sku in cortes_set:
-                c.execute(
-                    "INSERT INTO cortes_tasks (ot_id, sku_ml, title_ml, title_tec, qty_total, created_at) VALUES (?,?,?,?,?,?)",
-                    (ot_id, sku, title, title_tec_any, int(total), now_iso())
-                )
-            else:
-                c.execute("""
-                INSERT INTO picking_tasks (ot_id, sku_ml, title_ml, title_tec, qty_total, qty_picked, status, decided_at, confirm_mode)
-                VALUES (?,?,?,?,?,?,?,?,?)
-                """, (ot_id, sku, title, title_tec_any, int(total), 0, "PENDING", None, None))
+    build_pick_routes(c, ot_ids, method=route_method)
+
+    c.execute("DROP TABLE IF EXISTS temp.imp_orders;")
+    c.execute("DROP TABLE IF EXISTS temp.imp_items;")
+    c.execute("DROP TABLE IF EXISTS temp.imp_cortes;")
     conn.commit()
     conn.close()
 
@@ -1609,8 +2875,27 @@ def page_import(inv_map_sku: dict):
     st.subheader("Vista previa")
     st.dataframe(sales_df.head(30))
 
+    # Reparto entre pickers: makespan previsto por estrategia (esfuerzo = SKUs distintos + unidades)
+    st.subheader("Reparto entre pickeadores")
+    cmp_rows = compare_ot_strategies(sales_df, int(num_pickers), cortes_set=load_cortes_set())
+    best = min(cmp_rows, key=lambda r: (r["makespan"], r["strategy"] != DEFAULT_OT_STRATEGY))
+    st.dataframe(pd.DataFrame([{
+        "Estrategia": r["label"],
+        "OT más cargada": round(r["makespan"], 1),
+        "OT menos cargada": round(r["min"], 1),
+        "Esfuerzo total": round(r["total"], 1),
+    } for r in cmp_rows]), hide_index=True, use_container_width=True)
+    names = [r["strategy"] for r in cmp_rows]
+    strategy = st.radio(
+        "Estrategia de reparto",
+        names,
+        index=names.index(best["strategy"]),
+        format_func=lambda n: OT_ASSIGN_STRATEGIES[n][0],
+        horizontal=True,
+    )
+
     if st.button("Cargar y generar OTs"):
-        save_orders_and_build_ots(sales_df, inv_map_sku, int(num_pickers))
+        save_orders_and_build_ots(sales_df, inv_map_sku, int(num_pickers), strategy=strategy)
         st.success("OTs creadas. Anda a Picking y selecciona P1, P2, ...")
 
 
@@ -1782,6 +3067,75 @@ def picking_lobby():
     return "selected_picker" in st.session_state
 
 
+PICK_TASK_COLS = "id, sku_ml, title_ml, title_tec, qty_total, qty_picked, status, defer_rank, route_rank, CAST(sku_ml AS INTEGER)"
+
+
+def _pick_task_sort_key(row):
+    # mismo orden que: COALESCE(defer_rank,0), COALESCE(route_rank,999999), CAST(sku_ml AS INTEGER), sku_ml
+    return (row[7] or 0, 999999 if row[8] is None else row[8], row[9] or 0, row[1] or "", row[0])
+
+
+def _pick_task_view(c, ot_id: int) -> dict:
+    """Tareas de la OT cacheadas en la sesión. Cada rerun hace UNA consulta por índice
+    (COUNT, MAX(task_version)); si algo cambió relee solo las filas con task_version mayor.
+    Altas/bajas (cambia COUNT o aparece un id desconocido) -> recarga completa.
+    -> {"tasks": [(id, sku, title_ml, title_tec, qty_total, qty_picked, status)] en orden,
+        "pending": deque de ids PENDING en orden, "done": n, "raw_titles": {sku: título maestro}}"""
+    n, version = c.execute(
+        "SELECT COUNT(*), COALESCE(MAX(task_version), 0) FROM picking_tasks WHERE ot_id=?;", (ot_id,)
+    ).fetchone()
+    master = master_content_hash(MASTER_FILE)
+    view = st.session_state.get("pick_task_view")
+    if view is not None and (view["ot_id"] != ot_id or view["count"] != n or view["master"] != master):
+        view = None
+    if view is not None and view["version"] == version:
+        return view
+
+    if view is not None:
+        delta = c.execute(
+            f"SELECT {PICK_TASK_COLS} FROM picking_tasks WHERE ot_id=? AND task_version>?;", (ot_id, view["version"])
+        ).fetchall()
+        rows = view["rows"]
+        if all(r[0] in rows for r in delta):
+            # solo se reordena / relee el maestro si cambió la clave de orden o el SKU
+            resort = any(_pick_task_sort_key(r) != _pick_task_sort_key(rows[r[0]]) for r in delta)
+            new_sku = any(r[1] != rows[r[0]][1] for r in delta)
+            closed = [r[0] for r in delta if rows[r[0]][6] == "PENDING" and r[6] != "PENDING"]
+            reopened = any(rows[r[0]][6] != "PENDING" and r[6] == "PENDING" for r in delta)
+            view["done"] += sum((r[6] in ("DONE", "INCIDENCE")) - (rows[r[0]][6] in ("DONE", "INCIDENCE")) for r in delta)
+            for r in delta:
+                rows[r[0]] = r
+            if resort or reopened:
+                ordered = sorted(rows.values(), key=_pick_task_sort_key)
+                view["pending"] = deque(r[0] for r in ordered if r[6] == "PENDING")
+            else:
+                # caso normal (se resolvió la tarea actual): sale del frente de la cola
+                ordered = [rows[t[0]] for t in view["tasks"]]
+                pending = view["pending"]
+                for tid in closed:
+                    if pending and pending[0] == tid:
+                        pending.popleft()
+                    else:
+                        pending.remove(tid)
+            if new_sku:
+                view["raw_titles"] = master_raw_titles_lookup(MASTER_FILE, [r[1] for r in ordered])
+        else:
+            view = None
+    if view is None:
+        rows = c.execute(f"SELECT {PICK_TASK_COLS} FROM picking_tasks WHERE ot_id=?;", (ot_id,)).fetchall()
+        view = {"ot_id": ot_id, "master": master, "rows": {r[0]: r for r in rows}}
+        ordered = sorted(rows, key=_pick_task_sort_key)
+        view["raw_titles"] = master_raw_titles_lookup(MASTER_FILE, [r[1] for r in ordered])
+        view["pending"] = deque(r[0] for r in ordered if r[6] == "PENDING")
+        view["done"] = sum(1 for r in ordered if r[6] in ("DONE", "INCIDENCE"))
+
+    view["tasks"] = [r[:7] for r in ordered]
+    view["count"] = n
+    view["version"] = version
+    st.session_state["pick_task_view"] = view
+    return view
+
+
 def page_picking():
     if "selected_picker" not in st.session_state:
         ok = picking_lobby()
@@ -1799,6 +3153,8 @@ def page_picking():
     with topB:
         if st.button("Cambiar pickeador"):
             st.session_state.pop("selected_picker", None)
+            st.session_state.pop("pick_ot_row", None)
+            st.session_state.pop("pick_task_view", None)
             st.rerun()
 
     st.markdown(
@@ -1822,29 +3178,43 @@ def page_picking():
     conn = get_conn()
     c = conn.cursor()
 
-    c.execute("SELECT barcode, sku_ml FROM sku_barcodes")
-    barcode_to_sku = {r[0]: r[1] for r in c.fetchall()}
-
-    c.execute("""
-        SELECT po.id, po.ot_code, po.status
-        FROM picking_ots po
-        JOIN pickers pk ON pk.id = po.picker_id
-        WHERE pk.name = ?
-        ORDER BY po.ot_code
-    """, (picker_name,))
-    ots = c.fetchall()
-    if not ots:
-        st.error(f"No existe OT para {picker_name}. Importa ventas y genera OTs.")
-        conn.close()
-        return
+    barcode_to_sku = get_barcode_resolver(MASTER_FILE)
 
+    # OT abierta del pickeador recordada en la sesión; en cada rerun se revalida por PK (sigue
+    # existiendo, abierta y del mismo pickeador). Si no, se vuelve a buscar con el join.
     ot_row = None
-    for r in ots:
-        if r[2] != "PICKED":
-            ot_row = r
-            break
+    cached_ot = st.session_state.get("pick_ot_row")
+    if cached_ot and cached_ot[0] == picker_name:
+        _name, cached_id, cached_picker = cached_ot
+        r = c.execute("SELECT ot_code, status, picker_id FROM picking_ots WHERE id=?;", (cached_id,)).fetchone()
+        if r and r[1] != "PICKED" and r[2] == cached_picker:
+            ot_row = (cached_id, r[0], r[1])
     if ot_row is None:
-        ot_row = ots[0]
+        st.session_state.pop("pick_ot_row", None)
+        c.execute("""
+            SELECT po.id, po.ot_code, po.status, po.picker_id
+            FROM picking_ots po
+            JOIN pickers pk ON pk.id = po.picker_id
+            WHERE pk.name = ?
+            ORDER BY po.ot_code
+        """, (picker_name,))
+        ots = c.fetchall()
+        if not ots:
+            st.error(f"No existe OT para {picker_name}. Importa ventas y genera OTs.")
+            conn.close()
+            return
+
+        found = None
+        for r in ots:
+            if r[2] != "PICKED":
+                found = r
+                break
+        if found is None:
+            found = ots[0]
+
+        ot_row = found[:3]
+        if found[2] != "PICKED":
+            st.session_state["pick_ot_row"] = (picker_name, found[0], found[3])
 
     ot_id, ot_code, ot_status = ot_row
 
@@ -1853,25 +3223,21 @@ def page_picking():
         conn.close()
         return
 
-    c.execute("""
-        SELECT id, sku_ml, title_ml, title_tec,
-               qty_total, qty_picked, status
-        FROM picking_tasks
-        WHERE ot_id=?
-        ORDER BY COALESCE(defer_rank,0) ASC, CAST(sku_ml AS INTEGER), sku_ml
-    """, (ot_id,))
-    tasks = c.fetchall()
+    view = _pick_task_view(c, ot_id)
+    tasks = view["tasks"]
 
     total_tasks = len(tasks)
-    done_small = sum(1 for t in tasks if t[6] in ("DONE", "INCIDENCE"))
+    done_small = view["done"]
     st.caption(f"Resueltos: {done_small}/{total_tasks}")
 
-    current = next((t for t in tasks if t[6] == "PENDING"), None)
+    current = view["rows"][view["pending"][0]][:7] if view["pending"] else None
     if current is None:
         st.success("No quedan SKUs pendientes.")
         if st.button("Cerrar OT"):
             c.execute("UPDATE picking_ots SET status='PICKED', closed_at=? WHERE id=?", (now_iso(), ot_id))
             conn.commit()
+            st.session_state.pop("pick_ot_row", None)
+            st.session_state.pop("pick_task_view", None)
             st.success("OT cerrada.")
         conn.close()
         return
@@ -1879,7 +3245,8 @@ def page_picking():
     task_id, sku_expected, title_ml, title_tec, qty_total, qty_picked, status = current
 
     # Título: prioridad absoluta al texto crudo del maestro (tal cual). Si no existe, cae a title_tec/title_ml.
-    raw_master = master_raw_title_lookup(MASTER_FILE, sku_expected)
+    raw_titles = view["raw_titles"]
+    raw_master = raw_titles.get(sku_expected, "")
     producto_show = raw_master if raw_master else (title_tec if title_tec not in (None, "") else (title_ml or ""))
     if "pick_state" not in st.session_state:
         st.session_state.pick_state = {}
@@ -2151,7 +3518,7 @@ def page_picking():
         for t in ordered:
             _tid, _sku, _title_ml, _title_tec, _qty_total, _qty_picked, _status = t
 
-            raw_master_t = master_raw_title_lookup(MASTER_FILE, _sku)
+            raw_master_t = raw_titles.get(_sku, "")
             _title_show = raw_master_t if raw_master_t else (
                 _title_tec if _title_tec not in (None, "") else (_title_ml or "")
             )
@@ -2223,78 +3590,129 @@ def _cell_to_str(x) -> str:
     return _safe_str(x)
 
 
-def read_full_excel(file) -> pd.DataFrame:
-    """
-    Lee todas las hojas y devuelve un DF normalizado:
-    sku_ml, title, qty_required, area, nro, etiquetar, es_pack, instruccion, vence, sheet
-    """
-    xls = pd.ExcelFile(file)
-    all_rows = []
-    for sh in xls.sheet_names:
-        df = pd.read_excel(xls, sheet_name=sh, dtype=str)
-        if df is None or df.empty:
-            continue
+# Columnas de salida de read_full_excel (en este orden).
+FULL_EXCEL_COLUMNS = ["sheet", "sku_ml", "title", "qty_required", "area", "nro",
+                      "etiquetar", "es_pack", "instruccion", "vence"]
+FULL_EXCEL_WORKERS = PDF_PARSE_WORKERS  # 0/1 = serial
+FULL_EXCEL_PARALLEL_MIN_BYTES = 1 << 20  # libros chicos: levantar procesos cuesta más que leerlos
 
-        cols_orig = df.columns.tolist()
-        cols_lower = [str(c).strip().lower() for c in cols_orig]
-
-        sku_col = _pick_col(cols_lower, cols_orig, ["sku", "sku_ml", "codigo", "código", "cod", "ubc", "cod sku"])
-        qty_col = _pick_col(cols_lower, cols_orig, ["cantidad", "qty", "unidades", "cant", "cant.", "cantidad total"])
-        title_col = _pick_col(cols_lower, cols_orig, ["articulo", "artículo", "descripcion", "descripción", "producto", "detalle", "artículo / producto"])
-
-        area_col = _pick_col(cols_lower, cols_orig, ["area", "área", "zona", "ubicacion", "ubicación"])
-        nro_col = _pick_col(cols_lower, cols_orig, ["nro", "n°", "numero", "número", "num", "#", "n"])
-
-        etiquetar_col = _pick_col(cols_lower, cols_orig, ["etiquetar", "etiqueta"])
-        pack_col = _pick_col(cols_lower, cols_orig, ["es pack", "pack", "es_pack", "espack"])
-        instr_col = _pick_col(cols_lower, cols_orig, ["instruccion", "instrucción", "obs", "observacion", "observación", "nota", "notas"])
-        vence_col = _pick_col(cols_lower, cols_orig, ["vence", "vencimiento", "fecha vence", "fecha_vencimiento"])
-
-        # Fallback mínimo: si no hay columnas clave, intentar por posición
-        if sku_col is None or qty_col is None:
-            if df.shape[1] >= 3:
-                # intento: col0 area, col1 nro, col2 sku, col3 desc, col4 qty
-                sku_col = sku_col or cols_orig[min(2, len(cols_orig) - 1)]
-                qty_col = qty_col or cols_orig[min(4, len(cols_orig) - 1)]
-                title_col = title_col or cols_orig[min(3, len(cols_orig) - 1)]
-                area_col = area_col or cols_orig[0]
-                nro_col = nro_col or cols_orig[min(1, len(cols_orig) - 1)]
-
-        for _, r in df.iterrows():
-            sku = normalize_sku(r.get(sku_col, "")) if sku_col else ""
-            if not sku:
-                continue
 
-            qty_raw = r.get(qty_col, "") if qty_col else ""
+def _safe_str_series(values: pd.Series) -> pd.Series:
+    """_safe_str vectorizado (mismo resultado elemento a elemento)."""
+    raw = values.astype(object)
+    s = raw.map(str).str.strip()
+    empty = (s.str.lower() == "nan") | ((s == "None") & raw.isna())
+    return s.where(~empty, "")
+
+
+def _full_qty(x) -> int:
+    s = str(x).strip()
+    try:
+        return int(float(s)) if s else 0
+    except Exception:
+        return 0
+
+
+def _full_qty_series(values: pd.Series) -> pd.Series:
+    """Cantidad entera de cada celda como en la versión fila a fila (int(float(str)), 0 si falla).
+    Las cantidades se repiten mucho: se convierte cada valor distinto una sola vez."""
+    raw = values.astype(object)
+    keys = raw.map(str)
+    conv = {k: _full_qty(k) for k in keys.unique()}
+    return keys.map(conv)
+
+
+def _full_sheet_frame(df: pd.DataFrame, sh) -> pd.DataFrame:
+    """Filas válidas (SKU y cantidad > 0) de una hoja, ya normalizadas."""
+    if df is None or df.empty:
+        return None
+
+    cols_orig = df.columns.tolist()
+    cols_lower = [str(c).strip().lower() for c in cols_orig]
+
+    sku_col = _pick_col(cols_lower, cols_orig, ["sku", "sku_ml", "codigo", "código", "cod", "ubc", "cod sku"])
+    qty_col = _pick_col(cols_lower, cols_orig, ["cantidad", "qty", "unidades", "cant", "cant.", "cantidad total"])
+    title_col = _pick_col(cols_lower, cols_orig, ["articulo", "artículo", "descripcion", "descripción", "producto", "detalle", "artículo / producto"])
+
+    area_col = _pick_col(cols_lower, cols_orig, ["area", "área", "zona", "ubicacion", "ubicación"])
+    nro_col = _pick_col(cols_lower, cols_orig, ["nro", "n°", "numero", "número", "num", "#", "n"])
+
+    etiquetar_col = _pick_col(cols_lower, cols_orig, ["etiquetar", "etiqueta"])
+    pack_col = _pick_col(cols_lower, cols_orig, ["es pack", "pack", "es_pack", "espack"])
+    instr_col = _pick_col(cols_lower, cols_orig, ["instruccion", "instrucción", "obs", "observacion", "observación", "nota", "notas"])
+    vence_col = _pick_col(cols_lower, cols_orig, ["vence", "vencimiento", "fecha vence", "fecha_vencimiento"])
+
+    # Fallback mínimo: si no hay columnas clave, intentar por posición
+    if sku_col is None or qty_col is None:
+        if df.shape[1] >= 3:
+            # intento: col0 area, col1 nro, col2 sku, col3 desc, col4 qty
+            sku_col = sku_col or cols_orig[min(2, len(cols_orig) - 1)]
+            qty_col = qty_col or cols_orig[min(4, len(cols_orig) - 1)]
+            title_col = title_col or cols_orig[min(3, len(cols_orig) - 1)]
+            area_col = area_col or cols_orig[0]
+            nro_col = nro_col or cols_orig[min(1, len(cols_orig) - 1)]
+
+    if not sku_col or not qty_col:
+        return None
+
+    sku = normalize_sku_series(df[sku_col])
+    qty = _full_qty_series(df[qty_col])
+    keep = (sku != "") & (qty > 0)
+    if not keep.any():
+        return None
+    df = df[keep]
+
+    def text(col):
+        if not col:
+            return pd.Series("", index=df.index, dtype=object)
+        return _safe_str_series(df[col])
+
+    return pd.DataFrame({
+        "sheet": pd.Series(sh, index=df.index, dtype=object),
+        "sku_ml": sku[keep],
+        "title": text(title_col),
+        "qty_required": qty[keep],
+        "area": text(area_col),
+        "nro": text(nro_col),
+        "etiquetar": text(etiquetar_col),
+        "es_pack": text(pack_col),
+        "instruccion": text(instr_col),
+        "vence": text(vence_col),
+    }, columns=FULL_EXCEL_COLUMNS)
+
+
+def _full_excel_frames(data: bytes, max_workers: int) -> list:
+    """(hoja, DataFrame dtype=str) de todas las hojas, en orden. Con max_workers > 1 y un libro
+    grande, las hojas se leen en procesos (workers.py); si el pool falla, en serie."""
+    with pd.ExcelFile(io.BytesIO(data)) as xls:
+        sheets = list(xls.sheet_names)
+        if max_workers > 1 and len(sheets) > 1 and len(data) >= FULL_EXCEL_PARALLEL_MIN_BYTES:
             try:
-                qty = int(float(str(qty_raw).strip())) if str(qty_raw).strip() else 0
+                k = min(max_workers, len(sheets))
+                groups = [sheets[i::k] for i in range(k)]
+                ctx = multiprocessing.get_context("spawn")  # fork con hilos de Streamlit no es seguro
+                with ProcessPoolExecutor(max_workers=k, mp_context=ctx) as ex:
+                    parts = list(ex.map(workers.excel_sheet_frames, [data] * k, groups))
+                by_sheet = {sh: frame for g, part in zip(groups, parts) for sh, frame in zip(g, part)}
+                return [(sh, by_sheet[sh]) for sh in sheets]
             except Exception:
-                qty = 0
-            if qty <= 0:
-                continue
+                pass
+        return [(sh, pd.read_excel(xls, sheet_name=sh, dtype=str)) for sh in sheets]
 
-            title = _safe_str(r.get(title_col, "")) if title_col else ""
-            area = _safe_str(r.get(area_col, "")) if area_col else ""
-            nro = _safe_str(r.get(nro_col, "")) if nro_col else ""
-            etiquetar = _safe_str(r.get(etiquetar_col, "")) if etiquetar_col else ""
-            es_pack = _safe_str(r.get(pack_col, "")) if pack_col else ""
-            instruccion = _safe_str(r.get(instr_col, "")) if instr_col else ""
-            vence = _safe_str(r.get(vence_col, "")) if vence_col else ""
-
-            all_rows.append({
-                "sheet": sh,
-                "sku_ml": sku,
-                "title": title,
-                "qty_required": qty,
-                "area": area,
-                "nro": nro,
-                "etiquetar": etiquetar,
-                "es_pack": es_pack,
-                "instruccion": instruccion,
-                "vence": vence,
-            })
 
-    return pd.DataFrame(all_rows)
+def read_full_excel(file, max_workers: int = None) -> pd.DataFrame:
+    """
+    Lee todas las hojas y devuelve un DF normalizado:
+    sku_ml, title, qty_required, area, nro, etiquetar, es_pack, instruccion, vence, sheet
+    """
+    data = _pdf_bytes(file)
+    max_workers = FULL_EXCEL_WORKERS if max_workers is None else int(max_workers)
+    frames = [f for f in (_full_sheet_frame(df, sh) for sh, df in _full_excel_frames(data, max_workers)) if f is not None]
+    if not frames:
+        return pd.DataFrame()
+    out = pd.concat(frames, ignore_index=True)
+    # misma inferencia de dtypes que DataFrame(lista de dicts) (p.ej. str en pandas >= 3)
+    return pd.DataFrame({col: out[col].tolist() for col in FULL_EXCEL_COLUMNS})
 
 
 def compute_full_status(qty_required: int, qty_checked: int, has_incidence: bool = False) -> str:
@@ -2322,56 +3740,63 @@ def get_open_full_batches():
     return rows
 
 
-def upsert_full_batch_from_df(df: pd.DataFrame, batch_name: str):
-    """
-    Crea un batch y carga items agregados por SKU.
-    """
-    if df is None or df.empty:
-        raise ValueError("El Excel no tiene filas válidas (SKU/Cantidad).")
+FULL_OPTIONAL_FIELDS = ["etiquetar", "es_pack", "instruccion", "vence"]
 
-    # Agregar por SKU
-    agg = {}
-    for _, r in df.iterrows():
-        sku = normalize_sku(r.get("sku_ml", ""))
-        if not sku:
-            continue
 
-        qty = int(r.get("qty_required", 0) or 0)
-        if qty <= 0:
-            continue
+def _full_text_col(df: pd.DataFrame, col: str, keep=None) -> pd.Series:
+    """Columna como texto limpio (_cell_to_str); '' si no existe."""
+    if col not in df.columns:
+        return pd.Series("", index=df.index if keep is None else df.index[keep], dtype=object)
+    values = df[col]
+    if isinstance(values, pd.DataFrame):
+        # columnas duplicadas: primer valor no vacío de la fila, como _cell_to_str
+        values = values.apply(_cell_to_str, axis=1)
+    if keep is not None:
+        values = values[keep]
+    return _safe_str_series(values)
 
-        if sku not in agg:
-            agg[sku] = {
-                "sku_ml": sku,
-                "title": _cell_to_str(r.get("title", "")),
-                "qty_required": 0,
-                "areas": set(),
-                "nros": set(),
-                "etiquetar": "",
-                "es_pack": "",
-                "instruccion": "",
-                "vence": "",
-            }
 
-        a = agg[sku]
-        a["qty_required"] += qty
+def _full_first_nonempty(keys: pd.Series, values: pd.Series, order) -> list:
+    """Primer valor no vacío por clave (en orden de filas); '' si todos vacíos. Alineado a order."""
+    first = values.where(values != "").groupby(keys, sort=False).first()
+    return first.reindex(order).fillna("").tolist()
+
 
-        area = _safe_str(r.get("area", ""))
-        nro = _safe_str(r.get("nro", ""))
-        if area:
-            a["areas"].add(area)
-        if nro:
-            a["nros"].add(nro)
+def _full_join_unique(keys: pd.Series, values: pd.Series, order) -> list:
+    """Valores no vacíos distintos por clave, ordenados y unidos con ' / '. Alineado a order."""
+    pairs = pd.DataFrame({"k": keys.to_numpy(dtype=object), "v": values.to_numpy(dtype=object)})
+    pairs = pairs[pairs["v"] != ""].drop_duplicates().sort_values("v", kind="stable")
+    groups = {}
+    for k, v in zip(pairs["k"].tolist(), pairs["v"].tolist()):
+        groups.setdefault(k, []).append(v)
+    return [" / ".join(groups[k]) if k in groups else "" for k in order]
 
-        # En campos opcionales, guardamos el primero no vacío (si hay)
-        for k in ["etiquetar", "es_pack", "instruccion", "vence"]:
-            v = _safe_str(r.get(k, ""))
-            if v and not a.get(k):
-                a[k] = v
 
-        # si no hay título, intentar completar después con maestro (en UI)
-        if not a["title"]:
-            a["title"] = _cell_to_str(r.get("title", ""))
+def upsert_full_batch_from_df(df: pd.DataFrame, batch_name: str):
+    """
+    Crea un batch y carga items agregados por SKU (groupby + un solo executemany).
+    Devuelve (batch_id, resumen) con n_skus, req_units y n_rows (filas válidas agregadas).
+    """
+    if df is None or df.empty:
+        raise ValueError("El Excel no tiene filas válidas (SKU/Cantidad).")
+
+    # Agregar por SKU (en orden de primera aparición)
+    sku = normalize_sku_series(df["sku_ml"]) if "sku_ml" in df.columns else pd.Series("", index=df.index)
+    if "qty_required" in df.columns:
+        q = df["qty_required"]
+        qty = q.astype("int64") if pd.api.types.is_integer_dtype(q) else q.map(lambda x: int(x or 0))
+    else:
+        qty = pd.Series(0, index=df.index)
+    keep = ((sku != "") & (qty > 0)).to_numpy()
+
+    keys = sku[keep]
+    qty_sum = qty[keep].groupby(keys, sort=False).sum()
+    skus = qty_sum.index
+    # si no hay título, se completa con el primero no vacío del SKU (o después con maestro, en UI)
+    title = _full_first_nonempty(keys, _full_text_col(df, "title", keep), skus)
+    areas = _full_join_unique(keys, _full_text_col(df, "area", keep), skus)
+    nros = _full_join_unique(keys, _full_text_col(df, "nro", keep), skus)
+    optional = {k: _full_first_nonempty(keys, _full_text_col(df, k, keep), skus) for k in FULL_OPTIONAL_FIELDS}
 
     conn = get_conn()
     c = conn.cursor()
@@ -2383,46 +3808,151 @@ def upsert_full_batch_from_df(df: pd.DataFrame, batch_name: str):
     )
     batch_id = c.lastrowid
 
-    for sku, a in agg.items():
-        areas_txt = " / ".join(sorted(a["areas"])) if a["areas"] else ""
-        nros_txt = " / ".join(sorted(a["nros"])) if a["nros"] else ""
-        c.execute("""
-            INSERT INTO full_batch_items
-            (batch_id, sku_ml, title, areas, nros, etiquetar, es_pack, instruccion, vence, qty_required, qty_checked, status, updated_at)
-            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)
-        """, (
-            batch_id, sku, a["title"], areas_txt, nros_txt,
-            a.get("etiquetar", ""), a.get("es_pack", ""), a.get("instruccion", ""), a.get("vence", ""),
-            int(a["qty_required"]), 0, "PENDING", now_iso()
-        ))
+    c.executemany("""
+        INSERT INTO full_batch_items
+        (batch_id, sku_ml, title, areas, nros, etiquetar, es_pack, instruccion, vence, qty_required, qty_checked, status, updated_at)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)
+    """, zip(
+        [batch_id] * len(skus), skus.tolist(), title, areas, nros,
+        *(optional[k] for k in FULL_OPTIONAL_FIELDS),
+        (int(x) for x in qty_sum.tolist()), [0] * len(skus), ["PENDING"] * len(skus), [created] * len(skus),
+    ))
 
     conn.commit()
     conn.close()
-    return batch_id
+    summary = {
+        "n_skus": int(len(skus)),
+        "req_units": int(qty_sum.sum()) if len(skus) else 0,
+        "n_rows": int(keep.sum()),
+    }
+    return batch_id, summary
+
+
+# True: get_full_batch_summary lee full_batch_stats (una fila, mantenida por triggers).
+# False: agrega full_batch_items en cada llamada.
+FULL_STATS_MATERIALIZED = True
+FULL_DETAIL_PAGE_SIZES = [50, 100, 200, 500]
+
+
+def _full_stats_counts(c, batch_id: int = None) -> dict:
+    """Contadores de FULL_STATS_COUNTERS por lote ({batch_id: {contador: n}}) con una consulta."""
+    aggs = ", ".join(f"COALESCE(SUM({expr.format(r='full_batch_items')}), 0)" for _name, expr in FULL_STATS_COUNTERS)
+    where = "WHERE batch_id=?" if batch_id is not None else "WHERE batch_id IS NOT NULL"
+    params = (batch_id,) if batch_id is not None else ()
+    rows = c.execute(f"SELECT batch_id, {aggs} FROM full_batch_items {where} GROUP BY batch_id;", params).fetchall()
+    return {int(row[0]): dict(zip(FULL_STATS_NAMES, (int(v or 0) for v in row[1:]))) for row in rows}
+
+
+def _full_stats_rebuild(c, batch_id: int = None) -> dict:
+    """Recalcula full_batch_stats desde full_batch_items (un lote o todos). No hace commit."""
+    counts = _full_stats_counts(c, batch_id)
+    if batch_id is None:
+        c.execute("DELETE FROM full_batch_stats;")
+    else:
+        c.execute("DELETE FROM full_batch_stats WHERE batch_id=?;", (batch_id,))
+        counts.setdefault(int(batch_id), dict.fromkeys(FULL_STATS_NAMES, 0))
+    ph = ",".join(["?"] * (len(FULL_STATS_NAMES) + 1))
+    c.executemany(
+        f"INSERT INTO full_batch_stats(batch_id, {', '.join(FULL_STATS_NAMES)}) VALUES ({ph});",
+        [(b, *(d[n] for n in FULL_STATS_NAMES)) for b, d in counts.items()],
+    )
+    return counts
 
 
-def get_full_batch_summary(batch_id: int):
+def get_full_batch_summary(batch_id: int, fresh: bool = False):
+    """(full_batches row, (n_skus, req_units, chk_units, ok_skus, touched_skus, pending_skus)).
+    Con FULL_STATS_MATERIALIZED lee full_batch_stats; fresh=True recuenta (y corrige la fila)."""
     conn = get_conn()
     c = conn.cursor()
 
     c.execute("SELECT batch_name, status, created_at, closed_at FROM full_batches WHERE id=?", (batch_id,))
     b = c.fetchone()
 
+    if FULL_STATS_MATERIALIZED and fresh:
+        counts = _full_stats_rebuild(c, batch_id)[int(batch_id)]
+        conn.commit()
+    elif FULL_STATS_MATERIALIZED:
+        row = c.execute(
+            f"SELECT {', '.join(FULL_STATS_NAMES)} FROM full_batch_stats WHERE batch_id=?;", (batch_id,)
+        ).fetchone()
+        counts = dict(zip(FULL_STATS_NAMES, row)) if row else dict.fromkeys(FULL_STATS_NAMES, 0)
+    else:
+        counts = _full_stats_counts(c, batch_id).get(int(batch_id)) or dict.fromkeys(FULL_STATS_NAMES, 0)
+    s = tuple(counts[n] for n in FULL_STATS_NAMES)
+
+    conn.close()
+    return b, s
+
+
+def get_full_batch_detail_page(batch_id: int, limit: int, offset: int = 0) -> list:
+    """Una página del detalle por SKU (mismo orden que Full – Admin), por idx_full_items_detail."""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("""
+        SELECT sku_ml, COALESCE(NULLIF(title,''),''), qty_required, qty_checked,
+               (qty_required - qty_checked) as pendiente,
+               status, updated_at, areas, nros
+        FROM full_batch_items
+        WHERE batch_id=?
+        ORDER BY status, CAST(sku_ml AS INTEGER), sku_ml
+        LIMIT ? OFFSET ?
+    """, (batch_id, int(limit), int(offset)))
+    rows = c.fetchall()
+    conn.close()
+    return rows
+
+
+def load_full_sku_state(batch_id: int) -> dict:
+    """Estado en memoria del lote para el modo ráfaga: sku -> {req, chk, title}. Una consulta."""
+    conn = get_conn()
+    c = conn.cursor()
     c.execute("""
-        SELECT
-            COUNT(*) as n_skus,
-            SUM(qty_required) as req_units,
-            SUM(qty_checked) as chk_units,
-            SUM(CASE WHEN status='OK' THEN 1 ELSE 0 END) as ok_skus,
-            SUM(CASE WHEN status IN ('PARTIAL','INCIDENCE','OVER','OK_WITH_ISSUES') THEN 1 ELSE 0 END) as touched_skus,
-            SUM(CASE WHEN status='PENDING' THEN 1 ELSE 0 END) as pending_skus
+        SELECT sku_ml, COALESCE(qty_required,0), COALESCE(qty_checked,0), COALESCE(NULLIF(title,''),'')
         FROM full_batch_items
         WHERE batch_id=?
     """, (batch_id,))
-    s = c.fetchone()
-
+    out = {sku: {"req": int(req), "chk": int(chk), "title": title} for sku, req, chk, title in c.fetchall()}
     conn.close()
-    return b, s
+    return out
+
+
+def apply_full_acopio_batch(batch_id: int, qty_by_sku: dict) -> dict:
+    """Aplica varios acopios (sku -> unidades) en UNA transacción (BEGIN IMMEDIATE).
+    Nunca supera lo solicitado: lo que exceda el pendiente al momento de aplicar se rechaza.
+    Devuelve sku -> (aplicadas, rechazadas)."""
+    if not qty_by_sku:
+        return {}
+    conn = get_conn()
+    c = conn.cursor()
+    out = {}
+    try:
+        if not conn.in_transaction:
+            c.execute("BEGIN IMMEDIATE;")
+        now = now_iso()
+        updates = []
+        for sku, q in qty_by_sku.items():
+            row = c.execute(
+                "SELECT COALESCE(qty_required,0), COALESCE(qty_checked,0) FROM full_batch_items WHERE batch_id=? AND sku_ml=?",
+                (batch_id, sku),
+            ).fetchone()
+            applied = 0 if not row else max(0, min(int(q), int(row[0]) - int(row[1])))
+            out[sku] = (applied, int(q) - applied)
+            if applied:
+                updates.append((applied, applied, now, batch_id, sku))
+        c.executemany("""
+            UPDATE full_batch_items
+            SET qty_checked = COALESCE(qty_checked,0) + ?,
+                status = CASE WHEN (COALESCE(qty_checked,0) + ?) >= COALESCE(qty_required,0) THEN 'OK' ELSE 'PENDING' END,
+                updated_at = ?
+            WHERE batch_id=? AND sku_ml=?
+        """, updates)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return out
 
 
 # =========================
@@ -2489,10 +4019,13 @@ def page_full_upload(inv_map_sku: dict):
                     df_save = df_save.drop(columns=["title"])
                 df_save = df_save.rename(columns={"title_eff": "title"})
 
-            batch_id = upsert_full_batch_from_df(df_save, str(batch_name).strip())
+            batch_id, summary = upsert_full_batch_from_df(df_save, str(batch_name).strip())
 
             # Mostrar confirmación aunque hagamos rerun
-            st.session_state["full_flash"] = f"✅ Lote Full cargado correctamente (#{batch_id})."
+            st.session_state["full_flash"] = (
+                f"✅ Lote Full cargado correctamente (#{batch_id}): "
+                f"{summary['n_skus']} SKUs, {summary['req_units']} unidades."
+            )
             st.session_state.full_selected_batch = batch_id
             st.rerun()
         except Exception as e:
@@ -2501,6 +4034,108 @@ def page_full_upload(inv_map_sku: dict):
 
 
 
+# Modo ráfaga del supervisor Full: 1 unidad por escaneo, validada contra el estado del lote en
+# memoria (sin DB por escaneo) y aplicada en lotes con apply_full_acopio_batch.
+FULL_BURST_FLUSH_SIZE = 10        # escaneos en cola que disparan la escritura
+FULL_BURST_FLUSH_SECONDS = 3.0    # o antigüedad del escaneo más viejo en cola
+FULL_BURST_LOG_SIZE = 15
+
+
+def _st_fragment(run_every=None):
+    """st.fragment(run_every=...) si la versión de Streamlit lo trae; si no, la función tal cual."""
+    fragment = getattr(st, "fragment", None)
+    if fragment is None:
+        return lambda fn: fn
+    return fragment(run_every=run_every)
+
+
+def _full_burst_flush(batch_id: int, sst: dict):
+    """Escribe la cola del modo ráfaga y resincroniza el estado en memoria con la DB."""
+    queue = sst.get("burst_queue") or []
+    if not queue:
+        return
+    qty_by_sku = {}
+    for sku in queue:
+        qty_by_sku[sku] = qty_by_sku.get(sku, 0) + 1
+    result = apply_full_acopio_batch(batch_id, qty_by_sku)
+    sst["burst_queue"] = []
+    sst["burst_queue_since"] = None
+    sst["burst_model"] = load_full_sku_state(batch_id)
+    sst["burst_applied"] = int(sst.get("burst_applied", 0)) + sum(a for a, _r in result.values())
+    for sku, (_applied, rejected) in result.items():
+        if rejected:
+            # otro equipo acopió el mismo SKU mientras tanto
+            sst["burst_log"].appendleft(("ERR", sku, f"{rejected} unidad(es) rechazadas: sin pendiente al aplicar"))
+            sfx_emit("ERR")
+
+
+# El fragmento se re-ejecuta solo cada FULL_BURST_FLUSH_SECONDS: así la regla por tiempo aplica
+# la cola aunque el supervisor deje de escanear (a más tardar ~2x ese plazo tras el último escaneo).
+def _full_burst_flush_pending():
+    """Aplica las colas de modo ráfaga que quedaron sin escribir (el supervisor se fue a otra
+    página o modo) y suelta el estado en memoria: al volver se recarga desde la DB."""
+    for batch_id, sst in (st.session_state.get("full_sup_state") or {}).items():
+        if sst.get("burst_queue"):
+            _full_burst_flush(int(batch_id), sst)
+        sst["burst_model"] = None
+
+
+@_st_fragment(run_every=FULL_BURST_FLUSH_SECONDS)
+def _full_burst_scanner(batch_id: int, barcode_to_sku):
+    sst = st.session_state.full_sup_state[str(batch_id)]
+    if sst.get("burst_model") is None:
+        sst["burst_model"] = load_full_sku_state(batch_id)
+        sst["burst_queue"] = []
+        sst["burst_queue_since"] = None
+        sst["burst_log"] = deque(maxlen=FULL_BURST_LOG_SIZE)
+
+    input_key = f"full_burst_scan_{batch_id}"
+
+    def handle_scan(key):
+        raw = str(st.session_state.get(key, "") or "").strip()
+        st.session_state[key] = ""
+        if not raw:
+            return
+        sku = resolve_scan_to_sku(raw, barcode_to_sku)
+        item = sst["burst_model"].get(sku)
+        if item is None:
+            sst["burst_log"].appendleft(("ERR", sku or raw, "no pertenece a este lote"))
+            sfx_emit("ERR")
+            return
+        if item["chk"] >= item["req"]:
+            sst["burst_log"].appendleft(("ERR", sku, f"ya completo ({item['chk']}/{item['req']})"))
+            sfx_emit("ERR")
+            return
+        item["chk"] += 1  # optimista; la DB manda al aplicar la cola
+        sst["burst_queue"].append(sku)
+        if sst.get("burst_queue_since") is None:
+            sst["burst_queue_since"] = time.time()
+        sst["burst_log"].appendleft(("OK", sku, f"{item['chk']}/{item['req']} {item['title']}".strip()))
+        sfx_emit("OK")
+
+    queue = sst["burst_queue"]
+    since = sst.get("burst_queue_since")
+    if queue and (len(queue) >= FULL_BURST_FLUSH_SIZE or (since and time.time() - since >= FULL_BURST_FLUSH_SECONDS)):
+        _full_burst_flush(batch_id, sst)
+
+    scan_label = "Escaneo ráfaga"
+    st.text_input(scan_label, key=input_key, on_change=handle_scan, args=(input_key,))
+    force_tel_keyboard(scan_label)
+    autofocus_input(scan_label)
+    sfx_render_pending()
+
+    if st.button("💾 Aplicar ahora", key=f"full_burst_flush_{batch_id}", disabled=not sst["burst_queue"]):
+        _full_burst_flush(batch_id, sst)
+    m1, m2 = st.columns(2)
+    m1.metric("En cola", len(sst["burst_queue"]))
+    m2.metric("Aplicadas (sesión)", int(sst.get("burst_applied", 0)))
+
+    for kind, sku, msg in sst["burst_log"]:
+        css = "ok" if kind == "OK" else "bad"
+        label = "✅ OK" if kind == "OK" else "❌ ERROR"
+        st.markdown(f'<span class="tag {css}">{label}</span> {html.escape(str(sku))} — {html.escape(str(msg))}', unsafe_allow_html=True)
+
+
 def page_full_supervisor(inv_map_sku: dict):
     st.header("Full – Supervisor de acopio")
 
@@ -2512,12 +4147,8 @@ def page_full_supervisor(inv_map_sku: dict):
 
     batch_id, _batch_name, _status, _created_at = open_batches[0]
 
-    # Map barcode->sku desde DB (maestro ya lo cargó)
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT barcode, sku_ml FROM sku_barcodes")
-    barcode_to_sku = {r[0]: r[1] for r in c.fetchall()}
-    conn.close()
+    # Resolver barcode->sku compartido (maestro ya lo cargó)
+    barcode_to_sku = get_barcode_resolver(MASTER_FILE)
 
     st.markdown(
         """
@@ -2551,6 +4182,15 @@ def page_full_supervisor(inv_map_sku: dict):
         }
     sst = state[str(batch_id)]
 
+    burst = st.toggle("Modo ráfaga (1 unidad por escaneo)", key=f"full_burst_mode_{batch_id}")
+    if burst:
+        _full_burst_scanner(batch_id, barcode_to_sku)
+        return
+    if sst.get("burst_model") is not None:
+        # al salir del modo ráfaga se aplica lo que quedó en cola
+        _full_burst_flush(batch_id, sst)
+        sst["burst_model"] = None
+
     scan_key = f"full_scan_{batch_id}_{sst.get('scan_nonce',0)}"
     qty_key  = f"full_qty_{batch_id}_{sst.get('qty_nonce',0)}"
 
@@ -2819,23 +4459,26 @@ def page_full_admin():
     c2.metric("Unidades acopiadas", f"{chk_units}/{req_units}")
     c3.metric("SKUs OK", f"{ok_skus}/{n_skus}")
     c4.metric("SKUs pendientes", pending_skus)
-
-    conn = get_conn()
-    c = conn.cursor()
+    if st.button("Recalcular contadores", key="full_stats_fresh"):
+        get_full_batch_summary(batch_id, fresh=True)
+        st.rerun()
 
     st.subheader("Detalle por SKU")
-    c.execute("""
-        SELECT sku_ml, COALESCE(NULLIF(title,''),''), qty_required, qty_checked,
-               (qty_required - qty_checked) as pendiente,
-               status, updated_at, areas, nros
-        FROM full_batch_items
-        WHERE batch_id=?
-        ORDER BY status, CAST(sku_ml AS INTEGER), sku_ml
-    """, (batch_id,))
-    rows = c.fetchall()
+    # Paginado: cada rerun lee solo la página visible (n_skus viene del contador del lote)
+    pc1, pc2 = st.columns([1, 1])
+    page_size = pc1.selectbox("Filas por página", FULL_DETAIL_PAGE_SIZES, index=1, key="full_detail_page_size")
+    n_pages = max(1, -(-n_skus // int(page_size)))
+    page = pc2.number_input("Página", min_value=1, max_value=n_pages, value=1, step=1, key="full_detail_page")
+    page = min(int(page), n_pages)
+    offset = (page - 1) * int(page_size)
+    rows = get_full_batch_detail_page(batch_id, int(page_size), offset)
     df = pd.DataFrame(rows, columns=["SKU", "Artículo", "Solicitado", "Acopiado", "Pendiente", "Estado", "Actualizado", "Áreas", "Nros"])
     df["Actualizado"] = df["Actualizado"].apply(to_chile_display)
     st.dataframe(df, use_container_width=True)
+    st.caption(f"SKUs {offset + 1 if rows else 0}–{offset + len(rows)} de {n_skus} • Página {page}/{n_pages}")
+
+    conn = get_conn()
+    c = conn.cursor()
 
     st.subheader("Incidencias")
     c.execute("""
@@ -2850,9 +4493,11 @@ def page_full_admin():
         df_inc["Hora"] = df_inc["Hora"].apply(to_chile_display)
         # Producto (nombre técnico): usar maestro si existe, si no SKU
         if isinstance(inv_map_sku, dict) and not df_inc.empty:
+            _raw = master_raw_titles_lookup(MASTER_FILE, [str(x).strip() for x in df_inc["SKU"]])
+
             def _pname(sku):
                 k = str(sku).strip()
-                return inv_map_sku.get(k) or master_raw_title_lookup(MASTER_FILE, k) or k
+                return inv_map_sku.get(k) or _raw.get(k) or k
             df_inc["Producto"] = df_inc["SKU"].apply(_pname)
         else:
             df_inc["Producto"] = df_inc["SKU"].astype(str)
@@ -2884,6 +4529,7 @@ def page_full_admin():
                 c2.execute("DELETE FROM full_incidences;")
                 c2.execute("DELETE FROM full_batch_items;")
                 c2.execute("DELETE FROM full_batches;")
+                c2.execute("DELETE FROM full_batch_stats;")
                 conn2.commit()
                 conn2.close()
 
@@ -2939,12 +4585,21 @@ def page_admin():
     col3.metric("OTs", n_ots)
     col4.metric("Incidencias", n_inc)
 
+    with st.expander("Diagnóstico BD (índices / planes de consulta)", expanded=bool(_DB_PLAN_PROBLEMS)):
+        problems = db_check_query_plans(conn)
+        if problems:
+            st.error("Consultas calientes recorriendo la tabla completa (falta índice):")
+            st.table([{"consulta": q, "plan": p} for q, p in problems])
+        else:
+            st.success(f"{len(HOT_QUERIES)} consultas calientes usan índice.")
+
     st.subheader("Estado OTs")
     c.execute("""
         SELECT po.ot_code, pk.name, po.status, po.created_at, po.closed_at,
                SUM(CASE WHEN pt.status='PENDING' THEN 1 ELSE 0 END) as pendientes,
                SUM(CASE WHEN pt.status IN ('DONE','INCIDENCE') THEN 1 ELSE 0 END) as resueltas,
-               SUM(CASE WHEN pt.confirm_mode='MANUAL_NO_EAN' THEN 1 ELSE 0 END) as manual_no_ean
+               SUM(CASE WHEN pt.confirm_mode='MANUAL_NO_EAN' THEN 1 ELSE 0 END) as manual_no_ean,
+               po.route_distance
         FROM picking_ots po
         JOIN pickers pk ON pk.id = po.picker_id
         LEFT JOIN picking_tasks pt ON pt.ot_id = po.id
@@ -2953,7 +4608,7 @@ def page_admin():
     """)
     df = pd.DataFrame(c.fetchall(), columns=[
         "OT", "Picker", "Estado", "Creada", "Cerrada",
-        "Pendientes", "Resueltas", "Sin EAN"
+        "Pendientes", "Resueltas", "Sin EAN", "Recorrido est. (m)"
     ])
     df["Creada"] = df["Creada"].apply(to_chile_display)
     df["Cerrada"] = df["Cerrada"].apply(to_chile_display)
@@ -2972,7 +4627,8 @@ def page_admin():
         df_inc = pd.DataFrame(inc_rows, columns=["OT","Picker","SKU","Solicitado","Pickeado","Faltante","Motivo","Nota","Hora"])
         # Producto (título técnico): maestro si existe; si no, SKU
         try:
-            df_inc["Producto"] = df_inc["SKU"].apply(lambda x: (master_raw_title_lookup(MASTER_FILE, str(x).strip()) or str(x).strip()))
+            _raw = master_raw_titles_lookup(MASTER_FILE, [str(x).strip() for x in df_inc["SKU"]])
+            df_inc["Producto"] = df_inc["SKU"].apply(lambda x: (_raw.get(str(x).strip()) or str(x).strip()))
         except Exception:
             df_inc["Producto"] = df_inc["SKU"].astype(str)
 
@@ -3063,82 +4719,88 @@ def decode_fh(text: str) -> str:
             return m.group(0)
     return re.sub(r"_(..)", repl, text)
 
-def clean_address(text: str) -> str:
-    if not text:
-        return ""
-    t = decode_fh(text)
-    # remove JSON objects from QR payloads if present
-    t = re.sub(r"\{.*?\}", "", t)
-    t = t.replace("->", " ")
-    t = re.sub(r"\s+", " ", t).strip()
-    # cut off technical tails often present
-    t = re.sub(r"\s*\(\s*Liberador.*$", "", t, flags=re.IGNORECASE).strip()
-    return t
-
-def parse_zpl_labels(raw: str):
-    # Returns dict pack_id -> {shipment_id,buyer,address,raw}
-    # and dict shipment_id -> same (for FLEX QR)
-    pack_map = {}
-    ship_map = {}
-
-    # collect ^FD...^FS fields and decode ^FH content
-    fd = re.findall(r"\^FD(.*?)\^FS", raw, flags=re.DOTALL)
-    fd = [decode_fh(x.replace("\n"," ").replace("\r"," ").strip()) for x in fd if x]
-    joined = " ".join(fd)
-
-    # Split by ^XA/^XZ blocks
-    blocks = re.split(r"\^XA", raw)
-    for b in blocks:
-        if "^XZ" not in b:
-            continue
-        # shipment id from barcode
-        ship = None
-        m = re.search(r"\^FD>:\s*(\d{6,20})", b)
-        if m:
-            ship = m.group(1)
-        # shipment id from QR JSON
-        if not ship:
-            m = re.search(r'"id"\s*:\s*"(\d{6,20})"', b)
-            if m:
-                ship = m.group(1)
-
-        # pack id (may be split across fields)
-        pack = None
-        # try "Pack ID:" with digits/spaces following
-        dec_b = decode_fh(b.replace("\n"," ").replace("\r"," "))
-        m = re.search(r"Pack ID:\s*([0-9 ]{6,30})", dec_b)
-        if m:
-            pack = re.sub(r"\s+", "", m.group(1))
-        # fallback: if we see a 17-18 digit starting with 20000
-        if not pack:
-            m = re.search(r"\b(20000\d{7,20})\b", dec_b)
-            if m:
-                pack = m.group(1)
-
-        # buyer and address heuristics
-        buyer = None
-        addr = None
-        # buyer often appears after ' - ' near end
-        m = re.search(r"\b([A-Za-zÁÉÍÓÚÜÑáéíóúüñ]+\s+[A-Za-zÁÉÍÓÚÜÑáéíóúüñ]+(?:\s+[A-Za-zÁÉÍÓÚÜÑáéíóúüñ]+)?)\s*\(", dec_b)
-        if m:
-            buyer = m.group(1).strip()
-        # domicile/address text
-        m = re.search(r"Domicilio:\s*([^\^]+?)(?:Ciudad de destino:|\^FS|$)", dec_b, flags=re.IGNORECASE)
-        if m:
-            addr = clean_address(m.group(1))
-        else:
-            # try line that contains comuna / ciudad
-            m = re.search(r"(?:\bComuna\b|\bCiudad\b|\bRM\b).{10,200}", dec_b)
-            if m:
-                addr = clean_address(m.group(0))
-
-        rec = {"pack_id": pack, "shipment_id": ship, "buyer": buyer, "address": addr, "raw": b}
-        if pack:
-            pack_map[pack] = rec
-        if ship:
-            ship_map[ship] = rec
+# =========================
+# ZPL: TOKENIZER (streaming, una pasada)
+# =========================
+ZPL_CHUNK_SIZE = 1 << 20   # 1 MiB por lectura
+
+def _zpl_chunks(src):
+    """Trozos de texto/bytes desde str, bytes, archivo (read) o iterable de trozos."""
+    if isinstance(src, str):
+        yield src
+        return
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        mv = memoryview(src)
+        for i in range(0, len(mv), ZPL_CHUNK_SIZE):
+            yield mv[i:i + ZPL_CHUNK_SIZE]
+        return
+    if hasattr(src, "read"):
+        while True:
+            chunk = src.read(ZPL_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        yield from src
+
+def zpl_iter_labels(src, keep_raw: bool = False):
+    """Recorre un stream ZPL en UNA pasada lineal y entrega una etiqueta por bloque ^XA.
+
+    Cada etiqueta es un dict:
+      - fields: lista de (data, fh, kind) por cada ^FD...^FS, en orden.
+          data: contenido crudo del ^FD (sin decodificar)
+          fh:   True si venía precedido por ^FH (escapes _HH, ver decode_fh)
+          kind: 'text' | 'barcode' (^BC, ^B3, ...) | 'qr' (^BQ)
+      - closed: True si el bloque trae ^XZ
+      - raw: texto completo del bloque (solo con keep_raw=True)
 
-    return pack_map, ship_map
+    Como en un split por "^XA", lo que viene entre ^XZ y el siguiente ^XA queda en la
+    etiqueta anterior. Solo se entregan etiquetas con al menos un ^FD.
+    """
+    dec = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    buf = ""
+    pos = 0          # inicio de la etiqueta en curso dentro de buf
+
+    def texts():
+        for chunk in _zpl_chunks(src):
+            yield chunk if isinstance(chunk, str) else dec.decode(bytes(chunk))
+        yield dec.decode(b"", final=True)
+
+    for text in texts():
+        buf = buf[pos:] + text
+        pos = 0
+        while True:
+            end = buf.find("^XA", pos)
+            if end < 0:
+                break            # etiqueta incompleta: esperar el siguiente trozo
+            label = _zpl_label(buf[pos:end], keep_raw)
+            if label:
+                yield label
+            pos = end + 3
+
+    label = _zpl_label(buf[pos:], keep_raw)
+    if label:
+        yield label
+
+def _zpl_label(block: str, keep_raw: bool):
+    fields = []
+    closed = False
+    fh = False
+    kind = "text"
+    for data, fs, cmd in ZPL_TOKEN_RE.findall(block):
+        if fs:
+            fields.append((data, fh, kind))
+            fh = False
+            kind = "text"
+        elif cmd == "FH":
+            fh = True
+        elif cmd == "XZ":
+            closed = True
+        elif cmd:
+            kind = "qr" if cmd == "BQ" else "barcode"
+    if not fields:
+        return None
+    return {"fields": fields, "closed": closed, "raw": block if keep_raw else None}
 
 def parse_control_pdf_by_page(pdf_file):
     """Parsea Control.pdf (Flex/Colecta) por página.
@@ -3153,7 +4815,11 @@ def parse_control_pdf_by_page(pdf_file):
     if not HAS_PDF_LIB:
         st.error("Falta pdfplumber en el entorno.")
         return None
+    return _parse_control_texts_by_page(pdf_extract_page_texts(pdf_file))
 
+
+def _parse_control_texts_by_page(page_texts: list):
+    """Máquina de estados de parse_control_pdf_by_page sobre el texto de cada página (contexto por página)."""
     def looks_like_name(s: str) -> bool:
         s = (s or "").strip()
         if not s:
@@ -3167,102 +4833,100 @@ def parse_control_pdf_by_page(pdf_file):
         return bool(re.search(r"[A-Za-zÁÉÍÓÚÜÑáéíóúüñ]", s))
 
     pages = []
-    with pdfplumber.open(pdf_file) as pdf:
-        for pno, page in enumerate(pdf.pages, start=1):
-            text = page.extract_text() or ""
-            lines = [ln.strip() for ln in text.splitlines() if ln and ln.strip()]
-
-            items = []
-
-            # Contexto (se mantiene mientras cambian SKU/Cantidad)
-            ctx = {
-                "shipment_id": "",
-                "ml_order_id": None,
-                "pack_id": None,
-                "buyer": "",
-                "title_ml": "",
-            }
+    for pno, text in enumerate(page_texts, start=1):
+        lines = [ln.strip() for ln in text.splitlines() if ln and ln.strip()]
+
+        items = []
+
+        # Contexto (se mantiene mientras cambian SKU/Cantidad)
+        ctx = {
+            "shipment_id": "",
+            "ml_order_id": None,
+            "pack_id": None,
+            "buyer": "",
+            "title_ml": "",
+        }
 
-            current_sku = None
-            current_title = ""
+        current_sku = None
+        current_title = ""
 
-            def push_item(sku, qty):
-                if not ctx.get("ml_order_id") or not sku or not qty:
-                    return
-                try:
-                    q = int(qty)
-                except Exception:
-                    return
-                items.append({
-                    "shipment_id": ctx.get("shipment_id", "") or "",
-                    "ml_order_id": str(ctx.get("ml_order_id")),
-                    "pack_id": (str(ctx.get("pack_id")) if ctx.get("pack_id") else None),
-                    "sku": str(sku),
-                    "qty": q,
-                    "title_ml": (ctx.get("title_ml") or current_title or "")[:200],
-                    "buyer": (ctx.get("buyer") or "")[:120],
-                })
-
-            # Heurística: en algunos PDFs vienen títulos al final; guardamos el último "título largo" como fallback.
-            for ln in lines:
-                # 1) shipment id (Flex) dentro de una línea tipo "4638.... <texto>"
-                m_ship = re.match(r"^(\d{8,15})\s+(.+)$", ln)
-                if m_ship and not ln.lower().startswith("venta"):
-                    ctx["shipment_id"] = m_ship.group(1)
-                    title = m_ship.group(2).strip()
-                    if title and len(title) >= 8:
-                        ctx["title_ml"] = title[:200]
-                    continue
+        def push_item(sku, qty):
+            if not ctx.get("ml_order_id") or not sku or not qty:
+                return
+            try:
+                q = int(qty)
+            except Exception:
+                return
+            items.append({
+                "shipment_id": ctx.get("shipment_id", "") or "",
+                "ml_order_id": str(ctx.get("ml_order_id")),
+                "pack_id": (str(ctx.get("pack_id")) if ctx.get("pack_id") else None),
+                "sku": str(sku),
+                "qty": q,
+                "title_ml": (ctx.get("title_ml") or current_title or "")[:200],
+                "buyer": (ctx.get("buyer") or "")[:120],
+            })
 
-                # 2) Pack ID / Venta
-                m_pack = re.search(r"\bPack\s*ID:\s*([0-9]{10,20})\b", ln, flags=re.I)
-                if m_pack:
-                    ctx["pack_id"] = m_pack.group(1)
-                    # a veces trae SKU en la misma línea
-                    m_pack_sku = re.search(r"\bSKU:\s*([0-9A-Za-z_-]+)\b", ln, flags=re.I)
-                    if m_pack_sku:
-                        current_sku = m_pack_sku.group(1)
-                    continue
+        # Heurística: en algunos PDFs vienen títulos al final; guardamos el último "título largo" como fallback.
+        for ln in lines:
+            # 1) shipment id (Flex) dentro de una línea tipo "4638.... <texto>"
+            m_ship = re.match(r"^(\d{8,15})\s+(.+)$", ln)
+            if m_ship and not ln.lower().startswith("venta"):
+                ctx["shipment_id"] = m_ship.group(1)
+                title = m_ship.group(2).strip()
+                if title and len(title) >= 8:
+                    ctx["title_ml"] = title[:200]
+                continue
 
-                m_sale = re.search(r"\bVenta:\s*([0-9]{10,20})\b", ln, flags=re.I)
-                if m_sale:
-                    ctx["ml_order_id"] = m_sale.group(1)
-                    # En algunos casos viene un SKU y Cantidad en la misma línea
-                    m_sale_sku = re.search(r"\bSKU:\s*([0-9A-Za-z_-]+)\b", ln, flags=re.I)
-                    if m_sale_sku:
-                        current_sku = m_sale_sku.group(1)
-                    m_sale_qty = re.search(r"\bCantidad:\s*(\d+)\b", ln, flags=re.I)
-                    if m_sale_qty and current_sku:
-                        push_item(current_sku, m_sale_qty.group(1))
-                        current_sku = None
-                    continue
+            # 2) Pack ID / Venta
+            m_pack = re.search(r"\bPack\s*ID:\s*([0-9]{10,20})\b", ln, flags=re.I)
+            if m_pack:
+                ctx["pack_id"] = m_pack.group(1)
+                # a veces trae SKU en la misma línea
+                m_pack_sku = re.search(r"\bSKU:\s*([0-9A-Za-z_-]+)\b", ln, flags=re.I)
+                if m_pack_sku:
+                    current_sku = m_pack_sku.group(1)
+                continue
 
-                # 3) SKU (línea sola)
-                m_sku = re.match(r"^SKU:\s*([0-9A-Za-z_-]+)\b", ln, flags=re.I)
-                if m_sku:
-                    current_sku = m_sku.group(1)
-                    continue
+            m_sale = re.search(r"\bVenta:\s*([0-9]{10,20})\b", ln, flags=re.I)
+            if m_sale:
+                ctx["ml_order_id"] = m_sale.group(1)
+                # En algunos casos viene un SKU y Cantidad en la misma línea
+                m_sale_sku = re.search(r"\bSKU:\s*([0-9A-Za-z_-]+)\b", ln, flags=re.I)
+                if m_sale_sku:
+                    current_sku = m_sale_sku.group(1)
+                m_sale_qty = re.search(r"\bCantidad:\s*(\d+)\b", ln, flags=re.I)
+                if m_sale_qty and current_sku:
+                    push_item(current_sku, m_sale_qty.group(1))
+                    current_sku = None
+                continue
+
+            # 3) SKU (línea sola)
+            m_sku = re.match(r"^SKU:\s*([0-9A-Za-z_-]+)\b", ln, flags=re.I)
+            if m_sku:
+                current_sku = m_sku.group(1)
+                continue
+
+            # 4) Cantidad (línea sola) -> si hay current_sku, crea item
+            m_qty = re.match(r"^Cantidad:\s*(\d+)\b", ln, flags=re.I)
+            if m_qty:
+                if current_sku:
+                    push_item(current_sku, m_qty.group(1))
+                    current_sku = None
+                continue
 
-                # 4) Cantidad (línea sola) -> si hay current_sku, crea item
-                m_qty = re.match(r"^Cantidad:\s*(\d+)\b", ln, flags=re.I)
-                if m_qty:
-                    if current_sku:
-                        push_item(current_sku, m_qty.group(1))
-                        current_sku = None
+            # 5) Comprador (suele venir justo después de Venta)
+            if looks_like_name(ln):
+                # Si aún no hay buyer y ya hay venta, lo tomamos
+                if ctx.get("ml_order_id") and not ctx.get("buyer"):
+                    ctx["buyer"] = ln[:120]
                     continue
 
-                # 5) Comprador (suele venir justo después de Venta)
-                if looks_like_name(ln):
-                    # Si aún no hay buyer y ya hay venta, lo tomamos
-                    if ctx.get("ml_order_id") and not ctx.get("buyer"):
-                        ctx["buyer"] = ln[:120]
-                        continue
-
-                # 6) Guardar posible título largo como fallback
-                if len(ln) >= 18 and ":" not in ln and not re.match(r"^(Despacha|Identif|Pack\s*ID|Venta:|SKU:|Cantidad:)", ln, flags=re.I):
-                    current_title = ln[:200]
+            # 6) Guardar posible título largo como fallback
+            if len(ln) >= 18 and ":" not in ln and not re.match(r"^(Despacha|Identif|Pack\s*ID|Venta:|SKU:|Cantidad:)", ln, flags=re.I):
+                current_title = ln[:200]
 
-            pages.append({"page_no": pno, "items": items})
+        pages.append({"page_no": pno, "items": items})
 
     return pages
 
@@ -3335,90 +4999,7 @@ def _s2_now_iso():
         return datetime.now(CL_TZ).isoformat(timespec="seconds")
     return datetime.now().isoformat(timespec="seconds")
 
-def _s2_create_tables():
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("""CREATE TABLE IF NOT EXISTS s2_manifests (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        status TEXT NOT NULL DEFAULT 'ACTIVE',
-        created_at TEXT NOT NULL
-    );""")
-    c.execute("""CREATE TABLE IF NOT EXISTS s2_files (
-        manifest_id INTEGER PRIMARY KEY,
-        control_pdf BLOB,
-        labels_txt BLOB,
-        control_name TEXT,
-        labels_name TEXT,
-        updated_at TEXT NOT NULL
-    );""")
-    c.execute("""CREATE TABLE IF NOT EXISTS s2_page_assign (
-        manifest_id INTEGER NOT NULL,
-        page_no INTEGER NOT NULL,
-        mesa INTEGER NOT NULL,
-        PRIMARY KEY (manifest_id, page_no)
-    );""")
-    c.execute("""CREATE TABLE IF NOT EXISTS s2_sales (
-        manifest_id INTEGER NOT NULL,
-        sale_id TEXT NOT NULL,
-        shipment_id TEXT,
-        page_no INTEGER NOT NULL,
-        mesa INTEGER,
-        status TEXT NOT NULL DEFAULT 'NEW',
-        opened_at TEXT,
-        closed_at TEXT,
-        PRIMARY KEY (manifest_id, sale_id)
-    );""")
-    c.execute("""CREATE TABLE IF NOT EXISTS s2_items (
-        manifest_id INTEGER NOT NULL,
-        sale_id TEXT NOT NULL,
-        sku TEXT NOT NULL,
-        description TEXT,
-        qty INTEGER NOT NULL,
-        picked INTEGER NOT NULL DEFAULT 0,
-        status TEXT NOT NULL DEFAULT 'PENDING',
-        PRIMARY KEY (manifest_id, sale_id, sku)
-    );""")
-    c.execute("""CREATE TABLE IF NOT EXISTS s2_labels (
-        manifest_id INTEGER NOT NULL,
-        shipment_id TEXT NOT NULL,
-        raw TEXT,
-        PRIMARY KEY (manifest_id, shipment_id)
-    );""")
-
-    # --- Migraciones suaves (SQLite) ---
-    try:
-        cols = [r[1] for r in c.execute("PRAGMA table_info(s2_sales);").fetchall()]
-        if "pack_id" not in cols:
-            c.execute("ALTER TABLE s2_sales ADD COLUMN pack_id TEXT;")
-        if "customer" not in cols:
-            c.execute("ALTER TABLE s2_sales ADD COLUMN customer TEXT;")
-    except Exception:
-        pass
-
-    # s2_items: guardar confirm_mode para trazabilidad (ej: MANUAL_NO_EAN)
-    try:
-        cols_i = [r[1] for r in c.execute("PRAGMA table_info(s2_items);").fetchall()]
-        if "confirm_mode" not in cols_i:
-            c.execute("ALTER TABLE s2_items ADD COLUMN confirm_mode TEXT;")
-        if "updated_at" not in cols_i:
-            c.execute("ALTER TABLE s2_items ADD COLUMN updated_at TEXT;")
-    except Exception:
-        pass
-
-
-    # Mapa Pack ID -> Shipment ID (necesario para Colecta)
-    c.execute("""CREATE TABLE IF NOT EXISTS s2_pack_ship (
-        manifest_id INTEGER NOT NULL,
-        pack_id TEXT NOT NULL,
-        shipment_id TEXT NOT NULL,
-        PRIMARY KEY (manifest_id, pack_id)
-    );""")
-
-    conn.commit()
-    conn.close()
-
 def _s2_get_active_manifest_id():
-    _s2_create_tables()
     conn = get_conn()
     c = conn.cursor()
     c.execute("SELECT id FROM s2_manifests WHERE status='ACTIVE' ORDER BY id DESC LIMIT 1;")
@@ -3436,7 +5017,6 @@ def _s2_get_active_manifest_id():
 
 def _s2_manifest_files_state(mid: int) -> dict:
     """Return whether the active manifest already has Control and/or Labels loaded."""
-    _s2_create_tables()
     conn = get_conn()
     c = conn.cursor()
     row = c.execute(
@@ -3452,7 +5032,6 @@ def _s2_manifest_files_state(mid: int) -> dict:
 
 def _s2_close_manifest(mid: int):
     """Marks current manifest as DONE (archived)."""
-    _s2_create_tables()
     conn = get_conn()
     c = conn.cursor()
     c.execute("UPDATE s2_manifests SET status='DONE' WHERE id=?;", (int(mid),))
@@ -3461,7 +5040,6 @@ def _s2_close_manifest(mid: int):
 
 def _s2_create_new_manifest() -> int:
     """Creates a new ACTIVE manifest and returns its id."""
-    _s2_create_tables()
     conn = get_conn()
     c = conn.cursor()
     c.execute("INSERT INTO s2_manifests(status, created_at) VALUES('ACTIVE', ?);", (_s2_now_iso(),))
@@ -3473,28 +5051,19 @@ def _s2_create_new_manifest() -> int:
 
 def _s2_parse_label_raw_info(raw: str):
     """Extrae info visible de una etiqueta (nombre, dirección, comuna, etc.) desde el texto raw."""
-    import re
     if not raw:
         return {}
     s = str(raw).replace("\r", "\n")
     info = {}
-    m = re.search(r"Destinatario\s*:\s*(.+)", s, flags=re.IGNORECASE)
-    if m:
-        info["destinatario"] = m.group(1).strip()
-    m = re.search(r"Direccion\s*:\s*(.+)", s, flags=re.IGNORECASE)
-    if m:
-        info["direccion"] = m.group(1).strip()
-    m = re.search(r"Comuna\s*:\s*(.+)", s, flags=re.IGNORECASE)
-    if m:
-        info["comuna"] = m.group(1).strip()
-    m = re.search(r"Ciudad\s*de\s*destino\s*:\s*(.+)", s, flags=re.IGNORECASE)
-    if m:
-        info["ciudad_destino"] = m.group(1).strip()
-    m = re.search(r"Domicilio\s*:\s*(.+)", s, flags=re.IGNORECASE)
+    for key, rx in S2_LABEL_INFO_RES:
+        m = rx.search(s)
+        if m:
+            info[key] = m.group(1).strip()
+    m = S2_LABEL_DOMICILIO_RE.search(s)
     if m and "direccion" not in info:
         info["direccion"] = m.group(1).strip()
     if "destinatario" not in info:
-        m = re.search(r"^\s*([A-ZÁÉÍÓÚÑ][^\n]{3,60})\s*\(([^\n]{2,30})\)\s*$", s, flags=re.M)
+        m = S2_LABEL_NAME_LINE_RE.search(s)
         if m:
             info["destinatario"] = m.group(1).strip()
     return info
@@ -3506,6 +5075,36 @@ def _s2_get_label_raw(mid:int, shipment_id:str):
     conn.close()
     return row[0] if row else ""
 
+# (manifest_id, shipment_id) -> info parseada de la etiqueta. Se limpia al recargar etiquetas.
+_S2_LABEL_INFO_CACHE = {}
+S2_LABEL_INFO_CACHE_MAX = 5000
+
+def _s2_label_info(mid:int, shipment_id:str, c=None) -> dict:
+    """_s2_parse_label_raw_info de la etiqueta del envío, memoizado por shipment_id.
+    No modificar el dict devuelto (es compartido)."""
+    if not shipment_id:
+        return {}
+    key = (int(mid), str(shipment_id))
+    info = _S2_LABEL_INFO_CACHE.get(key)
+    if info is None:
+        if c is None:
+            raw = _s2_get_label_raw(mid, shipment_id)
+        else:
+            row = c.execute("SELECT raw FROM s2_labels WHERE manifest_id=? AND shipment_id=?;", key).fetchone()
+            raw = row[0] if row else ""
+        info = _s2_parse_label_raw_info(raw)
+        if len(_S2_LABEL_INFO_CACHE) >= S2_LABEL_INFO_CACHE_MAX:
+            _S2_LABEL_INFO_CACHE.clear()
+        _S2_LABEL_INFO_CACHE[key] = info
+    return info
+
+def _s2_label_info_invalidate(mid:int = None):
+    if mid is None:
+        _S2_LABEL_INFO_CACHE.clear()
+        return
+    for key in [k for k in _S2_LABEL_INFO_CACHE if k[0] == int(mid)]:
+        _S2_LABEL_INFO_CACHE.pop(key, None)
+
 def _s2_extract_shipment_id(scan_raw: str):
     """Lee el identificador desde el escaneo de etiqueta.
 
@@ -3515,7 +5114,6 @@ def _s2_extract_shipment_id(scan_raw: str):
 
     Devuelve el mejor candidato numérico (string) o None.
     """
-    import re, json
     if not scan_raw:
         return None
     s = str(scan_raw).strip()
@@ -3525,13 +5123,13 @@ def _s2_extract_shipment_id(scan_raw: str):
         try:
             obj = json.loads(s)
             sid = obj.get("id")
-            if sid and re.fullmatch(r"\d{8,20}", str(sid)):
+            if sid and S2_SCAN_JSON_ID_RE.fullmatch(str(sid)):
                 return str(sid)
         except Exception:
             pass
 
     # 2) Números: extraer todos los grupos (incluye prefijos tipo >: )
-    nums = re.findall(r"(\d{6,20})", s)
+    nums = S2_SCAN_NUM_RE.findall(s)
     if not nums:
         return None
 
@@ -3547,8 +5145,32 @@ def _s2_extract_shipment_id(scan_raw: str):
 
 
 
-def _s2_parse_control_pdf(pdf_bytes: bytes):
-    """Parse Control.pdf (Flex/Colecta) into sales with items.
+def _s2_classify_control_line(ln: str) -> dict:
+    """Etiqueta una línea (ya strip) del Control en una sola pasada de S2_CTRL_LINE_RE.
+
+    Devuelve {ship, pack, sale, qty: primer match de cada uno (qty como int);
+    sku: lista de SKUs en orden; name: bool, la línea parece un nombre de cliente}.
+    """
+    tags = {"sku": []}
+    for m in S2_CTRL_LINE_RE.finditer(ln):
+        kind = m.lastgroup
+        if kind == "sku":
+            tags["sku"].append(m.group(kind))
+        elif kind not in tags:
+            tags[kind] = m.group(kind)
+    if "qty" in tags:
+        tags["qty"] = int(tags["qty"])
+    tags["name"] = bool(ln) and len(ln) <= 70 and "attr" not in tags and NAME_LETTER_RE.search(ln) is not None
+    return tags
+
+
+def _s2_parse_control_pdf(pdf_bytes: bytes, max_workers: int = None):
+    """Parse Control.pdf (Flex/Colecta) into sales with items (ver _s2_parse_control_texts)."""
+    return _s2_parse_control_texts(pdf_extract_page_texts(pdf_bytes, max_workers=max_workers))
+
+
+def _s2_parse_control_texts(page_texts: list):
+    """Parse the page texts of Control.pdf (Flex/Colecta) into sales with items.
 
     Importante (Colecta): el Control a veces NO trae shipment_id al inicio de línea.
     Por eso este parser NO exige shipment_id para contar ventas; lo completa luego
@@ -3558,36 +5180,13 @@ def _s2_parse_control_pdf(pdf_bytes: bytes):
       {page_no:int, shipment_id:str|None, sale_id:str, pack_id:str|None, customer:str|None,
        items:[{sku:str, qty:int}]}
     """
-    import io, re, pdfplumber
-
-    def ship_from_line(s: str):
-        # Flex suele venir como número al inicio (p.ej. 4636...)
-        m = re.match(r"^(46\d{8,13})\b", (s or "").strip())  # evita capturar códigos no-shipment (ej: 30119784...)
-        return m.group(1) if m else None
-
-    def sale_from_line(s: str):
-        m = re.search(r"\bVenta\s*:\s*(\d{10,20})\b", s or "", flags=re.IGNORECASE)
-        return m.group(1) if m else None
-
-    def pack_from_line(s: str):
-        m = re.search(r"\bPack\s*ID\s*:\s*(\d{10,20})\b", s or "", flags=re.IGNORECASE)
-        return m.group(1) if m else None
-
-    def skus_from_line(s: str):
-        # SKU puede venir con guiones/letras en algunos casos internos, pero en Control suele ser numérico
-        return re.findall(r"\bSKU\s*:\s*([0-9A-Za-z_-]{6,20})\b", s or "", flags=re.IGNORECASE)
-
-    def qty_from_line(s: str):
-        m = re.search(r"\bCantidad\s*:\s*(\d+)\b", s or "", flags=re.IGNORECASE)
-        return int(m.group(1)) if m else None
-
     def looks_like_name(s: str):
         s = (s or "").strip()
         if not s or len(s) > 70:
             return False
-        if re.search(r"\b(color|acabado|modelo|di[aá]metro|voltaje|dise[nñ]o|tipo)\b\s*:", s, flags=re.I):
+        if NAME_ATTR_RE.search(s):
             return False
-        return bool(re.search(r"[A-Za-zÁÉÍÓÚÜÑáéíóúüñ]", s))
+        return bool(NAME_LETTER_RE.search(s))
 
     sales = []
     cur = {"page_no": None, "shipment_id": None, "sale_id": None, "pack_id": None, "customer": None, "items": []}
@@ -3601,76 +5200,101 @@ def _s2_parse_control_pdf(pdf_bytes: bytes):
         cur = {"page_no": None, "shipment_id": None, "sale_id": None, "pack_id": None, "customer": None, "items": []}
         sku_queue = []
 
-    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
-        for pidx, page in enumerate(pdf.pages, start=1):
-            text = page.extract_text() or ""
-            lines = [ln.strip() for ln in text.splitlines() if ln and ln.strip()]
-            for ln in lines:
-                low = ln.lower()
-                if low.startswith("despacha ") or low.startswith("identifi"):
-                    continue
-
-                # Flex shipment id en línea
-                ship = ship_from_line(ln)
-                if ship:
-                    if cur.get("shipment_id") and ship != cur.get("shipment_id") and cur.get("sale_id"):
-                        flush()
-                    if not cur.get("shipment_id"):
-                        cur["shipment_id"] = ship
-                        if not cur.get("page_no"):
-                            cur["page_no"] = pidx
-
-                # Pack ID (ojo: en Colecta a veces Pack+SKU viene ANTES de "Venta:",
-                # así que si aparece un Pack ID nuevo y ya tenemos una venta completa, hacemos flush aquí)
-                pid = pack_from_line(ln)
-                if pid:
-                    if cur.get("sale_id") and cur.get("items"):
-                        if (cur.get("pack_id") and pid != cur.get("pack_id")) or (cur.get("pack_id") is None):
-                            flush()
-                    cur["pack_id"] = pid
-                    if not cur.get("page_no"):
-                        cur["page_no"] = pidx
+    for pidx, text in enumerate(page_texts, start=1):
+        lines = [ln.strip() for ln in text.splitlines() if ln and ln.strip()]
+        for ln in lines:
+            low = ln.lower()
+            if low.startswith("despacha ") or low.startswith("identifi"):
+                continue
 
+            tags = _s2_classify_control_line(ln)
 
-                # Venta (si cambia, flush)
-                sid = sale_from_line(ln)
-                if sid:
-                    if cur.get("sale_id") and sid != cur.get("sale_id") and cur.get("items"):
-                        flush()
-                    cur["sale_id"] = sid
+            # Flex shipment id en línea
+            ship = tags.get("ship")
+            if ship:
+                if cur.get("shipment_id") and ship != cur.get("shipment_id") and cur.get("sale_id"):
+                    flush()
+                if not cur.get("shipment_id"):
+                    cur["shipment_id"] = ship
                     if not cur.get("page_no"):
                         cur["page_no"] = pidx
 
-                # SKU en línea
-                skus = skus_from_line(ln)
-                if skus:
-                    sku_queue.extend(skus)
-
-                # Cantidad: asigna a primer SKU pendiente
-                q = qty_from_line(ln)
-                if q is not None:
-                    # cliente a veces viene junto a Cantidad
-                    if cur.get("sale_id") and not cur.get("customer") and ("venta" not in low) and ("pack" not in low):
-                        pre = re.split(r"Cantidad\s*:", ln, flags=re.IGNORECASE)[0].strip()
-                        pre = re.sub(r"\bSKU\s*:\s*[0-9A-Za-z_-]{6,20}\b", "", pre, flags=re.IGNORECASE).strip()
-                        pre = re.sub(r"^\d{8,15}\b", "", pre).strip()
-                        if pre and len(pre) <= 70 and looks_like_name(pre):
-                            cur["customer"] = pre
-
-                    if sku_queue:
-                        sku = sku_queue.pop(0)
-                        cur["items"].append({"sku": sku, "qty": int(q)})
-                else:
-                    # nombre en línea sola después de Venta
-                    if cur.get("sale_id") and not cur.get("customer") and looks_like_name(ln):
-                        cur["customer"] = ln[:70]
+            # Pack ID (ojo: en Colecta a veces Pack+SKU viene ANTES de "Venta:",
+            # así que si aparece un Pack ID nuevo y ya tenemos una venta completa, hacemos flush aquí)
+            pid = tags.get("pack")
+            if pid:
+                if cur.get("sale_id") and cur.get("items"):
+                    if (cur.get("pack_id") and pid != cur.get("pack_id")) or (cur.get("pack_id") is None):
+                        flush()
+                cur["pack_id"] = pid
+                if not cur.get("page_no"):
+                    cur["page_no"] = pidx
+
+
+            # Venta (si cambia, flush)
+            sid = tags.get("sale")
+            if sid:
+                if cur.get("sale_id") and sid != cur.get("sale_id") and cur.get("items"):
+                    flush()
+                cur["sale_id"] = sid
+                if not cur.get("page_no"):
+                    cur["page_no"] = pidx
+
+            # SKU en línea
+            skus = tags["sku"]
+            if skus:
+                sku_queue.extend(skus)
+
+            # Cantidad: asigna a primer SKU pendiente
+            q = tags.get("qty")
+            if q is not None:
+                # cliente a veces viene junto a Cantidad
+                if cur.get("sale_id") and not cur.get("customer") and ("venta" not in low) and ("pack" not in low):
+                    pre = S2_CTRL_QTY_LABEL_RE.split(ln, 1)[0].strip()
+                    pre = S2_CTRL_SKU_TOKEN_RE.sub("", pre).strip()
+                    pre = S2_CTRL_LEAD_NUM_RE.sub("", pre).strip()
+                    if pre and len(pre) <= 70 and looks_like_name(pre):
+                        cur["customer"] = pre
+
+                if sku_queue:
+                    sku = sku_queue.pop(0)
+                    cur["items"].append({"sku": sku, "qty": int(q)})
+            else:
+                # nombre en línea sola después de Venta
+                if cur.get("sale_id") and not cur.get("customer") and tags["name"]:
+                    cur["customer"] = ln[:70]
 
     flush()
     return sales
 
-def _s2_parse_labels_txt(raw_bytes: bytes):
+def _s2_label_split_id(kind: str, text: str):
+    """Pack/Venta ID de una etiqueta, completo o partido en dos ^FD.
+
+    kind: 'pack' o 'venta'; text: los ^FD unidos por "\x00" y en minúsculas (más rápido que re.I).
+
+    - Completo:  kind ID: 2000011363....
+    - Partido:   ^FDkind ID: 20000^FS + siguiente ^FD que sea solo dígitos -> 2000011363....
+    """
+    full_re, head_re = S2_LABEL_SPLIT_RES[kind]
+    m = full_re.search(text)
+    if m:
+        return NON_DIGIT_RE.sub("", m.group(1))
+
+    m = head_re.search(text)
+    if m:
+        tm = S2_LABEL_TAIL_RE.search(text, m.end() - 1)
+        if tm:
+            cand = m.group(1) + NON_DIGIT_RE.sub("", tm.group(1))
+            if 10 <= len(cand) <= 20:
+                return cand
+    return None
+
+def _s2_parse_labels_txt(raw_bytes):
     """Parsea etiquetas TXT/ZPL de Flex y Colecta.
 
+    raw_bytes puede ser bytes, str, un archivo abierto o un iterable de trozos: se
+    recorre en streaming con zpl_iter_labels (una pasada, sin partir el archivo entero).
+
     Devuelve:
       - pack_to_ship: dict {pack_id(str) -> shipment_id(str)}
       - sale_to_ship: dict {sale_id(str) -> shipment_id(str)}  (fallback cuando no hay Pack ID en Control)
@@ -3680,69 +5304,30 @@ def _s2_parse_labels_txt(raw_bytes: bytes):
         ^FDPack ID: 20000^FS  y luego ^FD1128....^FS  -> 200001128....
         ^FDVenta: 20000^FS    y luego ^FD1498....^FS  -> 200001498....
     """
-    import re
-
-    try:
-        txt = raw_bytes.decode("utf-8", errors="ignore")
-    except Exception:
-        txt = str(raw_bytes)
-
-    # separar etiquetas por bloque ^XA ... ^XZ
-    blocks = re.split(r"\^XA", txt)
     pack_to_ship = {}
     sale_to_ship = {}
     shipment_ids = set()
 
-    def clean_num(s):
-        return re.sub(r"\D", "", s or "")
-
-    def rebuild_split_id(kind: str, b: str):
-        """
-        kind: 'Pack' o 'Venta'
-        Busca:
-          - Completo:  kind ID: 2000011363....
-          - Partido:   kind ID: 20000  + siguiente ^FD 11363....
-        """
-        kind_re = kind
-        full = None
-
-        m_full = re.search(rf"{kind_re}\s*(?:ID)?\s*:\s*(\d{{10,20}})", b, flags=re.I)
-        if m_full:
-            full = clean_num(m_full.group(1))
-
-        if not full:
-            m_part = re.search(rf"{kind_re}\s*(?:ID)?\s*:\s*(\d{{4,10}})\s*\^FS", b, flags=re.I)
-            if m_part:
-                head = clean_num(m_part.group(1))
-                tailm = re.search(r"\^FD\s*([0-9 ]{6,20})\s*\^FS", b[m_part.end():])
-                if tailm:
-                    tail = clean_num(tailm.group(1))
-                    cand = head + tail
-                    if 10 <= len(cand) <= 20:
-                        full = cand
-        return full
-
-    for b in blocks:
-        if not b.strip():
-            continue
-
-        pack_full = rebuild_split_id("Pack", b)
-        sale_full = rebuild_split_id("Venta", b)
+    for label in zpl_iter_labels(raw_bytes):
+        text = "\x00" + "\x00".join(f[0] for f in label["fields"]) + "\x00"
 
         # shipment id: preferir JSON con "id":"4638..."
         ship = None
-        jm = re.search(r"\"id\"\s*:\s*\"(\d{8,15})\"", b)
+        jm = S2_LABEL_JSON_ID_RE.search(text)
         if jm:
             ship = jm.group(1)
 
         if not ship:
             # buscar números candidatos, priorizando 10-15 dígitos y que empiecen por 46
-            nums = re.findall(r"\b\d{10,15}\b", b)
+            nums = S2_LABEL_NUM_RE.findall(text)
             if nums:
                 nums_sorted = sorted(nums, key=lambda x: (0 if x.startswith("46") else 1, -len(x)))
                 ship = nums_sorted[0]
 
         if ship:
+            low = text.lower()
+            pack_full = _s2_label_split_id("pack", low)
+            sale_full = _s2_label_split_id("venta", low)
             shipment_ids.add(ship)
             if pack_full:
                 pack_to_ship[str(pack_full)] = str(ship)
@@ -3751,17 +5336,72 @@ def _s2_parse_labels_txt(raw_bytes: bytes):
 
     return pack_to_ship, sale_to_ship, sorted(shipment_ids)
 
+# Subir estas versiones cuando cambie la salida del parser (invalida s2_parse_cache)
+S2_CONTROL_PARSER_VERSION = "1"
+S2_LABELS_PARSER_VERSION = "1"
+S2_PARSE_CACHE_MAX_ROWS = 40  # por tipo (control / labels); se borran los más antiguos
+
+
+def _s2_sha256(data: bytes) -> str:
+    return hashlib.sha256(data or b"").hexdigest()
+
+
+def _s2_parse_cached(kind: str, version: str, data: bytes, parse_fn, digest: str = None):
+    """Resultado del parser desde s2_parse_cache (sha256 + versión); si no está, parsea y guarda (JSON)."""
+    digest = digest or _s2_sha256(data)
+    conn = get_conn()
+    c = conn.cursor()
+    row = c.execute(
+        "SELECT payload FROM s2_parse_cache WHERE digest=? AND kind=? AND parser_version=?;",
+        (digest, kind, version),
+    ).fetchone()
+    if row:
+        conn.close()
+        return json.loads(row[0])
+    result = parse_fn(data)
+    c.execute(
+        "INSERT OR REPLACE INTO s2_parse_cache(digest, kind, parser_version, payload, created_at) VALUES(?,?,?,?,?);",
+        (digest, kind, version, json.dumps(result, ensure_ascii=False), _s2_now_iso()),
+    )
+    _s2_parse_cache_prune(c, kind, version)
+    conn.commit()
+    conn.close()
+    return result
+
+
+def _s2_parse_cache_prune(c, kind: str, version: str, keep: int = S2_PARSE_CACHE_MAX_ROWS):
+    """Borra de s2_parse_cache las filas de otra versión del parser y deja solo las `keep` más nuevas del tipo."""
+    c.execute("DELETE FROM s2_parse_cache WHERE kind=? AND parser_version<>?;", (kind, version))
+    c.execute(
+        """DELETE FROM s2_parse_cache WHERE kind=? AND rowid NOT IN (
+               SELECT rowid FROM s2_parse_cache WHERE kind=? ORDER BY created_at DESC, rowid DESC LIMIT ?
+           );""",
+        (kind, kind, int(keep)),
+    )
+
+
+def _s2_file_is_current(mid: int, kind: str, digest: str) -> bool:
+    """True si ese mismo archivo (por sha256) ya está cargado en el manifiesto."""
+    col = "control_sha" if kind == "control" else "labels_sha"
+    conn = get_conn()
+    row = conn.execute(f"SELECT {col} FROM s2_files WHERE manifest_id=?;", (mid,)).fetchone()
+    conn.close()
+    return bool(row and row[0] and row[0] == digest)
+
+
 def _s2_upsert_control(mid: int, pdf_name: str, pdf_bytes: bytes):
-    pages_sales = _s2_parse_control_pdf(pdf_bytes)
+    digest = _s2_sha256(pdf_bytes)
+    pages_sales = _s2_parse_cached("control", S2_CONTROL_PARSER_VERSION, pdf_bytes, _s2_parse_control_pdf, digest)
     conn = get_conn()
     c = conn.cursor()
     # store file
-    c.execute("""INSERT INTO s2_files(manifest_id, control_pdf, control_name, updated_at)
-                 VALUES(?, ?, ?, ?)
+    c.execute("""INSERT INTO s2_files(manifest_id, control_pdf, control_name, control_sha, updated_at)
+                 VALUES(?, ?, ?, ?, ?)
                  ON CONFLICT(manifest_id) DO UPDATE SET
                     control_pdf=excluded.control_pdf,
                     control_name=excluded.control_name,
-                    updated_at=excluded.updated_at;""", (mid, pdf_bytes, pdf_name, _s2_now_iso()))
+                    control_sha=excluded.control_sha,
+                    updated_at=excluded.updated_at;""", (mid, pdf_bytes, pdf_name, digest, _s2_now_iso()))
     # clear previous parsed sales/items
     c.execute("DELETE FROM s2_items WHERE manifest_id=?;", (mid,))
     c.execute("DELETE FROM s2_sales WHERE manifest_id=?;", (mid,))
@@ -3813,25 +5453,31 @@ def _s2_upsert_control(mid: int, pdf_name: str, pdf_bytes: bytes):
 
 
 def _s2_upsert_labels(mid: int, labels_name: str, labels_bytes: bytes):
-    pack_to_ship, sale_to_ship, shipment_ids = _s2_parse_labels_txt(labels_bytes)
+    digest = _s2_sha256(labels_bytes)
+    pack_to_ship, sale_to_ship, shipment_ids = _s2_parse_cached(
+        "labels", S2_LABELS_PARSER_VERSION, labels_bytes, _s2_parse_labels_txt, digest
+    )
     conn = get_conn()
     c = conn.cursor()
-    c.execute("""INSERT INTO s2_files(manifest_id, labels_txt, labels_name, updated_at)
-                 VALUES(?, ?, ?, ?)
+    c.execute("""INSERT INTO s2_files(manifest_id, labels_txt, labels_name, labels_sha, updated_at)
+                 VALUES(?, ?, ?, ?, ?)
                  ON CONFLICT(manifest_id) DO UPDATE SET
                     labels_txt=excluded.labels_txt,
                     labels_name=excluded.labels_name,
-                    updated_at=excluded.updated_at;""", (mid, labels_bytes, labels_name, _s2_now_iso()))
+                    labels_sha=excluded.labels_sha,
+                    updated_at=excluded.updated_at;""", (mid, labels_bytes, labels_name, digest, _s2_now_iso()))
 
     # limpiar y reinsertar shipment ids
     c.execute("DELETE FROM s2_labels WHERE manifest_id=?;", (mid,))
     for sid in shipment_ids:
-        c.execute("INSERT OR REPLACE INTO s2_labels(manifest_id, shipment_id, raw) VALUES(?,?,NULL);", (mid, str(sid)))
+        c.execute("""INSERT INTO s2_labels(manifest_id, shipment_id, raw) VALUES(?,?,NULL)
+                     ON CONFLICT(manifest_id, shipment_id) DO UPDATE SET raw=excluded.raw;""", (mid, str(sid)))
 
     # guardar pack->ship para Colecta
     if pack_to_ship:
         for pack_id, ship_id in pack_to_ship.items():
-            c.execute("INSERT OR REPLACE INTO s2_pack_ship(manifest_id, pack_id, shipment_id) VALUES(?,?,?);",
+            c.execute("""INSERT INTO s2_pack_ship(manifest_id, pack_id, shipment_id) VALUES(?,?,?)
+                         ON CONFLICT(manifest_id, pack_id) DO UPDATE SET shipment_id=excluded.shipment_id;""",
                       (mid, str(pack_id), str(ship_id)))
 
         # completar shipment_id en ventas usando pack_id si falta
@@ -3858,108 +5504,111 @@ def _s2_upsert_labels(mid: int, labels_name: str, labels_bytes: bytes):
 
     conn.commit()
     conn.close()
+    _s2_label_info_invalidate(mid)
     return len(shipment_ids)
 
-def _s2_get_stats(mid: int):
+# True: _s2_get_stats lee s2_manifest_stats (una fila, mantenida por triggers).
+# False: cuenta en cada llamada con una consulta agregada por tabla.
+S2_STATS_MATERIALIZED = True
+
+def _s2_stats_counts(c, mid: int = None) -> dict:
+    """Contadores de S2_STATS_COUNTERS por manifiesto ({mid: {contador: n}}), con UNA consulta
+    de agregación condicional por tabla. mid=None: todos los manifiestos."""
+    out = {}
+    for table, (_watch, counters) in S2_STATS_COUNTERS.items():
+        aggs = []
+        for name, expr, key in counters:
+            e = expr.format(r=table)
+            if key:
+                aggs.append(f"COUNT(DISTINCT CASE WHEN {e} THEN {key} END)")
+            elif expr == "1":
+                aggs.append("COUNT(*)")
+            else:
+                aggs.append(f"COALESCE(SUM({e}), 0)")
+        where = "WHERE manifest_id=?" if mid is not None else ""
+        params = (mid,) if mid is not None else ()
+        rows = c.execute(
+            f"SELECT manifest_id, {', '.join(aggs)} FROM {table} {where} GROUP BY manifest_id;", params
+        ).fetchall()
+        for row in rows:
+            d = out.setdefault(int(row[0]), dict.fromkeys(S2_STATS_NAMES, 0))
+            for (name, _e, _k), v in zip(counters, row[1:]):
+                d[name] = int(v or 0)
+    return out
+
+def _s2_stats_rebuild(c, mid: int = None) -> dict:
+    """Recalcula s2_manifest_stats desde las tablas (un manifiesto o todos). No hace commit."""
+    counts = _s2_stats_counts(c, mid)
+    if mid is None:
+        c.execute("DELETE FROM s2_manifest_stats;")
+    else:
+        c.execute("DELETE FROM s2_manifest_stats WHERE manifest_id=?;", (mid,))
+        counts.setdefault(int(mid), dict.fromkeys(S2_STATS_NAMES, 0))
+    cols = ", ".join(S2_STATS_NAMES)
+    ph = ",".join(["?"] * (len(S2_STATS_NAMES) + 1))
+    c.executemany(
+        f"INSERT INTO s2_manifest_stats(manifest_id, {cols}) VALUES ({ph});",
+        [(m, *(d[n] for n in S2_STATS_NAMES)) for m, d in counts.items()],
+    )
+    return counts
+
+def _s2_get_stats(mid: int, fresh: bool = False):
     """
     Stats del manifiesto (Sorting v2).
     Incluye aliases para UI: ventas/items/etiquetas/... para evitar KeyError.
     Tolerante a cambios de esquema.
+
+    Con S2_STATS_MATERIALIZED lee la fila de s2_manifest_stats; fresh=True recuenta desde las
+    tablas (y corrige la fila).
     """
     conn = get_conn()
     c = conn.cursor()
 
-    def has_col(table: str, col: str) -> bool:
-        try:
-            cols = [r[1] for r in c.execute(f"PRAGMA table_info({table});").fetchall()]
-            return col in cols
-        except Exception:
-            return False
-
-    stats = {}
-
-    # Core counts
-    sales_total = int(c.execute("SELECT COUNT(*) FROM s2_sales WHERE manifest_id=?;", (mid,)).fetchone()[0] or 0)
-    items_total = int(c.execute("SELECT COUNT(*) FROM s2_items WHERE manifest_id=?;", (mid,)).fetchone()[0] or 0)
-    labels_total = int(c.execute("SELECT COUNT(*) FROM s2_labels WHERE manifest_id=?;", (mid,)).fetchone()[0] or 0)
-
-    sales_pending = int(c.execute("SELECT COUNT(*) FROM s2_sales WHERE manifest_id=? AND status='PENDING';", (mid,)).fetchone()[0] or 0)
-    sales_done    = int(c.execute("SELECT COUNT(*) FROM s2_sales WHERE manifest_id=? AND status='DONE';", (mid,)).fetchone()[0] or 0)
-
-    items_pending = int(c.execute("SELECT COUNT(*) FROM s2_items WHERE manifest_id=? AND status='PENDING';", (mid,)).fetchone()[0] or 0)
-    items_done    = int(c.execute("SELECT COUNT(*) FROM s2_items WHERE manifest_id=? AND status='DONE';", (mid,)).fetchone()[0] or 0)
-    items_incid   = int(c.execute("SELECT COUNT(*) FROM s2_items WHERE manifest_id=? AND status='INCIDENCE';", (mid,)).fetchone()[0] or 0)
-
-    # Labels with shipment_id
-    if has_col("s2_labels", "shipment_id"):
-        labels_with_ship = int(c.execute(
-            "SELECT COUNT(*) FROM s2_labels WHERE manifest_id=? AND shipment_id IS NOT NULL AND shipment_id!='';",
-            (mid,)
-        ).fetchone()[0] or 0)
-        distinct_ship_labels = int(c.execute(
-            "SELECT COUNT(DISTINCT shipment_id) FROM s2_labels WHERE manifest_id=? AND shipment_id IS NOT NULL AND shipment_id!='';",
-            (mid,)
-        ).fetchone()[0] or 0)
+    if S2_STATS_MATERIALIZED and fresh:
+        counts = _s2_stats_rebuild(c, mid)[int(mid)]
+        conn.commit()
+    elif S2_STATS_MATERIALIZED:
+        row = c.execute(
+            f"SELECT {', '.join(S2_STATS_NAMES)} FROM s2_manifest_stats WHERE manifest_id=?;", (mid,)
+        ).fetchone()
+        counts = dict(zip(S2_STATS_NAMES, row)) if row else dict.fromkeys(S2_STATS_NAMES, 0)
     else:
-        labels_with_ship = 0
-        distinct_ship_labels = 0
-
-    # Pack ID availability
-    # In control, pack_id usually lives in s2_sales.pack_id (not in labels).
-    sales_with_pack = 0
-    distinct_packs = 0
-    if has_col("s2_sales", "pack_id"):
-        sales_with_pack = int(c.execute(
-            "SELECT COUNT(*) FROM s2_sales WHERE manifest_id=? AND pack_id IS NOT NULL AND pack_id!='';",
-            (mid,)
-        ).fetchone()[0] or 0)
-        distinct_packs = int(c.execute(
-            "SELECT COUNT(DISTINCT pack_id) FROM s2_sales WHERE manifest_id=? AND pack_id IS NOT NULL AND pack_id!='';",
-            (mid,)
-        ).fetchone()[0] or 0)
+        counts = _s2_stats_counts(c, mid).get(int(mid)) or dict.fromkeys(S2_STATS_NAMES, 0)
 
+    # Pack/Venta en etiquetas: solo si el esquema trae esas columnas
     labels_with_pack = 0
-    if has_col("s2_labels", "pack_id"):
-        labels_with_pack = int(c.execute(
-            "SELECT COUNT(*) FROM s2_labels WHERE manifest_id=? AND pack_id IS NOT NULL AND pack_id!='';",
-            (mid,)
-        ).fetchone()[0] or 0)
-
     labels_with_sale = 0
-    if has_col("s2_labels", "sale_id"):
-        labels_with_sale = int(c.execute(
-            "SELECT COUNT(*) FROM s2_labels WHERE manifest_id=? AND sale_id IS NOT NULL AND sale_id!='';",
-            (mid,)
-        ).fetchone()[0] or 0)
-
-    # Sales with shipment_id (after matching)
-    if has_col("s2_sales", "shipment_id"):
-        sales_with_ship = int(c.execute(
-            "SELECT COUNT(*) FROM s2_sales WHERE manifest_id=? AND shipment_id IS NOT NULL AND shipment_id!='';",
-            (mid,)
-        ).fetchone()[0] or 0)
-    else:
-        sales_with_ship = 0
+    label_cols = _db_schema_cols(c, "s2_labels")
+    if "pack_id" in label_cols or "sale_id" in label_cols:
+        pack_expr = "COALESCE(SUM(COALESCE(pack_id,'')!=''), 0)" if "pack_id" in label_cols else "0"
+        sale_expr = "COALESCE(SUM(COALESCE(sale_id,'')!=''), 0)" if "sale_id" in label_cols else "0"
+        labels_with_pack, labels_with_sale = c.execute(
+            f"SELECT {pack_expr}, {sale_expr} FROM s2_labels WHERE manifest_id=?;", (mid,)
+        ).fetchone()
+    conn.close()
 
+    sales_total = int(counts["sales_total"])
+    sales_with_pack = int(counts["sales_with_pack"])
+    sales_with_ship = int(counts["sales_with_ship"])
+    distinct_packs = int(counts["distinct_packs"])
+    items_total = int(counts["items_total"])
+    labels_total = int(counts["labels_total"])
+    labels_with_ship = int(counts["labels_with_ship"])
+    # shipment_id es parte de la PK de s2_labels: con envío == envíos distintos
+    distinct_ship_labels = labels_with_ship
+    matched_by_pack = int(counts["matched_by_pack"])
     missing_ship = sales_total - sales_with_ship
 
-    # Matches by pack (if mapping table exists)
-    matched_by_pack = 0
-    if "s2_pack_ship" in [r[0] for r in c.execute("SELECT name FROM sqlite_master WHERE type='table';").fetchall()]:
-        matched_by_pack = int(c.execute(
-            "SELECT COUNT(DISTINCT pack_id) FROM s2_pack_ship WHERE manifest_id=? AND pack_id IS NOT NULL AND pack_id!='' AND shipment_id IS NOT NULL AND shipment_id!='';",
-            (mid,)
-        ).fetchone()[0] or 0)
-
+    stats = {}
     # Fill canonical keys
     stats.update({
         "sales_total": sales_total,
-        "sales_pending": sales_pending,
-        "sales_done": sales_done,
+        "sales_pending": int(counts["sales_pending"]),
+        "sales_done": int(counts["sales_done"]),
         "items_total": items_total,
-        "items_pending": items_pending,
-        "items_done": items_done,
-        "items_incidence": items_incid,
+        "items_pending": int(counts["items_pending"]),
+        "items_done": int(counts["items_done"]),
+        "items_incidence": int(counts["items_incidence"]),
         "labels_total": labels_total,
         "labels_with_ship": labels_with_ship,
         "labels_unique_ship": distinct_ship_labels,
@@ -3967,8 +5616,8 @@ def _s2_get_stats(mid: int):
         "distinct_packs": distinct_packs,
         "sales_with_ship": sales_with_ship,
         "sales_missing_ship": missing_ship,
-        "labels_with_pack": labels_with_pack,
-        "labels_with_sale": labels_with_sale,
+        "labels_with_pack": int(labels_with_pack or 0),
+        "labels_with_sale": int(labels_with_sale or 0),
         "matched_by_pack": matched_by_pack,
     })
 
@@ -3983,8 +5632,6 @@ def _s2_get_stats(mid: int):
         "missing_ship": missing_ship,
         "matched_by_pack": matched_by_pack,
     })
-
-    conn.close()
     return stats
 
 def _s2_reset_all_sorting():
@@ -3993,6 +5640,7 @@ def _s2_reset_all_sorting():
     c = conn.cursor()
     # New (s2_*) tables
     s2_tables = [
+        "s2_manifest_stats",
         "s2_page_assign",
         "s2_pack_ship",
         "s2_labels",
@@ -4000,6 +5648,7 @@ def _s2_reset_all_sorting():
         "s2_sales",
         "s2_files",
         "s2_manifests",
+        "s2_parse_cache",
     ]
     for t in s2_tables:
         c.execute(f"DELETE FROM {t};")
@@ -4019,6 +5668,8 @@ def _s2_reset_all_sorting():
             pass
 
     conn.commit()
+    conn.close()
+    _s2_label_info_invalidate()
 
 
 def _s2_get_pages(mid:int):
@@ -4029,20 +5680,166 @@ def _s2_get_pages(mid:int):
     conn.close()
     return pages
 
-def _s2_auto_assign_pages(mid:int, num_mesas:int=10):
-    pages=_s2_get_pages(mid)
-    if not pages:
+# Planificador Página -> Mesa (sorting v2). Carga de una página = ventas * S2_EFFORT_PER_SALE
+# + líneas (SKU por venta) * S2_EFFORT_PER_LINE + unidades * S2_EFFORT_PER_UNIT.
+S2_DEFAULT_MESAS = 10
+S2_EFFORT_PER_SALE = 1.0     # escanear etiqueta + cerrar venta
+S2_EFFORT_PER_LINE = 1.0     # escanear un producto
+S2_EFFORT_PER_UNIT = 1.0
+DEFAULT_S2_MESA_STRATEGY = "AUTO"
+# AUTO usa bloques contiguos si su mesa más cargada queda dentro de este margen sobre LPT
+S2_CONTIGUOUS_TOLERANCE = 0.05
+
+def _s2_page_loads(mid:int) -> list:
+    """[(page_no, ventas, líneas, unidades)] por página, en orden de página."""
+    conn=get_conn()
+    c=conn.cursor()
+    c.execute("""SELECT s.page_no, COUNT(DISTINCT s.sale_id), COUNT(i.sku), COALESCE(SUM(i.qty), 0)
+                 FROM s2_sales s
+                 LEFT JOIN s2_items i ON i.manifest_id=s.manifest_id AND i.sale_id=s.sale_id
+                 WHERE s.manifest_id=?
+                 GROUP BY s.page_no
+                 ORDER BY s.page_no;""", (mid,))
+    rows=[(int(p), int(ns), int(nl), int(nu)) for p, ns, nl, nu in c.fetchall()]
+    conn.close()
+    return rows
+
+def _s2_page_effort(load) -> float:
+    _, sales, lines, units = load
+    return sales * S2_EFFORT_PER_SALE + lines * S2_EFFORT_PER_LINE + units * S2_EFFORT_PER_UNIT
+
+def _s2_assign_round_robin(weights: list, k: int) -> list:
+    return [i % k for i in range(len(weights))]
+
+def _s2_assign_lpt(weights: list, k: int) -> list:
+    """Greedy LPT: páginas de mayor carga primero, cada una a la mesa menos cargada."""
+    loads = [0.0] * k
+    out = [0] * len(weights)
+    for i in sorted(range(len(weights)), key=lambda i: -weights[i]):
+        b = min(range(k), key=lambda j: (loads[j], j))
+        out[i] = b
+        loads[b] += weights[i]
+    return out
+
+def _s2_assign_contiguous(weights: list, k: int) -> list:
+    """Bloques de páginas consecutivas (mesa 1 las primeras, ...) que minimizan la carga máxima:
+    búsqueda binaria sobre la capacidad por mesa + llenado greedy."""
+    if not weights:
+        return []
+
+    def fill(cap):
+        out, cur, b = [], 0.0, 0
+        for w in weights:
+            if cur > 0 and cur + w > cap:
+                b += 1
+                cur = 0.0
+            out.append(b)
+            cur += w
+        return out, b + 1
+
+    lo, hi = max(weights), float(sum(weights))
+    for _ in range(50):
+        if hi - lo <= 1e-9 * max(1.0, hi):
+            break
+        cap = (lo + hi) / 2
+        if fill(cap)[1] <= k:
+            hi = cap
+        else:
+            lo = cap
+    return fill(hi)[0]
+
+def _s2_mesa_efforts(weights: list, assign: list, k: int) -> list:
+    out = [0.0] * k
+    for w, j in zip(weights, assign):
+        out[j] += w
+    return out
+
+def _s2_assign_auto(weights: list, k: int) -> list:
+    """Contiguo si no empeora la mesa más cargada más que S2_CONTIGUOUS_TOLERANCE sobre LPT."""
+    contiguous = _s2_assign_contiguous(weights, k)
+    lpt = _s2_assign_lpt(weights, k)
+    span_c = max(_s2_mesa_efforts(weights, contiguous, k), default=0.0)
+    span_l = max(_s2_mesa_efforts(weights, lpt, k), default=0.0)
+    return contiguous if span_c <= span_l * (1 + S2_CONTIGUOUS_TOLERANCE) else lpt
+
+# nombre -> (etiqueta, función(cargas por página, k) -> índice de mesa por página)
+S2_MESA_STRATEGIES = {
+    "AUTO": ("Contiguo si está cerca del óptimo, si no LPT", _s2_assign_auto),
+    "CONTIGUOUS": ("Bloques contiguos balanceados", _s2_assign_contiguous),
+    "LPT": ("Balanceo LPT (páginas salteadas)", _s2_assign_lpt),
+    "ROUND_ROBIN": ("Round-robin (anterior)", _s2_assign_round_robin),
+}
+
+def plan_s2_page_assignment(loads: list, num_mesas: int, strategy: str = DEFAULT_S2_MESA_STRATEGY) -> dict:
+    """page_no -> mesa (1..num_mesas) según la estrategia, a partir de _s2_page_loads."""
+    k = max(1, int(num_mesas))
+    weights = [_s2_page_effort(l) for l in loads]
+    _, fn = S2_MESA_STRATEGIES.get(strategy, S2_MESA_STRATEGIES[DEFAULT_S2_MESA_STRATEGY])
+    return {l[0]: j + 1 for l, j in zip(loads, fn(weights, k))}
+
+def _s2_page_ranges(pages: list) -> str:
+    """[1,2,3,7,9,10] -> '1-3, 7, 9-10'"""
+    out = []
+    for p in sorted(pages):
+        if out and p == out[-1][1] + 1:
+            out[-1][1] = p
+        else:
+            out.append([p, p])
+    return ", ".join(str(a) if a == b else f"{a}-{b}" for a, b in out)
+
+def s2_mesa_plan_summary(loads: list, plan: dict, num_mesas: int) -> pd.DataFrame:
+    """Carga prevista por mesa de un plan page_no -> mesa (páginas sin mesa no cuentan)."""
+    rows = {m: {"Mesa": m, "Páginas": [], "Ventas": 0, "Líneas": 0, "Unidades": 0, "Carga": 0.0}
+            for m in range(1, max(1, int(num_mesas)) + 1)}
+    for l in loads:
+        m = plan.get(l[0])
+        if m is None:
+            continue
+        r = rows.setdefault(m, {"Mesa": m, "Páginas": [], "Ventas": 0, "Líneas": 0, "Unidades": 0, "Carga": 0.0})
+        r["Páginas"].append(l[0])
+        r["Ventas"] += l[1]
+        r["Líneas"] += l[2]
+        r["Unidades"] += l[3]
+        r["Carga"] += _s2_page_effort(l)
+    out = [dict(r, Páginas=_s2_page_ranges(r["Páginas"])) for _, r in sorted(rows.items())]
+    return pd.DataFrame(out, columns=["Mesa", "Páginas", "Ventas", "Líneas", "Unidades", "Carga"])
+
+def compare_s2_mesa_strategies(loads: list, num_mesas: int) -> list:
+    """Carga de la mesa más cargada / menos cargada por estrategia, para elegir antes de aplicar."""
+    k = max(1, int(num_mesas))
+    weights = [_s2_page_effort(l) for l in loads]
+    out = []
+    for name, (label, fn) in S2_MESA_STRATEGIES.items():
+        efforts = _s2_mesa_efforts(weights, fn(weights, k), k)
+        out.append({
+            "strategy": name,
+            "label": label,
+            "makespan": max(efforts) if efforts else 0.0,
+            "min": min(efforts) if efforts else 0.0,
+            "total": sum(efforts),
+        })
+    return out
+
+def _s2_apply_page_plan(mid:int, plan: dict) -> int:
+    """Guarda un plan page_no -> mesa (una sola executemany); devuelve filas escritas."""
+    if not plan:
         return 0
     conn=get_conn()
     c=conn.cursor()
-    for i,p in enumerate(pages):
-        mesa = (i % num_mesas) + 1
-        c.execute("""INSERT INTO s2_page_assign(manifest_id, page_no, mesa)
+    c.executemany("""INSERT INTO s2_page_assign(manifest_id, page_no, mesa)
                      VALUES(?,?,?)
-                     ON CONFLICT(manifest_id, page_no) DO UPDATE SET mesa=excluded.mesa;""", (mid, p, mesa))
+                     ON CONFLICT(manifest_id, page_no) DO UPDATE SET mesa=excluded.mesa;""",
+                  [(mid, int(p), int(m)) for p, m in plan.items()])
+    n = c.rowcount
     conn.commit()
     conn.close()
-    return len(pages)
+    return n
+
+def _s2_auto_assign_pages(mid:int, num_mesas:int=S2_DEFAULT_MESAS, strategy:str=DEFAULT_S2_MESA_STRATEGY):
+    loads=_s2_page_loads(mid)
+    if not loads:
+        return 0
+    return _s2_apply_page_plan(mid, plan_s2_page_assignment(loads, num_mesas, strategy))
 
 def _s2_get_assignments(mid:int):
     conn=get_conn()
@@ -4061,24 +5858,27 @@ def _s2_set_assignment(mid:int, page_no:int, mesa:int):
     conn.commit()
     conn.close()
 
+# UPDATE ... FROM existe desde SQLite 3.33; antes se usa la subconsulta correlacionada.
+_SQLITE_UPDATE_FROM = sqlite3.sqlite_version_info >= (3, 33, 0)
+
 def _s2_create_corridas(mid:int):
-    # apply mesa from page assignments to sales
+    # apply mesa from page assignments to sales (una sola sentencia; devuelve ventas actualizadas)
     conn=get_conn()
     c=conn.cursor()
-    c.execute("SELECT page_no, mesa FROM s2_page_assign WHERE manifest_id=?;", (mid,))
-    page_to_mesa = {int(p): int(m) for p,m in c.fetchall()}
-    # update sales
-    c.execute("SELECT sale_id, page_no FROM s2_sales WHERE manifest_id=?;", (mid,))
-    sales = c.fetchall()
-    updated=0
-    for sale_id, page_no in sales:
-        mesa = page_to_mesa.get(int(page_no))
-        if mesa is None:
-            continue
+    if _SQLITE_UPDATE_FROM:
+        c.execute("""UPDATE s2_sales
+                     SET mesa=pa.mesa, status='PENDING', opened_at=NULL, closed_at=NULL
+                     FROM s2_page_assign pa
+                     WHERE pa.manifest_id=s2_sales.manifest_id AND pa.page_no=s2_sales.page_no
+                       AND s2_sales.manifest_id=?;""", (mid,))
+    else:
         c.execute("""UPDATE s2_sales
-                     SET mesa=?, status='PENDING', opened_at=NULL, closed_at=NULL
-                     WHERE manifest_id=? AND sale_id=?;""", (mesa, mid, sale_id))
-        updated += 1
+                     SET mesa=(SELECT pa.mesa FROM s2_page_assign pa
+                               WHERE pa.manifest_id=s2_sales.manifest_id AND pa.page_no=s2_sales.page_no),
+                         status='PENDING', opened_at=NULL, closed_at=NULL
+                     WHERE manifest_id=?
+                       AND page_no IN (SELECT page_no FROM s2_page_assign WHERE manifest_id=?);""", (mid, mid))
+    updated = c.rowcount
     conn.commit()
     conn.close()
     return updated
@@ -4116,24 +5916,111 @@ def _s2_sale_items(mid:int, sale_id:str):
     conn.close()
     return rows
 
-def _s2_apply_pick(mid:int, sale_id:str, sku:str, add_qty:int):
+def _s2_items_done(items) -> bool:
+    """Venta completa: todos los ítems (filas de _s2_sale_items) en DONE o INCIDENCE."""
+    return all(row[4] in ("DONE", "INCIDENCE") for row in items)
+
+def _s2_apply_scan(mid:int, sale_id:str, scan:str, barcode_to_sku=None, add_qty:int=None) -> dict:
+    """Escaneo de producto sobre la venta abierta en una sola conexión y transacción:
+    resuelve SKU/EAN (si se pasa barcode_to_sku), suma add_qty a picked con tope qty
+    (None = completa lo pendiente) y devuelve los ítems ya actualizados.
+    -> {"ok", "msg", "sku", "items", "done", "version"}
+
+    El incremento se hace en el UPDATE (picked = MIN(qty, picked + n)) dentro de
+    BEGIN IMMEDIATE, así dos equipos escaneando la misma venta no se pisan."""
+    sku = resolve_scan_to_sku(scan, barcode_to_sku) if barcode_to_sku is not None else str(scan).strip()
+    n = None if add_qty is None else int(add_qty)
     conn=get_conn()
     c=conn.cursor()
-    c.execute("""SELECT qty, picked FROM s2_items
-                 WHERE manifest_id=? AND sale_id=? AND sku=?;""", (mid, sale_id, sku))
-    row=c.fetchone()
-    if not row:
+    try:
+        if not conn.in_transaction:
+            c.execute("BEGIN IMMEDIATE;")
+        c.execute("""UPDATE s2_items
+                     SET picked = MIN(qty, picked + COALESCE(?, qty)),
+                         status = CASE WHEN MIN(qty, picked + COALESCE(?, qty)) >= qty THEN 'DONE' ELSE 'PENDING' END
+                     WHERE manifest_id=? AND sale_id=? AND sku=?;""", (n, n, mid, sale_id, sku))
+        ok = c.rowcount > 0
+        c.execute("""SELECT sku, description, qty, picked, status
+                     FROM s2_items WHERE manifest_id=? AND sale_id=? ORDER BY sku;""", (mid, sale_id))
+        items = c.fetchall()
+        row = c.execute("SELECT version FROM s2_sales WHERE manifest_id=? AND sale_id=?;", (mid, sale_id)).fetchone()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
         conn.close()
-        return False, "SKU no pertenece a esta venta"
-    qty, picked = int(row[0]), int(row[1])
-    new_picked = min(qty, picked + int(add_qty))
-    status = "DONE" if new_picked >= qty else "PENDING"
-    c.execute("""UPDATE s2_items SET picked=?, status=? WHERE manifest_id=? AND sale_id=? AND sku=?;""", 
-              (new_picked, status, mid, sale_id, sku))
-    # if all done, allow close
-    conn.commit()
+    return {
+        "ok": ok,
+        "msg": None if ok else "SKU no pertenece a esta venta",
+        "sku": sku,
+        "items": items,
+        "done": _s2_items_done(items),
+        "version": row[0] if row else None,
+    }
+
+def _s2_apply_pick(mid:int, sale_id:str, sku:str, add_qty:int):
+    res = _s2_apply_scan(mid, sale_id, sku, add_qty=add_qty)
+    return res["ok"], res["msg"]
+
+def _s2_item_title(sku, desc, inv_map_sku) -> str:
+    """Título visible de un ítem: maestro (SKU tal cual o sin ceros a la izquierda) > descripción > SKU."""
+    title = None
+    if isinstance(inv_map_sku, dict):
+        k = str(sku).strip()
+        title = inv_map_sku.get(k)
+        if title is None and k.isdigit():
+            try:
+                title = inv_map_sku.get(str(int(k)))
+            except Exception:
+                pass
+    return title or desc or str(sku)
+
+def _s2_load_sale_view(mid:int, sale_id:str, inv_map_sku) -> dict:
+    """Todo lo que muestra el Camarero para la venta abierta (venta, etiqueta, ítems, títulos),
+    leído en una sola conexión. Se guarda en session_state["s2_sale_view"] y se recarga
+    cuando cambia la venta/maestro o s2_sales.version (escrituras de cualquier equipo)."""
+    conn=get_conn()
+    c=conn.cursor()
+    # version se lee antes que los ítems: si alguien escribe entremedio, el próximo rerun recarga
+    sale_row = c.execute("SELECT shipment_id, pack_id, customer, page_no, mesa, status, version FROM s2_sales WHERE manifest_id=? AND sale_id=?;", (mid, sale_id)).fetchone()
+    shipment_id = sale_row[0] if sale_row else ""
+    info = _s2_label_info(mid, shipment_id, c)
+    items = c.execute("""SELECT sku, description, qty, picked, status
+                         FROM s2_items WHERE manifest_id=? AND sale_id=? ORDER BY sku;""", (mid, sale_id)).fetchall()
+    conn.close()
+    return {
+        "mid": mid,
+        "sale_id": sale_id,
+        "inv_id": id(inv_map_sku),
+        "shipment_id": shipment_id,
+        "pack_id": sale_row[1] if sale_row else "",
+        "customer": sale_row[2] if sale_row else "",
+        "page_no": sale_row[3] if sale_row else "",
+        "mesa": sale_row[4] if sale_row else "",
+        "version": sale_row[6] if sale_row else None,
+        "info": info,
+        "items": items,
+        "titles": {sku: _s2_item_title(sku, desc, inv_map_sku) for sku, desc, _q, _p, _s in items},
+        "done": _s2_items_done(items),
+    }
+
+def _s2_sale_version(mid:int, sale_id:str):
+    conn=get_conn()
+    row = conn.execute("SELECT version FROM s2_sales WHERE manifest_id=? AND sale_id=?;", (mid, sale_id)).fetchone()
     conn.close()
-    return True, None
+    return row[0] if row else None
+
+def _s2_sale_view(mid:int, sale_id:str, inv_map_sku) -> dict:
+    view = st.session_state.get("s2_sale_view")
+    if (not view or view["mid"] != mid or view["sale_id"] != sale_id or view["inv_id"] != id(inv_map_sku)
+            or view["version"] != _s2_sale_version(mid, sale_id)):
+        view = _s2_load_sale_view(mid, sale_id, inv_map_sku)
+        st.session_state["s2_sale_view"] = view
+    return view
+
+def _s2_sale_view_invalidate():
+    st.session_state.pop("s2_sale_view", None)
 
 
 def _s2_mark_incidence(mid:int, sale_id:str, sku:str, note:str=""):
@@ -4175,13 +6062,14 @@ def _s2_close_sale(mid:int, sale_id:str):
 def _s2_reset_all():
     conn=get_conn()
     c=conn.cursor()
-    for t in ["s2_labels","s2_items","s2_sales","s2_page_assign","s2_files","s2_manifests"]:
+    for t in ["s2_labels","s2_items","s2_sales","s2_page_assign","s2_files","s2_manifests","s2_parse_cache"]:
         c.execute(f"DROP TABLE IF EXISTS {t};")
     conn.commit()
     conn.close()
+    _s2_label_info_invalidate()
+    init_db(force=True)
 
 def page_sorting_upload(inv_map_sku, barcode_to_sku):
-    _s2_create_tables()
     st.title("Sorting - Carga y Corridas")
 
     mid = _s2_get_active_manifest_id()
@@ -4200,14 +6088,20 @@ def page_sorting_upload(inv_map_sku, barcode_to_sku):
     with col2:
         zpl = st.file_uploader("Etiquetas de envío (TXT/ZPL)", type=["txt","zpl"], key="s2_labels_txt")
 
+    # El uploader conserva el archivo entre reruns: si es el mismo (sha256) no se vuelve a
+    # cargar (re-cargar reiniciaría ventas/items y la asignación de mesas).
     if pdf is not None:
-        n_sales = _s2_upsert_control(mid, getattr(pdf, "name", "control.pdf"), pdf.getvalue())
-        st.success(f"Control cargado. Ventas detectadas: {n_sales}")
-        _s2_auto_assign_pages(mid, num_mesas=10)
+        pdf_bytes = pdf.getvalue()
+        if not _s2_file_is_current(mid, "control", _s2_sha256(pdf_bytes)):
+            n_sales = _s2_upsert_control(mid, getattr(pdf, "name", "control.pdf"), pdf_bytes)
+            st.success(f"Control cargado. Ventas detectadas: {n_sales}")
+            _s2_auto_assign_pages(mid, num_mesas=int(st.session_state.get("s2_num_mesas", S2_DEFAULT_MESAS)))
 
     if zpl is not None:
-        n_labels = _s2_upsert_labels(mid, getattr(zpl, "name", "etiquetas.txt"), zpl.getvalue())
-        st.success(f"Etiquetas cargadas. IDs detectados: {n_labels}")
+        zpl_bytes = zpl.getvalue()
+        if not _s2_file_is_current(mid, "labels", _s2_sha256(zpl_bytes)):
+            n_labels = _s2_upsert_labels(mid, getattr(zpl, "name", "etiquetas.txt"), zpl_bytes)
+            st.success(f"Etiquetas cargadas. IDs detectados: {n_labels}")
 
     # Resumen (para evitar confusión: ventas y etiquetas NO siempre coinciden 1:1)
     stats = _s2_get_stats(mid)
@@ -4236,6 +6130,35 @@ def page_sorting_upload(inv_map_sku, barcode_to_sku):
         return
 
     st.subheader("Asignación Página → Mesa")
+    num_mesas = st.number_input("Mesas activas", min_value=1, max_value=50,
+                                value=int(st.session_state.get("s2_num_mesas", S2_DEFAULT_MESAS)), key="s2_num_mesas")
+
+    with st.expander("Planificador de carga por mesa", expanded=False):
+        loads = _s2_page_loads(mid)
+        st.caption("Carga = ventas + líneas + unidades por página. Contiguo mantiene páginas seguidas en la misma mesa.")
+        cmp = compare_s2_mesa_strategies(loads, int(num_mesas))
+        st.dataframe(
+            pd.DataFrame([{"Estrategia": r["label"], "Mesa más cargada": round(r["makespan"], 1),
+                           "Mesa menos cargada": round(r["min"], 1)} for r in cmp]),
+            use_container_width=True, hide_index=True,
+        )
+        names = list(S2_MESA_STRATEGIES.keys())
+        strategy = st.radio("Estrategia", names, index=names.index(DEFAULT_S2_MESA_STRATEGY),
+                            format_func=lambda n: S2_MESA_STRATEGIES[n][0], horizontal=True, key="s2_mesa_strategy")
+        plan = plan_s2_page_assignment(loads, int(num_mesas), strategy)
+        preview = s2_mesa_plan_summary(loads, plan, int(num_mesas))
+        current = s2_mesa_plan_summary(loads, dict(_s2_get_assignments(mid)), int(num_mesas))
+        m1, m2 = st.columns(2)
+        m1.metric("Mesa más cargada (actual)", round(float(current["Carga"].max() or 0), 1))
+        m2.metric("Mesa más cargada (plan)", round(float(preview["Carga"].max() or 0), 1))
+        st.dataframe(preview, use_container_width=True, hide_index=True)
+        if st.button("Aplicar plan", use_container_width=True):
+            _s2_apply_page_plan(mid, plan)
+            # los number_input por página conservan su valor anterior si no se limpian
+            for p in pages:
+                st.session_state.pop(f"s2_mesa_{p}", None)
+            st.rerun()
+
     assigns = dict(_s2_get_assignments(mid))
     for p in pages:
         cur = assigns.get(p, 1)
@@ -4249,7 +6172,9 @@ def page_sorting_upload(inv_map_sku, barcode_to_sku):
     if missing:
         st.warning(f"Faltan páginas por asignar: {missing}")
         if st.button("Auto-asignar faltantes", use_container_width=True):
-            _s2_auto_assign_pages(mid, num_mesas=10)
+            _s2_auto_assign_pages(mid, num_mesas=int(num_mesas))
+            for p in pages:
+                st.session_state.pop(f"s2_mesa_{p}", None)
             st.rerun()
 
     st.divider()
@@ -4262,7 +6187,6 @@ def page_sorting_upload(inv_map_sku, barcode_to_sku):
             st.session_state["s2_last_created"] = created
 
 def page_sorting_camarero(inv_map_sku, barcode_to_sku):
-    _s2_create_tables()
     st.title("Camarero")
     st.caption("Escaneo por etiqueta (Flex/Colecta) y productos por SKU/EAN")
     mid = _s2_get_active_manifest_id()
@@ -4312,18 +6236,15 @@ def page_sorting_camarero(inv_map_sku, barcode_to_sku):
     st.info(f"Venta abierta: {sale_id}")
 
 
-    # Información de la etiqueta / envío
-    conn=get_conn(); c=conn.cursor()
-    sale_row = c.execute("SELECT shipment_id, pack_id, customer, page_no, mesa, status FROM s2_sales WHERE manifest_id=? AND sale_id=?;", (mid, sale_id)).fetchone()
-    conn.close()
-    shipment_id = sale_row[0] if sale_row else ""
-    pack_id = sale_row[1] if sale_row else ""
-    customer = sale_row[2] if sale_row else ""
-    page_no = sale_row[3] if sale_row else ""
-    mesa_db = sale_row[4] if sale_row else ""
-
-    raw_label = _s2_get_label_raw(mid, shipment_id) if shipment_id else ""
-    info = _s2_parse_label_raw_info(raw_label)
+    # Venta abierta (venta + etiqueta + ítems) cacheada en la sesión: teclear en el campo de
+    # escaneo no vuelve a la DB ni al parser de etiquetas.
+    view = _s2_sale_view(mid, sale_id, inv_map_sku)
+    shipment_id = view["shipment_id"]
+    pack_id = view["pack_id"]
+    customer = view["customer"]
+    page_no = view["page_no"]
+    mesa_db = view["mesa"]
+    info = view["info"]
 
     st.markdown("### Etiqueta / Envío")
     a,b,cx = st.columns(3)
@@ -4334,11 +6255,9 @@ def page_sorting_camarero(inv_map_sku, barcode_to_sku):
     name = info.get("destinatario") or customer or "-"
     addr = info.get("direccion") or "-"
     comuna = info.get("comuna") or info.get("ciudad_destino") or "-"
-    
-    
-    
 
-    items = _s2_sale_items(mid, sale_id)
+    items, done = view["items"], view["done"]
+    titles = view["titles"]
 
     st.markdown("### Productos de la venta")
     total_items = len(items)
@@ -4347,16 +6266,7 @@ def page_sorting_camarero(inv_map_sku, barcode_to_sku):
     st.caption(f"{done_items}/{total_items} ítems finalizados (DONE o INCIDENCE)")
 
     for sku, desc, qty, picked, status in items:
-        title = None
-        if isinstance(inv_map_sku, dict):
-            k = str(sku).strip()
-            title = inv_map_sku.get(k)
-            if title is None and k.isdigit():
-                try:
-                    title = inv_map_sku.get(str(int(k)))
-                except Exception:
-                    pass
-        title = title or desc or str(sku)
+        title = titles.get(sku) or desc or str(sku)
 
         remaining = max(0, int(qty) - int(picked))
         row1 = st.columns([6, 2, 2])
@@ -4368,9 +6278,11 @@ def page_sorting_camarero(inv_map_sku, barcode_to_sku):
             bcols = st.columns([1,1,6])
             if bcols[0].button("⚠️ Incidencia", key=f"s2_inc_{sale_id}_{sku}"):
                 _s2_mark_incidence(mid, sale_id, str(sku))
+                _s2_sale_view_invalidate()
                 st.rerun()
             if bcols[1].button("📝 Sin EAN", key=f"s2_noean_{sale_id}_{sku}"):
                 _s2_force_done_no_ean(mid, sale_id, str(sku))
+                _s2_sale_view_invalidate()
                 st.rerun()
         st.divider()
 
@@ -4401,20 +6313,13 @@ def page_sorting_camarero(inv_map_sku, barcode_to_sku):
     if sku_scan and not pending_sku:
         sku = resolve_scan_to_sku(sku_scan, barcode_to_sku)
 
-        # Buscar qty/picked del ítem dentro de esta venta
-        connx = get_conn()
-        cx = connx.cursor()
-        cx.execute(
-            "SELECT qty, picked, description FROM s2_items WHERE manifest_id=? AND sale_id=? AND sku=?;",
-            (mid, sale_id, str(sku))
-        )
-        row = cx.fetchone()
-        connx.close()
+        # Buscar qty/picked del ítem dentro de esta venta (ya cargados arriba)
+        row = next((r for r in items if str(r[0]) == str(sku)), None)
 
         if not row:
             st.error("SKU/EAN no pertenece a esta venta.")
         else:
-            qty_req, picked_now, desc_ml = int(row[0]), int(row[1]), row[2]
+            qty_req, picked_now, desc_ml = int(row[2]), int(row[3]), row[1]
             remaining = max(0, qty_req - picked_now)
 
             # Resolver título visible (maestro > descripción > SKU)
@@ -4445,10 +6350,14 @@ def page_sorting_camarero(inv_map_sku, barcode_to_sku):
         cA, cB = st.columns([2, 1])
         with cA:
             if st.button(f"✅ Verificar {pending_qty} y cerrar producto", key=f"s2_verify_{sale_id}_{pending_sku}", use_container_width=True):
-                ok, msg = _s2_apply_pick(mid, sale_id, str(pending_sku), int(pending_qty))
-                if not ok:
-                    st.error(msg or "No se pudo aplicar.")
+                res = _s2_apply_scan(mid, sale_id, str(pending_sku), add_qty=int(pending_qty))
+                if not res["ok"]:
+                    # la venta cambió en otro equipo (p.ej. se recargó el Control): releer
+                    _s2_sale_view_invalidate()
+                    st.error(res["msg"] or "No se pudo aplicar.")
                 else:
+                    # ítems y versión leídos en la misma transacción del escaneo: sin recarga extra
+                    view["items"], view["done"], view["version"] = res["items"], res["done"], res["version"]
                     st.session_state["s2_pending_sku"] = None
                     st.session_state["s2_pending_qty"] = 0
                     st.session_state["s2_pending_title"] = ""
@@ -4460,8 +6369,6 @@ def page_sorting_camarero(inv_map_sku, barcode_to_sku):
                 st.session_state["s2_pending_title"] = ""
                 st.rerun()
 
-    done = _s2_is_sale_done(mid, sale_id)
-
     st.subheader("Cerrar venta")
     if done:
         c1, c2 = st.columns([1,2])
@@ -4470,6 +6377,7 @@ def page_sorting_camarero(inv_map_sku, barcode_to_sku):
         with c2:
             if st.button("✅ Cerrar venta y volver a escanear etiqueta", key=f"s2_close_{sale_id}", use_container_width=True, disabled=not confirm_close):
                 _s2_close_sale(mid, sale_id)
+                _s2_sale_view_invalidate()
                 st.session_state["s2_sale_open"] = None
                 st.session_state["s2_clear_prod_scan"] = True
                 st.session_state["s2_clear_label_scan"] = True
@@ -4480,7 +6388,6 @@ def page_sorting_camarero(inv_map_sku, barcode_to_sku):
 
 
 def page_sorting_admin(inv_map_sku, barcode_to_sku):
-    _s2_create_tables()
     st.title("Administrador")
 
     # Respaldo/Restauración SOLO SORTING (no afecta otros módulos)
@@ -4516,6 +6423,9 @@ def page_sorting_admin(inv_map_sku, barcode_to_sku):
         st.caption(f"Control: {control_name or '-'} · Etiquetas: {labels_name or '-'} · Actualizado: {updated_at or '-'}")
     else:
         st.caption("Aún no se han cargado archivos para este manifiesto.")
+    if st.button("Recalcular contadores", key="s2_stats_fresh"):
+        _s2_get_stats(mid, fresh=True)
+        st.rerun()
 
     # ---- Trazabilidad ----
     st.divider()
@@ -5048,8 +6958,14 @@ def main():
     sfx_render_pending()
     init_db()
 
+    # Fuera del Supervisor Full no corre el fragmento del modo ráfaga: lo que quedó en cola se aplica aquí
+    if not (st.session_state.get("app_mode") == "FULL"
+            and str(st.session_state.get("full_menu_page", "")).startswith("2")):
+        _full_burst_flush_pending()
+
     # Auto-carga maestro desde repo (sirve para ambos modos)
-    inv_map_sku, barcode_to_sku, conflicts = master_bootstrap(MASTER_FILE)
+    inv_map_sku, _barcode_map, conflicts = master_bootstrap(MASTER_FILE)
+    barcode_to_sku = get_barcode_resolver(MASTER_FILE)
 
     # Si no hay modo seleccionado, mostramos lobby y salimos
     if "app_mode" not in st.session_state:
@@ -5128,7 +7044,7 @@ def main():
             "2) Supervisor de acopio",
             "3) Admin Full (progreso)",
         ]
-        page = st.sidebar.radio("Menú", pages, index=0)
+        page = st.sidebar.radio("Menú", pages, index=0, key="full_menu_page")
 
         if page.startswith("1"):
             page_full_upload(inv_map_sku)
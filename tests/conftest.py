@@ -0,0 +1,50 @@
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, "tests", "fixtures")
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import app  # noqa: E402
+
+
+def fixture_path(name: str) -> str:
+    return os.path.join(FIXTURES, name)
+
+
+@pytest.fixture
+def pool_spy(monkeypatch):
+    """Registra los pools de app que terminan su map sin error (si el pool falla, app cae
+    al modo serial en silencio y el test no se daría cuenta)."""
+    used = []
+
+    class SpyPool(ProcessPoolExecutor):
+        def map(self, fn, *iterables, **kw):
+            out = list(super().map(fn, *iterables, **kw))
+            used.append(len(out))
+            return out
+
+    monkeypatch.setattr(app, "ProcessPoolExecutor", SpyPool)
+    return used
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """aurora_ml.db nuevo en un directorio temporal, con todas las migraciones aplicadas."""
+    monkeypatch.chdir(tmp_path)
+    with app._DB_POOL_LOCK:
+        while app._DB_POOL_IDLE:
+            app._DB_POOL_IDLE.pop().close()
+    app._DB_THREAD.slot = None
+    app._DB_SCHEMA_CACHE["version"] = None
+    app._S2_LABEL_INFO_CACHE.clear()
+    monkeypatch.setattr(app, "_SCHEMA_READY", False)
+    app.init_db()
+    yield tmp_path
+    with app._DB_POOL_LOCK:
+        while app._DB_POOL_IDLE:
+            app._DB_POOL_IDLE.pop().close()
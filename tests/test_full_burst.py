@@ -0,0 +1,43 @@
+import os
+
+import pandas as pd
+import pytest
+from streamlit.testing.v1 import AppTest
+
+import app
+from conftest import ROOT
+
+
+@pytest.fixture
+def burst_app(db):
+    batch_id, _summary = app.upsert_full_batch_from_df(
+        pd.DataFrame({"sku_ml": ["100", "200"], "qty_required": [5, 1], "title": ["Taladro", "Sierra"]}), "lote"
+    )
+    at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=60)
+    at.session_state["app_mode"] = "FULL"
+    at.run()
+    at.radio(key="full_menu_page").set_value("2) Supervisor de acopio").run()
+    at.toggle[0].set_value(True).run()
+    scan = next(t for t in at.text_input if t.label == "Escaneo ráfaga")
+    scan.set_value("100").run()
+    scan = next(t for t in at.text_input if t.label == "Escaneo ráfaga")
+    scan.set_value("100").run()
+    assert not at.exception
+    assert len(at.session_state["full_sup_state"][str(batch_id)]["burst_queue"]) == 2
+    assert app.load_full_sku_state(batch_id)["100"]["chk"] == 0
+    return at, batch_id
+
+
+def test_burst_queue_flushed_when_leaving_supervisor_page(burst_app):
+    at, batch_id = burst_app
+    at.radio(key="full_menu_page").set_value("3) Admin Full (progreso)").run()
+    assert not at.exception
+    assert app.load_full_sku_state(batch_id)["100"]["chk"] == 2
+    assert at.session_state["full_sup_state"][str(batch_id)]["burst_queue"] == []
+
+
+def test_burst_queue_flushed_when_leaving_full_mode(burst_app):
+    at, batch_id = burst_app
+    next(b for b in at.sidebar.button if b.label.startswith("⬅️")).click().run()
+    assert not at.exception
+    assert app.load_full_sku_state(batch_id)["100"]["chk"] == 2
@@ -0,0 +1,58 @@
+import io
+import random
+import string
+
+import openpyxl
+import pandas as pd
+import pytest
+
+import app
+from conftest import fixture_path
+
+# full_multi.golden.csv = salida de read_full_excel antes de vectorizar, para full_multi.xlsx:
+# hojas con encabezados reconocibles, sin encabezados (fallback posicional), solo qty
+# reconocida, encabezados duplicados, una hoja corta sin qty y una vacía.
+WORKBOOK = fixture_path("full_multi.xlsx")
+
+
+@pytest.fixture(scope="module")
+def golden():
+    g = pd.read_csv(fixture_path("full_multi.golden.csv"), dtype=str, keep_default_na=False)
+    cols = {col: g[col].tolist() for col in app.FULL_EXCEL_COLUMNS}
+    cols["qty_required"] = [int(x) for x in cols["qty_required"]]
+    return pd.DataFrame(cols)
+
+
+def test_read_full_excel_serial_matches_golden(golden):
+    out = app.read_full_excel(WORKBOOK, max_workers=1)
+    pd.testing.assert_frame_equal(out, golden)
+    assert set(out["sheet"]) >= {"Full 1", "Hoja2", "Mixta", "Dup"}
+    assert "Corta" not in set(out["sheet"])
+
+
+def test_read_full_excel_sheet_pool_matches_golden(golden, pool_spy, monkeypatch):
+    # el libro del fixture es chico: bajar el umbral para pasar por el pool de procesos
+    monkeypatch.setattr(app, "FULL_EXCEL_PARALLEL_MIN_BYTES", 0)
+    with open(WORKBOOK, "rb") as f:
+        out = app.read_full_excel(f, max_workers=3)
+    assert pool_spy == [3]
+    pd.testing.assert_frame_equal(out, golden)
+
+
+
+def test_read_full_excel_large_workbook_uses_pool(golden, pool_spy):
+    # con el umbral real (>= FULL_EXCEL_PARALLEL_MIN_BYTES): el fixture + una hoja de relleno
+    # de texto aleatorio (no comprime) de una sola columna, que read_full_excel descarta
+    rnd = random.Random(21)
+    wb = openpyxl.load_workbook(WORKBOOK)
+    ws = wb.create_sheet("Relleno")
+    for _ in range(48):
+        ws.append(["".join(rnd.choices(string.ascii_letters + string.digits, k=30000))])
+    bio = io.BytesIO()
+    wb.save(bio)
+    data = bio.getvalue()
+    assert len(data) >= app.FULL_EXCEL_PARALLEL_MIN_BYTES
+
+    out = app.read_full_excel(data, max_workers=2)
+    assert pool_spy == [2]
+    pd.testing.assert_frame_equal(out, golden)
@@ -0,0 +1,21 @@
+import pandas as pd
+
+import app
+from conftest import fixture_path
+
+# ventas_ml.golden.csv = salida de la versión con iterrows (antes de vectorizar) sobre ventas_ml.xlsx
+GOLDEN = fixture_path("ventas_ml.golden.csv")
+
+
+def _golden() -> pd.DataFrame:
+    df = pd.read_csv(GOLDEN, dtype=str, keep_default_na=False)
+    df["qty"] = df["qty"].astype("int64")
+    return df
+
+
+def test_import_sales_excel_matches_golden():
+    out = app.import_sales_excel(fixture_path("ventas_ml.xlsx"))
+    pd.testing.assert_frame_equal(out, _golden(), check_dtype=False, check_exact=True)
+    assert str(out["qty"].dtype) == "int64"
+    assert all(pd.api.types.is_string_dtype(out[c]) for c in ("ml_order_id", "buyer", "sku_ml", "title_ml"))
+
@@ -0,0 +1,41 @@
+import pandas as pd
+import pytest
+
+import app
+from conftest import fixture_path
+
+# 16 páginas; al final de cada una queda una venta partida (Pack/SKU/Venta aquí, Cantidad
+# en la página siguiente), así que con 2 o 4 procesos hay ventas que cruzan el borde de bloque.
+CONTROL_PDF = fixture_path("control_16p.pdf")
+
+
+@pytest.fixture(scope="module")
+def pdf_bytes():
+    with open(CONTROL_PDF, "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("workers", [2, 4])
+def test_pooled_page_texts_match_serial(pdf_bytes, pool_spy, workers):
+    serial = app.pdf_extract_page_texts(pdf_bytes, max_workers=1)
+    pooled = app.pdf_extract_page_texts(pdf_bytes, max_workers=workers)
+    assert pool_spy == [workers]
+    assert len(serial) == 16
+    assert pooled == serial
+
+
+@pytest.mark.parametrize("workers", [2, 4])
+def test_pooled_parsers_match_serial(pdf_bytes, pool_spy, workers):
+    serial = app._s2_parse_control_pdf(pdf_bytes, max_workers=1)
+    pooled = app._s2_parse_control_pdf(pdf_bytes, max_workers=workers)
+    assert pooled == serial
+    # las ventas partidas entre páginas conservan su ítem y la cantidad de la página siguiente
+    split = [s for s in serial if any(i["sku"].startswith("9000") for i in s["items"])]
+    assert len(split) == 15
+    assert all(s["items"][-1]["qty"] == 3 for s in split)
+
+    pd.testing.assert_frame_equal(
+        app._parse_manifest_texts(app.pdf_extract_page_texts(pdf_bytes, max_workers=workers)),
+        app._parse_manifest_texts(app.pdf_extract_page_texts(pdf_bytes, max_workers=1)),
+    )
+    assert len(pool_spy) == 2
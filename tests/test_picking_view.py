@@ -0,0 +1,114 @@
+import types
+
+import pytest
+from streamlit.testing.v1 import AppTest
+
+import app
+
+PAGE = """
+import app
+app.page_picking()
+"""
+
+
+def _seed(ots, tasks=()):
+    """ots: [(ot_code, picker_name, status)]; tasks: [(ot_code, sku, status)]."""
+    conn = app.get_conn()
+    c = conn.cursor()
+    for code, picker, status in ots:
+        row = c.execute("SELECT id FROM pickers WHERE name=?;", (picker,)).fetchone()
+        pid = row[0] if row else c.execute("INSERT INTO pickers(name) VALUES(?);", (picker,)).lastrowid
+        c.execute("INSERT INTO picking_ots(ot_code, picker_id, status, created_at) VALUES(?,?,?, 'x');",
+                  (code, pid, status))
+    for code, sku, status in tasks:
+        c.execute("""INSERT INTO picking_tasks(ot_id, sku_ml, title_ml, qty_total, qty_picked, status)
+                     SELECT id, ?, 'Producto', 1, 0, ? FROM picking_ots WHERE ot_code=?;""", (sku, status, code))
+    conn.commit()
+    conn.close()
+
+
+def _ot_status(code):
+    conn = app.get_conn()
+    row = conn.execute("SELECT status FROM picking_ots WHERE ot_code=?;", (code,)).fetchone()
+    conn.close()
+    return row[0]
+
+
+def _page(picker="P1"):
+    at = AppTest.from_string(PAGE, default_timeout=30)
+    at.session_state["selected_picker"] = picker
+    return at.run()
+
+
+def test_close_empty_ot(db):
+    # una OT por pickeador: con más pickeadores que ventas queda una OT sin tareas
+    _seed([("OT001", "P1", "OPEN")])
+    at = _page()
+    assert not at.exception
+    close = [b for b in at.button if b.label == "Cerrar OT"]
+    assert close
+    close[0].click().run()
+    assert not at.exception
+    assert _ot_status("OT001") == "PICKED"
+    assert "OT cerrada." in [s.value for s in at.success]
+
+
+def test_ot_closed_on_other_device_is_not_served_from_cache(db):
+    _seed([("OT001", "P1", "OPEN"), ("OT002", "P1", "OPEN")],
+          [("OT001", "100", "PENDING"), ("OT002", "200", "PENDING")])
+    at = _page()
+    assert "OT: OT001" in [c.value for c in at.caption]
+
+    conn = app.get_conn()
+    conn.execute("UPDATE picking_ots SET status='PICKED' WHERE ot_code='OT001';")
+    conn.commit()
+    conn.close()
+    at.run()
+    assert not at.exception
+    assert "OT: OT002" in [c.value for c in at.caption]
+
+
+@pytest.fixture
+def view_session(db, monkeypatch):
+    monkeypatch.setattr(app, "st", types.SimpleNamespace(session_state={}))
+    _seed([("OT001", "P1", "OPEN")], [("OT001", str(sku), "PENDING") for sku in (30, 10, 20, 40)])
+    conn = app.get_conn()
+    yield conn
+    conn.close()
+
+
+def _full_view(c):
+    rows = c.execute(
+        "SELECT id, sku_ml, title_ml, title_tec, qty_total, qty_picked, status FROM picking_tasks WHERE ot_id=1 "
+        "ORDER BY COALESCE(defer_rank,0), COALESCE(route_rank,999999), CAST(sku_ml AS INTEGER), sku_ml, id;"
+    ).fetchall()
+    return rows, [r[0] for r in rows if r[6] == "PENDING"], sum(r[6] in ("DONE", "INCIDENCE") for r in rows)
+
+
+def _update(c, sql, tid):
+    c.execute(sql, (tid,))
+    c.commit()
+    view = app._pick_task_view(c, 1)
+    tasks, pending, done = _full_view(c)
+    assert view["tasks"] == tasks
+    assert list(view["pending"]) == pending
+    assert view["done"] == done
+    return view
+
+
+def test_task_view_pending_queue_follows_deltas(view_session):
+    c = view_session
+    view = app._pick_task_view(c, 1)
+    queue = view["pending"]
+    first, _second, third, last = list(queue)
+
+    # resolver la tarea actual o una del medio: la misma deque, sin reconstruir
+    view = _update(c, "UPDATE picking_tasks SET status='DONE', qty_picked=1 WHERE id=?;", first)
+    view = _update(c, "UPDATE picking_tasks SET status='INCIDENCE' WHERE id=?;", third)
+    assert view["pending"] is queue
+
+    # reabrir o postergar cambia el orden: la cola se rehace desde las filas
+    view = _update(c, "UPDATE picking_tasks SET status='PENDING', qty_picked=0 WHERE id=?;", first)
+    view = _update(c, "UPDATE picking_tasks SET defer_rank=5 WHERE id=?;", first)
+    assert view["pending"][-1] == first
+    _update(c, "UPDATE picking_tasks SET status='DONE', qty_picked=1 WHERE id=?;", last)
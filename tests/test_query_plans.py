@@ -0,0 +1,23 @@
+import pytest
+
+import app
+
+
+def test_hot_queries_use_their_index(db):
+    assert app.db_check_query_plans(strict=True) == []
+    assert app._DB_PLAN_PROBLEMS == []
+
+
+def test_hot_queries_after_forced_migrations(db, monkeypatch):
+    monkeypatch.setattr(app, "DB_STRICT_QUERY_PLANS", True)
+    app.init_db(force=True)
+    assert app.db_check_query_plans(strict=True) == []
+
+
+def test_dropped_index_fails_strict_check(db):
+    conn = app.get_conn()
+    conn.execute("DROP INDEX idx_s2_sales_scan_ship;")
+    conn.commit()
+    conn.close()
+    with pytest.raises(RuntimeError, match="s2 escaneo por envío"):
+        app.db_check_query_plans(strict=True)
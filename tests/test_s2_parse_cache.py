@@ -0,0 +1,47 @@
+import app
+
+
+def _cache_rows(kind=None):
+    conn = app.get_conn()
+    sql = "SELECT digest, kind, parser_version FROM s2_parse_cache"
+    rows = conn.execute(sql + (" WHERE kind=?;" if kind else ";"), (kind,) if kind else ()).fetchall()
+    conn.close()
+    return rows
+
+
+def test_parse_cache_hit_skips_parser(db):
+    calls = []
+
+    def parse(data):
+        calls.append(data)
+        return {"n": len(data)}
+
+    assert app._s2_parse_cached("labels", "1", b"abc", parse) == {"n": 3}
+    assert app._s2_parse_cached("labels", "1", b"abc", parse) == {"n": 3}
+    assert len(calls) == 1
+
+
+def test_parse_cache_prunes_old_versions_and_caps_rows(db):
+    app._s2_parse_cached("control", "0", b"viejo", lambda d: [])
+    app._s2_parse_cached("labels", "0", b"otro tipo", lambda d: [])
+    for i in range(5):
+        app._s2_parse_cached("control", "1", b"pdf %d" % i, lambda d: [], digest=f"d{i}")
+    conn = app.get_conn()
+    app._s2_parse_cache_prune(conn.cursor(), "control", "1", keep=3)
+    conn.commit()
+    conn.close()
+
+    kept = _cache_rows("control")
+    assert {r[2] for r in kept} == {"1"}
+    assert sorted(r[0] for r in kept) == ["d2", "d3", "d4"]
+    # cada tipo se poda por separado
+    assert _cache_rows("labels") == [(app._s2_sha256(b"otro tipo"), "labels", "0")]
+
+
+def test_sorting_resets_clear_parse_cache(db):
+    app._s2_parse_cached("control", "1", b"pdf", lambda d: [])
+    app._s2_reset_all_sorting()
+    assert _cache_rows() == []
+    app._s2_parse_cached("control", "1", b"pdf", lambda d: [])
+    app._s2_reset_all()
+    assert _cache_rows() == []
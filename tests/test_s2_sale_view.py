@@ -0,0 +1,58 @@
+import types
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def sale(db, monkeypatch):
+    monkeypatch.setattr(app, "st", types.SimpleNamespace(session_state={}))
+    conn = app.get_conn()
+    conn.execute("INSERT INTO s2_manifests(status, created_at) VALUES('ACTIVE', 'x');")
+    conn.execute("INSERT INTO s2_sales(manifest_id, sale_id, page_no, mesa, status) VALUES(1, 'V1', 1, 1, 'PENDING');")
+    conn.executemany(
+        "INSERT INTO s2_items(manifest_id, sale_id, sku, qty) VALUES(1, 'V1', ?, ?);",
+        [("100", 2), ("200", 1)],
+    )
+    conn.commit()
+    conn.close()
+    loads = []
+    load = app._s2_load_sale_view
+    monkeypatch.setattr(app, "_s2_load_sale_view", lambda *a: loads.append(a) or load(*a))
+    return loads
+
+
+def test_sale_view_cached_between_reruns(sale):
+    inv = {}
+    view = app._s2_sale_view(1, "V1", inv)
+    assert app._s2_sale_view(1, "V1", inv) is view
+    assert len(sale) == 1
+
+
+def test_sale_view_reloads_after_write_from_other_device(sale):
+    inv = {}
+    view = app._s2_sale_view(1, "V1", inv)
+    assert [r[3] for r in view["items"]] == [0, 0]
+
+    # otro equipo: escribe directo en la DB, sin pasar por esta sesión
+    app._s2_apply_scan(1, "V1", "100", add_qty=1)
+    view = app._s2_sale_view(1, "V1", inv)
+    assert [r[3] for r in view["items"]] == [1, 0]
+
+    app._s2_mark_incidence(1, "V1", "200")
+    app._s2_apply_scan(1, "V1", "100")
+    view = app._s2_sale_view(1, "V1", inv)
+    assert view["done"] and len(sale) == 3
+
+    app._s2_close_sale(1, "V1")
+    assert app._s2_sale_view(1, "V1", inv) is not view
+
+
+def test_own_scan_keeps_view_current_without_reload(sale):
+    inv = {}
+    view = app._s2_sale_view(1, "V1", inv)
+    res = app._s2_apply_scan(1, "V1", "100", add_qty=2)
+    view["items"], view["done"], view["version"] = res["items"], res["done"], res["version"]
+    assert app._s2_sale_view(1, "V1", inv) is view
+    assert len(sale) == 1
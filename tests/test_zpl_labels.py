@@ -0,0 +1,47 @@
+import io
+import json
+
+import pytest
+
+import app
+from conftest import fixture_path
+
+# etiquetas.golden.json = salida de _s2_parse_labels_txt antes del tokenizer en streaming
+# (split por ^XA + regex sobre el bloque unido) para etiquetas.zpl: Flex QR/barcode, Colecta
+# con Pack ID/Venta partidos en dos ^FD, ^FH, UTF-8 multibyte y una etiqueta final sin ^XZ.
+LABELS = fixture_path("etiquetas.zpl")
+
+
+@pytest.fixture(scope="module")
+def labels_bytes():
+    with open(LABELS, "rb") as f:
+        return f.read()
+
+
+@pytest.fixture(scope="module")
+def golden():
+    with open(fixture_path("etiquetas.golden.json"), encoding="utf-8") as f:
+        g = json.load(f)
+    return g["pack_to_ship"], g["sale_to_ship"], g["shipment_ids"]
+
+
+def test_labels_match_golden(labels_bytes, golden):
+    assert app._s2_parse_labels_txt(labels_bytes) == golden
+    assert app._s2_parse_labels_txt(labels_bytes.decode("utf-8")) == golden
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 4096])
+def test_labels_streaming_chunks_match_golden(labels_bytes, golden, monkeypatch, chunk_size):
+    # trozos que cortan ^XA, ^FD...^FS y caracteres UTF-8 por la mitad
+    monkeypatch.setattr(app, "ZPL_CHUNK_SIZE", chunk_size)
+    assert app._s2_parse_labels_txt(labels_bytes) == golden
+    assert app._s2_parse_labels_txt(io.BytesIO(labels_bytes)) == golden
+
+
+def test_zpl_iter_labels_fields(labels_bytes):
+    labels = list(app.zpl_iter_labels(labels_bytes))
+    first = labels[0]
+    assert first["closed"] and first["raw"] is None
+    assert ("Domicilio: Peñalolén, Ñuñoa", False, "text") in first["fields"]
+    assert (">:4612345678901", False, "barcode") in first["fields"]
+    assert not labels[-1]["closed"]
@@ -0,0 +1,40 @@
+"""Funciones para procesos hijos (ProcessPoolExecutor).
+
+Viven fuera de app.py porque Streamlit ejecuta app.py como __main__ y un proceso hijo
+no puede importar funciones desde ahí. Este módulo no importa streamlit.
+"""
+import io
+
+try:
+    import pdfplumber
+    HAS_PDF_LIB = True
+except ImportError:
+    HAS_PDF_LIB = False
+
+
+def pdf_page_count(pdf_bytes: bytes) -> int:
+    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+        return len(pdf.pages)
+
+
+def pdf_page_texts(pdf_bytes: bytes, start: int = 0, stop: int = None) -> list:
+    """Texto (extract_text) de las páginas [start, stop) en orden. '' si la página no trae texto."""
+    out = []
+    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+        pages = pdf.pages[start:stop]
+        for page in pages:
+            out.append(page.extract_text() or "")
+            # liberar el layout cacheado de la página (PDFs grandes)
+            try:
+                page.flush_cache()
+            except Exception:
+                pass
+    return out
+
+
+def excel_sheet_frames(xlsx_bytes: bytes, sheet_names: list) -> list:
+    """pd.read_excel(dtype=str) de cada hoja indicada, en el mismo orden."""
+    import pandas as pd
+
+    with pd.ExcelFile(io.BytesIO(xlsx_bytes)) as xls:
+        return [pd.read_excel(xls, sheet_name=sh, dtype=str) for sh in sheet_names]